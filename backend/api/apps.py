@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class ApiConfig(AppConfig):
+    name = 'api'
+
+    def ready(self):
+        # Connect model signal handlers
+        from . import signals  # noqa: F401
+        from . import checks  # noqa: F401
@@ -0,0 +1,262 @@
+"""
+Arrival and departure events from the stations' bus receivers.
+
+A receiver reports the buses it currently hears, each with the ETA the bus
+broadcast and when it was last heard, whenever that list changes; reports
+from many stations can be posted together. ingest_reports() folds them
+into one open StationVisit row per (station, bus). A request locks the
+rows of the stations it reports for, so two receivers' posts, or a retry
+racing the original, are applied one after the other and never log an
+arrival twice. A bus listed in consecutive reports from a station is on
+the same visit, so repeated and retried sightings only move its last-seen
+time. A visit adds at most two rows to the append-only StationEvent log,
+all of a request's in one bulk insert:
+
+- an arrival, the first time the bus is within ARRIVAL_ETA minutes, at the
+  time it was due at the stop;
+- a departure, once the station stops listing the bus, at the time it was
+  last heard.
+
+A bus that only passed within radio range without getting close leaves no
+events. fill_actual_times() copies events onto the actual times of the
+matching scheduled stops, away from the request path; run the
+fill_actual_times command every minute or so.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .ingest import parse_timestamp
+from .models import Bus, Station, StationEvent, StationSchedule, StationVisit
+
+MAX_REPORTS = 1000
+MAX_SIGHTINGS = 100
+
+# A bus within this many minutes of a station is arriving
+ARRIVAL_ETA = 1
+
+# Open visits not heard for this long, because their station stopped
+# reporting, are dropped without a departure
+VISIT_TIMEOUT = timedelta(hours=1)
+
+# An event is matched to the scheduled stop nearest in time, up to this far off
+MATCH_WINDOW = timedelta(minutes=30)
+
+INSERT_BATCH_SIZE = 2000
+UPDATE_BATCH_SIZE = 500
+
+
+class InvalidReport(ValueError):
+    pass
+
+
+def _id(raw, key):
+    try:
+        return int(raw.get(key))
+    except (TypeError, ValueError):
+        raise InvalidReport(f"{key} must be an integer")
+
+
+def parse_report(raw, now):
+    """Validate one report and return (station_id, {bus_id: (seen_at, eta)})."""
+    if not isinstance(raw, dict):
+        raise InvalidReport("report must be an object")
+    station_id = _id(raw, 'station_id')
+    bus_data = raw.get('bus_data', [])
+    if not isinstance(bus_data, list):
+        raise InvalidReport("bus_data must be a list")
+    if len(bus_data) > MAX_SIGHTINGS:
+        raise InvalidReport(f"at most {MAX_SIGHTINGS} buses per report")
+
+    sightings = {}
+    for bus in bus_data:
+        if not isinstance(bus, dict):
+            raise InvalidReport("bus_data entries must be objects")
+        bus_id = _id(bus, 'bus_id')
+        try:
+            eta = float(bus.get('eta'))
+        except (TypeError, ValueError):
+            raise InvalidReport("eta must be a number")
+        if not 0 <= eta <= 24 * 60:
+            raise InvalidReport("eta out of range")
+        seen_at = now
+        if bus.get('last_seen') is not None:
+            try:
+                seen_at = parse_timestamp(bus['last_seen'], now)
+            except ValueError as e:
+                raise InvalidReport(f"last_seen: {e}")
+        if bus_id not in sightings or seen_at > sightings[bus_id][0]:
+            sightings[bus_id] = (seen_at, eta)
+    return station_id, sightings
+
+
+def parse_batch(payload):
+    """
+    Accept a single report, a list of reports or {"reports": [...]}. Returns
+    (reports, errors) where errors is a list of {"index", "error"} dicts.
+    """
+    if isinstance(payload, dict) and 'reports' in payload:
+        payload = payload['reports']
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list):
+        raise InvalidReport("expected a report, a list of reports or {\"reports\": [...]}")
+    if len(payload) > MAX_REPORTS:
+        raise InvalidReport(f"at most {MAX_REPORTS} reports per batch")
+
+    now = timezone.now()
+    reports = []
+    errors = []
+    for index, raw in enumerate(payload):
+        try:
+            reports.append(parse_report(raw, now))
+        except InvalidReport as e:
+            errors.append({'index': index, 'error': str(e)})
+    return reports, errors
+
+
+def update_visits(visits, station_id, sightings):
+    """
+    Fold one station's report into its open visits, {bus_id: {"seen", "arrived"}}.
+    Returns (new visits, events as (station_id, bus_id, kind, timestamp)).
+    """
+    events = []
+    current = {}
+    for bus_id, (seen_at, eta) in sightings.items():
+        visit = visits.get(bus_id)
+        if visit is None:
+            visit = {'seen': seen_at, 'arrived': False}
+        else:
+            # A late or repeated report does not move a visit back
+            visit = {**visit, 'seen': max(visit['seen'], seen_at)}
+        if not visit['arrived'] and eta <= ARRIVAL_ETA:
+            visit['arrived'] = True
+            events.append((station_id, bus_id, StationEvent.ARRIVAL, seen_at + timedelta(minutes=eta)))
+        current[bus_id] = visit
+
+    for bus_id, visit in visits.items():
+        if bus_id not in current and visit['arrived']:
+            events.append((station_id, bus_id, StationEvent.DEPARTURE, visit['seen']))
+    return current, events
+
+
+def ingest_reports(payload):
+    """Validate a batch of station reports and log the events. Returns a summary for the response."""
+    reports, errors = parse_batch(payload)
+
+    station_ids = {station_id for station_id, _ in reports}
+    bus_ids = {bus_id for _, sightings in reports for bus_id in sightings}
+    known_buses = set(Bus.objects.filter(id__in=bus_ids).values_list('id', flat=True))
+
+    with transaction.atomic():
+        # Locked in id order, so requests covering the same stations cannot deadlock
+        known_stations = set(Station.objects.select_for_update().filter(id__in=station_ids).order_by(
+            'id').values_list('id', flat=True))
+        stale_before = timezone.now() - VISIT_TIMEOUT
+        rows = {}
+        visits = {station_id: {} for station_id in known_stations}
+        for row in StationVisit.objects.filter(station_id__in=known_stations):
+            rows[row.station_id, row.bus_id] = row
+            if row.seen >= stale_before:
+                visits[row.station_id][row.bus_id] = {'seen': row.seen, 'arrived': row.arrived}
+
+        events = []
+        unknown_stations = unknown_buses = 0
+        # Reports are applied in order, so several from one station in a batch
+        # behave as if they had been posted one by one
+        for station_id, sightings in reports:
+            if station_id not in known_stations:
+                unknown_stations += 1
+                continue
+            for bus_id in [bus_id for bus_id in sightings if bus_id not in known_buses]:
+                del sightings[bus_id]
+                unknown_buses += 1
+            visits[station_id], new_events = update_visits(visits[station_id], station_id, sightings)
+            events.extend(new_events)
+
+        new, changed = [], []
+        for station_id, station_visits in visits.items():
+            for bus_id, visit in station_visits.items():
+                row = rows.pop((station_id, bus_id), None)
+                if row is None:
+                    new.append(StationVisit(station_id=station_id, bus_id=bus_id, **visit))
+                elif (row.seen, row.arrived) != (visit['seen'], visit['arrived']):
+                    row.seen, row.arrived = visit['seen'], visit['arrived']
+                    changed.append(row)
+        # Whatever is left has ended or gone stale
+        StationVisit.objects.filter(id__in=[row.id for row in rows.values()]).delete()
+        StationVisit.objects.bulk_update(changed, ['seen', 'arrived'], batch_size=UPDATE_BATCH_SIZE)
+        StationVisit.objects.bulk_create(new, batch_size=INSERT_BATCH_SIZE)
+        StationEvent.objects.bulk_create([
+            StationEvent(station_id=station_id, bus_id=bus_id, kind=kind, timestamp=timestamp)
+            for station_id, bus_id, kind, timestamp in events
+        ], batch_size=INSERT_BATCH_SIZE)
+
+    return {
+        'received': len(reports) + len(errors),
+        'accepted': len(reports) - unknown_stations,
+        'events': len(events),
+        'unknown_station': unknown_stations,
+        'unknown_bus': unknown_buses,
+        'errors': errors,
+    }
+
+
+def fill_actual_times(since, log=None):
+    """
+    Set actual arrival and departure times on scheduled stops from events
+    logged since `since`. Each event goes to its bus's stop at that station
+    scheduled nearest in time, within MATCH_WINDOW; a time already set is
+    kept, so running over the same events again changes nothing. Returns
+    the number of stops updated.
+    """
+    events = list(StationEvent.objects.filter(timestamp__gte=since).order_by('timestamp').values_list(
+        'station_id', 'bus_id', 'kind', 'timestamp'
+    ))
+    if not events:
+        return 0
+
+    stops = StationSchedule.objects.filter(
+        station_id__in={event[0] for event in events},
+        schedule__bus_id__in={event[1] for event in events},
+        schedule__departure_time__lte=events[-1][3] + MATCH_WINDOW,
+        schedule__arrival_time__gte=events[0][3] - MATCH_WINDOW,
+    ).only(
+        'id', 'station', 'arrival_time', 'departure_time', 'actual_arrival_time', 'actual_departure_time',
+    ).annotate(bus_id=F('schedule__bus_id'))
+    candidates = {}
+    for stop in stops:
+        candidates.setdefault((stop.station_id, stop.bus_id), []).append(stop)
+
+    changed = {}
+    unmatched = 0
+    for station_id, bus_id, kind, timestamp in events:
+        arrival = kind == StationEvent.ARRIVAL
+        best = None
+        for stop in candidates.get((station_id, bus_id), ()):
+            if arrival:
+                scheduled = stop.arrival_time or stop.departure_time
+            else:
+                scheduled = stop.departure_time or stop.arrival_time
+            if scheduled is None:
+                continue
+            offset = abs(scheduled - timestamp)
+            if offset <= MATCH_WINDOW and (best is None or offset < best[0]):
+                best = (offset, stop)
+        if best is None:
+            unmatched += 1
+            continue
+        stop = best[1]
+        field = 'actual_arrival_time' if arrival else 'actual_departure_time'
+        if getattr(stop, field) is None:
+            setattr(stop, field, timestamp)
+            changed[stop.id] = stop
+
+    StationSchedule.objects.bulk_update(
+        list(changed.values()), ['actual_arrival_time', 'actual_departure_time'], batch_size=UPDATE_BATCH_SIZE
+    )
+    if log:
+        log(f"{len(events)} events, {len(changed)} stops updated, {unmatched} events matched no scheduled stop")
+    return len(changed)
@@ -0,0 +1,29 @@
+"""
+System checks for settings the api relies on.
+
+Table versions (response_cache, journeys, geo, geometry, eta), the fleet
+snapshot and its rebuild lock and the dashboard counters live in the
+default cache, and every worker process has to see the same values. A
+process-local backend makes each worker keep its own versions, so a
+change saved in one process never reaches the others' caches. `manage.py check --deploy` fails on such a backend.
+"""
+from django.conf import settings
+from django.core import checks
+
+PROCESS_LOCAL_BACKENDS = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_BACKENDS:
+        return [checks.Error(
+            f"The default cache ({backend}) is not shared between processes.",
+            hint="Point CACHES['default'] at Redis or Memcached so cache versions, the fleet snapshot and "
+                 "counters are the same in every worker.",
+            id='api.E001',
+        )]
+    return []
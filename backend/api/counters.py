@@ -0,0 +1,182 @@
+"""
+Incrementally maintained counters for the admin dashboard.
+
+Model signals turn every save and delete of a Bus, Station, Route, Alert or
+Booking into +/- deltas on DashboardCounter rows, in the same transaction as
+the change. Bookings are counted per day, so "today's bookings" is a lookup
+rather than a date scan. reconcile() recomputes everything from the source
+tables; run it periodically to correct drift from bulk writes. Until it
+has run once, read() returns None, whatever counters signals have started.
+
+Active schedules are not a counter: a schedule stops counting when its
+departure time passes, without any write to hook. read() counts them live,
+a range scan on the departure_time index.
+"""
+import random
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Alert, Booking, Bus, DashboardCounter, Route, Schedule, Station
+
+# Bookings arrive in bursts; spread their counters over this many rows
+BOOKING_SHARDS = 8
+
+# Daily booking counters older than this are removed by reconcile()
+BOOKING_DAYS_KEPT = 30
+
+COUNTERS = [
+    'total_buses', 'active_buses', 'total_stations', 'total_routes', 'unresolved_alerts',
+]
+
+# Written only by reconcile(). Signals create counters from their first
+# delta, so a counter existing does not mean it holds a total.
+RECONCILED_KEY = 'reconciled'
+
+
+def bookings_key(day):
+    return f"bookings:{day.isoformat()}"
+
+
+def add(key, delta, shards=1):
+    if not delta:
+        return
+    shard = random.randrange(shards)
+    updated = DashboardCounter.objects.filter(key=key, shard=shard).update(value=F('value') + delta)
+    if not updated:
+        try:
+            with transaction.atomic():
+                DashboardCounter.objects.create(key=key, shard=shard, value=delta)
+        except IntegrityError:
+            # Another writer created the row first
+            DashboardCounter.objects.filter(key=key, shard=shard).update(value=F('value') + delta)
+
+
+def read():
+    """Return the dashboard stats, or None if the counters were never reconciled. Two queries."""
+    today = bookings_key(timezone.localdate())
+    totals = dict(
+        DashboardCounter.objects.filter(key__in=COUNTERS + [today, RECONCILED_KEY]).values('key').annotate(
+            total=Sum('value')
+        ).values_list('key', 'total')
+    )
+    if RECONCILED_KEY not in totals:
+        return None
+    return {
+        'total_buses': totals['total_buses'],
+        'active_buses': totals['active_buses'],
+        'total_stations': totals['total_stations'],
+        'total_routes': totals['total_routes'],
+        'today_bookings': totals.get(today, 0),
+        'active_schedules': count_active_schedules(),
+        'unresolved_alerts': totals['unresolved_alerts'],
+    }
+
+
+def count_active_schedules(now=None):
+    return Schedule.objects.filter(is_active=True, departure_time__gte=now or timezone.now()).count()
+
+
+def count_all():
+    """The counters computed directly from the source tables."""
+    return {
+        'total_buses': Bus.objects.count(),
+        'active_buses': Bus.objects.filter(is_active=True).count(),
+        'total_stations': Station.objects.count(),
+        'total_routes': Route.objects.count(),
+        'unresolved_alerts': Alert.objects.filter(is_resolved=False).count(),
+    }
+
+
+@transaction.atomic
+def reconcile(now=None):
+    """Overwrite every counter with its true value. Returns {key: (old, new)} for drifted ones."""
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    since = today - timedelta(days=BOOKING_DAYS_KEPT - 1)
+
+    # Lock the existing rows first: writers that change a source row meanwhile
+    # block on their counter update until we commit, then apply their delta on
+    # top of the corrected value.
+    list(DashboardCounter.objects.select_for_update().values_list('pk', flat=True))
+    current = dict(
+        DashboardCounter.objects.values('key').annotate(total=Sum('value')).values_list('key', 'total')
+    )
+
+    actual = count_all()
+    start = timezone.make_aware(datetime.combine(since, datetime.min.time()))
+    per_day = Booking.objects.filter(booking_time__gte=start).annotate(
+        day=TruncDate('booking_time')
+    ).values('day').annotate(n=Count('id')).values_list('day', 'n')
+    for day, n in per_day:
+        actual[bookings_key(day)] = n
+    actual.setdefault(bookings_key(today), 0)
+    actual[RECONCILED_KEY] = 1
+
+    drift = {key: (current.get(key), value) for key, value in actual.items() if current.get(key) != value}
+    DashboardCounter.objects.filter(key__in=list(drift)).delete()
+    DashboardCounter.objects.bulk_create(
+        [DashboardCounter(key=key, shard=0, value=actual[key]) for key in drift]
+    )
+    # Days that are out of the window or no longer have any bookings, and
+    # counters that are no longer kept
+    DashboardCounter.objects.exclude(key__in=list(actual)).delete()
+    drift.pop(RECONCILED_KEY, None)
+    return drift
+
+
+def _old_values(sender, instance, fields):
+    if instance._state.adding or instance.pk is None:
+        return None
+    return sender.objects.filter(pk=instance.pk).values(*fields).first()
+
+
+def remember_old_state(sender, instance, **kwargs):
+    """pre_save: stash the fields counters depend on, before they change."""
+    fields = TRACKED_FIELDS.get(sender)
+    if fields:
+        instance._counter_old = _old_values(sender, instance, fields)
+
+
+def model_saved(sender, instance, created, **kwargs):
+    old = getattr(instance, '_counter_old', None)
+    if sender is Bus:
+        if created:
+            add('total_buses', 1)
+        was_active = old['is_active'] if old else False
+        add('active_buses', int(instance.is_active) - int(was_active))
+    elif sender is Station and created:
+        add('total_stations', 1)
+    elif sender is Route and created:
+        add('total_routes', 1)
+    elif sender is Alert:
+        was_open = (not old['is_resolved']) if old else False
+        add('unresolved_alerts', int(not instance.is_resolved) - int(was_open))
+    elif sender is Booking and created:
+        add(bookings_key(timezone.localdate(instance.booking_time)), 1, shards=BOOKING_SHARDS)
+
+
+def model_deleted(sender, instance, **kwargs):
+    if sender is Bus:
+        add('total_buses', -1)
+        add('active_buses', -int(instance.is_active))
+    elif sender is Station:
+        add('total_stations', -1)
+    elif sender is Route:
+        add('total_routes', -1)
+    elif sender is Alert:
+        add('unresolved_alerts', -int(not instance.is_resolved))
+    elif sender is Booking:
+        add(bookings_key(timezone.localdate(instance.booking_time)), -1, shards=BOOKING_SHARDS)
+
+
+# Fields whose previous value decides the delta on update
+TRACKED_FIELDS = {
+    Bus: ['is_active'],
+    Alert: ['is_resolved'],
+}
+
+COUNTED_MODELS = [Bus, Station, Route, Alert, Booking]
@@ -0,0 +1,40 @@
+"""
+Server-side dead reckoning of bus positions.
+
+Trackers in adaptive mode (hardware/dead_reckoning.py) stop reporting while
+a bus moves as predicted from its last fix, so the stored BusLocation can be
+up to a minute old on purpose. estimate() extrapolates it the same way the
+tracker does, which keeps the estimate within the tracker's distance
+threshold of the real position. extrapolate() must match the tracker's.
+"""
+import math
+
+from django.utils import timezone
+
+EARTH_RADIUS_M = 6371000
+
+# The tracker reports at least this often, so never extrapolate further
+MAX_INTERVAL = 60
+STOPPED_SPEED = 0.5
+
+
+def extrapolate(latitude, longitude, speed, heading, seconds):
+    """Position after `seconds` at `speed` m/s on `heading` degrees."""
+    if speed < STOPPED_SPEED or seconds <= 0:
+        return latitude, longitude
+    seconds = min(seconds, MAX_INTERVAL)
+    distance = speed * seconds
+    bearing = math.radians(heading)
+    lat = latitude + math.degrees(distance * math.cos(bearing) / EARTH_RADIUS_M)
+    lon = longitude + math.degrees(
+        distance * math.sin(bearing) / (EARTH_RADIUS_M * math.cos(math.radians(latitude)))
+    )
+    return lat, lon
+
+
+def estimate(location, now=None):
+    """Estimated position of a BusLocation now: {latitude, longitude, extrapolated_seconds}."""
+    now = now or timezone.now()
+    seconds = min(max((now - location.timestamp).total_seconds(), 0.0), MAX_INTERVAL)
+    lat, lon = extrapolate(location.latitude, location.longitude, location.speed, location.heading, seconds)
+    return {'latitude': lat, 'longitude': lon, 'extrapolated_seconds': round(seconds, 1)}
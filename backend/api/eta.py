@@ -0,0 +1,362 @@
+"""
+Server-side arrival predictions.
+
+Routes are cut into SEGMENT_METERS stretches. learn_speed_profiles() walks
+the location history and records, per stretch and hour of the day, how fast
+buses actually progressed along it. A profile is turned into a cumulative
+travel-time curve per hour, so the time between two points on a route is
+two np.interp lookups.
+
+The ingest path hands the newest fix per bus to EtaEngine.update(). Each
+bus's current trip (schedule, stops and their positions along the route) is
+kept in process, so a fix costs O(remaining stops). Predictions go to the
+shared cache, where the search and bus-detail views read them.
+"""
+import math
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .geometry import geometries, snap_positions, stop_distances, OFF_ROUTE_METERS
+from .models import Bus, BusLocationHistory, Schedule, SegmentSpeed, StationSchedule
+
+SEGMENT_METERS = 250
+
+# Used for stretches with no history, in m/s
+DEFAULT_SPEED = 20 / 3.6
+MIN_SPEED = 1.0
+
+# Time spent at each intermediate stop
+DWELL_SECONDS = 20
+
+# A stretch/hour needs this many observations before it is trusted
+MIN_SAMPLES = 3
+
+# Consecutive fixes further apart than this are not used for learning
+MAX_FIX_GAP = 120
+
+LEARN_CHUNK = 50_000
+
+# Predictions expire if the bus stops reporting
+PREDICTION_TTL = 120
+
+# How early a bus waiting for its next trip starts getting predictions
+TRIP_LOOKAHEAD = timedelta(minutes=30)
+TRIP_GRACE = timedelta(minutes=15)
+# Cached trips are reloaded after this long so edits made through other
+# worker processes are picked up
+TRIP_MAX_AGE = timedelta(minutes=5)
+NO_TRIP_RETRY = timedelta(minutes=1)
+
+PROFILE_VERSION_KEY = 'eta:profile-version'
+PREDICTION_KEY = 'eta:bus:{}'
+
+
+def _hours(epochs):
+    # Hour of the day in the configured time zone
+    offset = timezone.localtime(timezone.now()).utcoffset().total_seconds()
+    return ((np.asarray(epochs) + offset) // 3600 % 24).astype(np.intp)
+
+
+def _segments(geometry):
+    return max(1, math.ceil(geometry.length / SEGMENT_METERS))
+
+
+class SpeedProfiles:
+    """Per-route cumulative travel-time curves, built from SegmentSpeed rows."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.version = None
+
+    def invalidate(self):
+        with self.lock:
+            self.routes.clear()
+        cache.add(PROFILE_VERSION_KEY, 0, None)
+        try:
+            cache.incr(PROFILE_VERSION_KEY)
+        except ValueError:
+            pass
+
+    def _build(self, geometry):
+        n = _segments(geometry)
+        known = np.zeros((24, n))
+        weights = np.zeros((24, n))
+        rows = SegmentSpeed.objects.filter(
+            route_id=geometry.route_id, segment__lt=n
+        ).values_list('segment', 'hour', 'speed', 'samples')
+        for segment, hour, speed, count in rows:
+            if count >= MIN_SAMPLES and speed > 0:
+                known[hour, segment] = speed
+                weights[hour, segment] = count
+
+        # Fall back to the stretch's all-day speed, then the route's, then a default
+        weighted = known * weights
+        route_speed = weighted.sum() / weights.sum() if weights.sum() else DEFAULT_SPEED
+        day_weights = weights.sum(axis=0)
+        day_speed = np.where(
+            day_weights > 0, weighted.sum(axis=0) / np.maximum(day_weights, 1), route_speed
+        )
+        speeds = np.where(weights > 0, known, day_speed[None, :])
+        speeds = np.maximum(speeds, MIN_SPEED)
+
+        edges = np.minimum(np.arange(n + 1) * SEGMENT_METERS, geometry.length).astype(np.float64)
+        edges[-1] = geometry.length
+        cumulative = np.concatenate(
+            (np.zeros((24, 1)), np.cumsum(np.diff(edges)[None, :] / speeds, axis=1)), axis=1
+        )
+        return geometry, edges, cumulative
+
+    def get(self, geometry):
+        version = cache.get(PROFILE_VERSION_KEY, 0)
+        with self.lock:
+            if version != self.version:
+                self.routes.clear()
+                self.version = version
+            profile = self.routes.get(geometry.route_id)
+        # Rebuild when the route's geometry was replaced
+        if profile is None or profile[0] is not geometry:
+            profile = self._build(geometry)
+            with self.lock:
+                self.routes[geometry.route_id] = profile
+        return profile
+
+    def travel_times(self, geometry, hour, start, ends):
+        """Seconds from distance `start` to each of `ends` along the route."""
+        _, edges, cumulative = self.get(geometry)
+        curve = cumulative[hour]
+        return np.interp(ends, edges, curve) - np.interp(start, edges, curve)
+
+
+speed_profiles = SpeedProfiles()
+
+
+def learn_speed_profiles(since, log=None):
+    """
+    Rebuild SegmentSpeed from location history newer than `since`. Speeds
+    are distance made good along the route over time between consecutive
+    fixes, so stops and congestion are included. Returns rows written.
+    """
+    buses = list(Bus.objects.filter(route__isnull=False).values_list('id', 'route_id'))
+    route_geometries = geometries.get_many({route_id for _, route_id in buses})
+
+    # route_id -> (metres, seconds, samples), each shaped (24, segments)
+    totals = {}
+    for bus_id, route_id in buses:
+        geometry = route_geometries.get(route_id)
+        if geometry is None:
+            continue
+        n = _segments(geometry)
+        if route_id not in totals:
+            totals[route_id] = (np.zeros((24, n)), np.zeros((24, n)), np.zeros((24, n)))
+        metres, seconds, samples = totals[route_id]
+
+        rows = BusLocationHistory.objects.filter(
+            bus_id=bus_id, timestamp__gte=since
+        ).order_by('timestamp').values_list('timestamp', 'lat_e6', 'lon_e6')
+
+        carry = []
+        chunk = []
+        for row in rows.iterator(chunk_size=LEARN_CHUNK):
+            chunk.append((row[0].timestamp(), row[1] / 1e6, row[2] / 1e6))
+            if len(chunk) >= LEARN_CHUNK:
+                carry = _accumulate(geometry, carry + chunk, metres, seconds, samples)
+                chunk = []
+        if chunk:
+            _accumulate(geometry, carry + chunk, metres, seconds, samples)
+
+    written = 0
+    for route_id, (metres, seconds, samples) in totals.items():
+        hours, segments = np.nonzero(samples)
+        rows = [
+            SegmentSpeed(
+                route_id=route_id,
+                segment=int(segment),
+                hour=int(hour),
+                speed=float(metres[hour, segment] / seconds[hour, segment]),
+                samples=int(samples[hour, segment]),
+            )
+            for hour, segment in zip(hours, segments)
+        ]
+        with transaction.atomic():
+            SegmentSpeed.objects.filter(route_id=route_id).delete()
+            SegmentSpeed.objects.bulk_create(rows, batch_size=2000)
+        written += len(rows)
+        if log:
+            log(f"Route {route_id}: {len(rows)} segment/hour speeds")
+
+    transaction.on_commit(speed_profiles.invalidate)
+    return written
+
+
+def _accumulate(geometry, points, metres, seconds, samples):
+    """Add the moves between consecutive fixes to the totals; returns the last fix."""
+    if len(points) < 2:
+        return points[-1:]
+    t, lats, lons = (np.asarray(c) for c in zip(*points))
+    distance, offset, _ = geometry.snap(lats, lons)
+
+    dt = np.diff(t)
+    dd = np.diff(distance)
+    on_route = offset <= OFF_ROUTE_METERS
+    usable = (dt > 0) & (dt <= MAX_FIX_GAP) & (dd >= 0) & on_route[1:] & on_route[:-1]
+
+    middle = (distance[1:] + distance[:-1]) / 2
+    segment = np.clip((middle // SEGMENT_METERS).astype(np.intp), 0, metres.shape[1] - 1)
+    hour = _hours(t[1:])
+    index = (hour[usable], segment[usable])
+    np.add.at(metres, index, dd[usable])
+    np.add.at(seconds, index, dt[usable])
+    np.add.at(samples, index, 1)
+    return points[-1:]
+
+
+class Trip:
+    __slots__ = ('schedule_id', 'departure', 'expires', 'geometry', 'orders', 'station_ids', 'distances')
+
+
+class EtaEngine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # bus_id -> Trip, or the time to look again when the bus has no trip
+        self.trips = {}
+
+    def invalidate(self, schedule_id=None, bus_id=None):
+        with self.lock:
+            if bus_id is not None:
+                self.trips.pop(bus_id, None)
+            if schedule_id is not None:
+                for key, trip in list(self.trips.items()):
+                    if isinstance(trip, Trip) and trip.schedule_id == schedule_id:
+                        del self.trips[key]
+
+    def _load_trips(self, bus_routes, now):
+        schedules = {}
+        rows = Schedule.objects.filter(
+            bus_id__in=list(bus_routes),
+            is_active=True,
+            arrival_time__gte=now,
+            departure_time__lte=now + TRIP_LOOKAHEAD,
+        ).order_by('bus_id', 'departure_time').values_list('id', 'bus_id', 'departure_time', 'arrival_time')
+        for schedule_id, bus_id, departure, arrival in rows:
+            # The trip under way, or else the next one
+            schedules.setdefault(bus_id, (schedule_id, departure, arrival))
+
+        stops = defaultdict(list)
+        stop_rows = StationSchedule.objects.filter(
+            schedule_id__in=[s[0] for s in schedules.values()]
+        ).select_related('station').order_by('schedule_id', 'order')
+        for stop in stop_rows:
+            stops[stop.schedule_id].append(stop)
+        route_geometries = geometries.get_many(set(bus_routes.values()))
+
+        trips = {}
+        for bus_id, route_id in bus_routes.items():
+            geometry = route_geometries.get(route_id)
+            schedule = schedules.get(bus_id)
+            if geometry is None or schedule is None or not stops[schedule[0]]:
+                trips[bus_id] = now + NO_TRIP_RETRY
+                continue
+            schedule_stops = stops[schedule[0]]
+            trip = Trip()
+            trip.schedule_id = schedule[0]
+            trip.departure = schedule[1].timestamp()
+            trip.expires = min(schedule[2] + TRIP_GRACE, now + TRIP_MAX_AGE)
+            trip.geometry = geometry
+            trip.orders = [s.order for s in schedule_stops]
+            trip.station_ids = [s.station_id for s in schedule_stops]
+            trip.distances = stop_distances(geometry, schedule_stops)
+            trips[bus_id] = trip
+        return trips
+
+    def _current_trips(self, bus_routes, now):
+        result = {}
+        missing = {}
+        with self.lock:
+            for bus_id, route_id in bus_routes.items():
+                trip = self.trips.get(bus_id)
+                if isinstance(trip, Trip):
+                    if trip.expires > now and trip.geometry.route_id == route_id:
+                        result[bus_id] = trip
+                        continue
+                elif trip is not None and trip > now:
+                    continue
+                missing[bus_id] = route_id
+
+        if missing:
+            loaded = self._load_trips(missing, now)
+            with self.lock:
+                self.trips.update(loaded)
+            result.update((k, v) for k, v in loaded.items() if isinstance(v, Trip))
+        return result
+
+    def _predict(self, trip, distance, offset, fix_time):
+        i = int(np.searchsorted(trip.distances, distance, side='right'))
+        if i >= len(trip.orders):
+            # Past the last stop; look for the next trip on the next fix
+            trip.expires = timezone.now()
+            return None
+
+        remaining = trip.distances[i:]
+        # A bus waiting at the terminus leaves at its scheduled time
+        start = max(fix_time, trip.departure)
+        hour = int(_hours([start])[0])
+        travel = speed_profiles.travel_times(trip.geometry, hour, distance, remaining)
+        arrivals = start + travel + DWELL_SECONDS * np.arange(len(remaining))
+        return {
+            'schedule_id': trip.schedule_id,
+            'updated_at': fix_time,
+            'off_route': offset > OFF_ROUTE_METERS,
+            'stops': [
+                (trip.orders[i + k], trip.station_ids[i + k], float(arrival))
+                for k, arrival in enumerate(arrivals)
+            ],
+        }
+
+    def update(self, positions):
+        """
+        Recompute predictions from fresh fixes. positions is a list of
+        (bus_id, route_id, lat, lon, timestamp) with at most one entry per bus.
+        """
+        now = timezone.now()
+        positions = [p for p in positions if p[1] is not None]
+        trips = self._current_trips({p[0]: p[1] for p in positions}, now)
+        fix_times = {p[0]: p[4].timestamp() for p in positions}
+
+        snapped = snap_positions([p[:4] for p in positions if p[0] in trips])
+        predictions = {}
+        for bus_id, (distance, offset, geometry) in snapped.items():
+            trip = trips[bus_id]
+            if geometry is not trip.geometry:
+                # The route was edited since the trip was cached
+                self.invalidate(bus_id=bus_id)
+                continue
+            prediction = self._predict(trip, distance, offset, fix_times[bus_id])
+            if prediction is not None:
+                predictions[PREDICTION_KEY.format(bus_id)] = prediction
+        if predictions:
+            cache.set_many(predictions, PREDICTION_TTL)
+
+    def predictions(self, bus_ids):
+        """Return {bus_id: prediction} for buses with a live prediction."""
+        keys = {PREDICTION_KEY.format(bus_id): bus_id for bus_id in bus_ids}
+        return {keys[k]: v for k, v in cache.get_many(list(keys)).items()}
+
+
+eta_engine = EtaEngine()
+
+
+def predicted_times(prediction, schedule_id):
+    """Map stop order -> predicted arrival datetime for one schedule's prediction."""
+    if not prediction or prediction['schedule_id'] != schedule_id:
+        return {}
+    return {
+        order: datetime.fromtimestamp(arrival, tz=dt_timezone.utc)
+        for order, _, arrival in prediction['stops']
+    }
@@ -0,0 +1,128 @@
+"""
+Fleet status for the admin dashboard.
+
+build_fleet_status() computes the status of every active bus in a fixed
+number of queries: buses with their location joined and their current or
+next schedule picked by correlated subqueries, then the chosen schedules and
+their stops in one query each. fleet_snapshot() shares the result between
+all admins through the cache for a few seconds; while one request rebuilds
+an expired snapshot, the others keep serving the previous one.
+"""
+import time
+
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .geometry import snap_positions, progress_data
+from .models import Bus, BusLocation, Schedule
+from .search import load_stops
+
+SNAPSHOT_KEY = 'admin:fleet-status'
+SNAPSHOT_LOCK_KEY = 'admin:fleet-status:lock'
+
+# How long a snapshot is served before it is rebuilt
+SNAPSHOT_MAX_AGE = 5
+
+# Stale snapshots are kept this long to serve while a rebuild runs
+SNAPSHOT_TTL = 60
+SNAPSHOT_LOCK_TTL = 30
+
+
+def build_fleet_status(now=None):
+    now = now or timezone.now()
+
+    current = Schedule.objects.filter(
+        bus=OuterRef('pk'),
+        is_active=True,
+        departure_time__lte=now,
+        arrival_time__gte=now
+    ).order_by('departure_time').values('id')[:1]
+    upcoming = Schedule.objects.filter(
+        bus=OuterRef('pk'),
+        is_active=True,
+        departure_time__gt=now
+    ).order_by('departure_time').values('id')[:1]
+
+    buses = list(Bus.objects.filter(is_active=True).select_related('location').annotate(
+        schedule_id=Coalesce(Subquery(current), Subquery(upcoming))
+    ).order_by('id'))
+
+    schedule_ids = [bus.schedule_id for bus in buses if bus.schedule_id]
+    schedules = Schedule.objects.select_related('start_station', 'end_station').in_bulk(schedule_ids)
+    stops = load_stops(schedule_ids)
+
+    data = []
+    positions = []
+    for bus in buses:
+        try:
+            location = bus.location
+        except BusLocation.DoesNotExist:
+            location = None
+
+        schedule = schedules.get(bus.schedule_id)
+        data.append({
+            'id': bus.id,
+            'number': bus.number,
+            'type': bus.type,
+            'route_id': bus.route_id,
+            'location': {
+                'latitude': location.latitude,
+                'longitude': location.longitude,
+                'updated_at': location.timestamp
+            } if location else None,
+            'current_schedule': {
+                'id': schedule.id,
+                'start_station': schedule.start_station.name,
+                'end_station': schedule.end_station.name,
+                'departure_time': schedule.departure_time,
+                'arrival_time': schedule.arrival_time
+            } if schedule else None,
+            'progress': None
+        })
+        if location and bus.route_id:
+            positions.append((len(data) - 1, bus.route_id, location.latitude, location.longitude))
+
+    # Snap every located bus onto its route in one pass per route
+    for index, (distance, offset, geometry) in snap_positions(positions).items():
+        schedule_id = buses[index].schedule_id
+        data[index]['progress'] = progress_data(
+            distance, offset, geometry, stops=stops.get(schedule_id)
+        )
+
+    return data
+
+
+def fleet_snapshot():
+    """Return the shared fleet status, rebuilding it at most every SNAPSHOT_MAX_AGE seconds."""
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot and time.time() - snapshot['built_at'] < SNAPSHOT_MAX_AGE:
+        return snapshot['data']
+
+    # Only one request rebuilds; the rest serve the stale copy if there is one
+    locked = cache.add(SNAPSHOT_LOCK_KEY, 1, SNAPSHOT_LOCK_TTL)
+    if snapshot and not locked:
+        return snapshot['data']
+
+    try:
+        data = build_fleet_status()
+        cache.set(SNAPSHOT_KEY, {'built_at': time.time(), 'data': data}, SNAPSHOT_TTL)
+    finally:
+        if locked:
+            cache.delete(SNAPSHOT_LOCK_KEY)
+    return data
+
+
+def filter_fleet(data, route_id=None, bbox=None):
+    if route_id is not None:
+        data = [bus for bus in data if bus['route_id'] == route_id]
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        data = [
+            bus for bus in data
+            if bus['location']
+            and min_lat <= bus['location']['latitude'] <= max_lat
+            and min_lon <= bus['location']['longitude'] <= max_lon
+        ]
+    return data
@@ -0,0 +1,87 @@
+"""
+In-memory grid index over Station coordinates.
+
+Stations are bucketed into fixed-size lat/lon cells. A radius query only
+looks at the handful of cells that overlap the search circle and runs the
+haversine check on those candidates. The index is rebuilt lazily after a
+station is saved or deleted.
+"""
+import math
+import threading
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from .models import Station
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Roughly 1.1 km north-south
+CELL_DEGREES = 0.01
+
+VERSION_KEY = 'geo:station-index-version'
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _cell(lat, lon):
+    return (math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES))
+
+
+class StationIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cells = None
+        self.version = None
+
+    def invalidate(self):
+        with self.lock:
+            self.cells = None
+        # Tell other worker processes to rebuild as well
+        cache.add(VERSION_KEY, 0, None)
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            pass
+
+    def _build(self):
+        cells = defaultdict(list)
+        for station_id, name, lat, lon in Station.objects.values_list('id', 'name', 'latitude', 'longitude'):
+            cells[_cell(lat, lon)].append((station_id, name, lat, lon))
+        return dict(cells)
+
+    def _get_cells(self):
+        version = cache.get(VERSION_KEY, 0)
+        with self.lock:
+            if self.cells is None or version != self.version:
+                self.cells = self._build()
+                self.version = version
+            return self.cells
+
+    def nearby(self, lat, lon, radius_km):
+        """Return [(distance_km, id, name, lat, lon)] within radius_km, nearest first."""
+        cells = self._get_cells()
+
+        lat_span = radius_km / 111.32
+        # Longitude degrees shrink towards the poles
+        lon_span = radius_km / max(111.32 * math.cos(math.radians(lat)), 1e-6)
+        min_cell = _cell(lat - lat_span, lon - lon_span)
+        max_cell = _cell(lat + lat_span, lon + lon_span)
+
+        found = []
+        for cell_lat in range(min_cell[0], max_cell[0] + 1):
+            for cell_lon in range(min_cell[1], max_cell[1] + 1):
+                for station_id, name, s_lat, s_lon in cells.get((cell_lat, cell_lon), ()):
+                    distance = haversine_km(lat, lon, s_lat, s_lon)
+                    if distance <= radius_km:
+                        found.append((distance, station_id, name, s_lat, s_lon))
+        found.sort()
+        return found
+
+
+station_index = StationIndex()
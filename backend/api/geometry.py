@@ -0,0 +1,213 @@
+"""
+Route polylines as NumPy arrays, and vectorised map-matching onto them.
+
+Each route's RoutePoints are projected once into a local flat x/y frame in
+metres and kept as segment start points, unit directions, lengths and the
+cumulative distance at each vertex. Snapping a batch of positions is then a
+single broadcast over (points x segments): project every point onto every
+segment, keep the nearest segment per point.
+"""
+import math
+import threading
+from collections import defaultdict
+
+import numpy as np
+from django.core.cache import cache
+
+from .models import RoutePoint
+
+EARTH_RADIUS_M = 6371008.8
+
+# Positions further than this from the polyline are reported off route
+OFF_ROUTE_METERS = 75
+
+# Bounds the (points x segments) working arrays
+SNAP_CHUNK_CELLS = 2_000_000
+
+VERSION_KEY = 'geometry:route-version'
+
+
+class RouteGeometry:
+    def __init__(self, route_id, lats, lons):
+        self.route_id = route_id
+        self.lat0 = float(lats[0])
+        self.lon0 = float(lons[0])
+        self.cos_lat0 = math.cos(math.radians(self.lat0))
+
+        xy = self.project(lats, lons)
+        starts = xy[:-1]
+        deltas = xy[1:] - starts
+        lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+        # Zero-length segments (repeated points) keep a zero direction
+        safe = np.where(lengths > 0, lengths, 1.0)
+
+        self.seg_start = starts
+        self.seg_dir = deltas / safe[:, None]
+        self.seg_len = lengths
+        self.cum_dist = np.concatenate(([0.0], np.cumsum(lengths)))
+        self.length = float(self.cum_dist[-1])
+
+    def project(self, lats, lons):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        x = np.radians(lons - self.lon0) * self.cos_lat0 * EARTH_RADIUS_M
+        y = np.radians(lats - self.lat0) * EARTH_RADIUS_M
+        return np.column_stack((x, y))
+
+    def snap(self, lats, lons):
+        """
+        Snap positions onto the polyline. Returns (distance_along, offset,
+        segment) arrays: metres from the first RoutePoint, metres from the
+        line, and the index of the matched segment.
+        """
+        points = self.project(lats, lons)
+        n = len(points)
+        distance = np.empty(n)
+        offset = np.empty(n)
+        segment = np.empty(n, dtype=np.intp)
+
+        step = max(1, SNAP_CHUNK_CELLS // max(len(self.seg_len), 1))
+        for lo in range(0, n, step):
+            chunk = points[lo:lo + step]
+            # (chunk, segments, 2): vector from each segment start to each point
+            rel = chunk[:, None, :] - self.seg_start[None, :, :]
+            t = np.einsum('psk,sk->ps', rel, self.seg_dir)
+            np.clip(t, 0.0, self.seg_len[None, :], out=t)
+            nearest = self.seg_start[None, :, :] + t[:, :, None] * self.seg_dir[None, :, :]
+            d2 = np.sum((chunk[:, None, :] - nearest) ** 2, axis=2)
+
+            best = np.argmin(d2, axis=1)
+            rows = np.arange(len(chunk))
+            segment[lo:lo + step] = best
+            offset[lo:lo + step] = np.sqrt(d2[rows, best])
+            distance[lo:lo + step] = self.cum_dist[best] + t[rows, best]
+
+        return distance, offset, segment
+
+
+class GeometryCache:
+    """Process-wide RouteGeometry cache, cleared when any RoutePoint changes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.version = None
+
+    def invalidate(self, route_id=None):
+        with self.lock:
+            if route_id is None:
+                self.routes.clear()
+            else:
+                self.routes.pop(route_id, None)
+        cache.add(VERSION_KEY, 0, None)
+        try:
+            version = cache.incr(VERSION_KEY)
+        except ValueError:
+            return
+        with self.lock:
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def get_many(self, route_ids):
+        """Return {route_id: RouteGeometry} loading any missing routes in one query."""
+        version = cache.get(VERSION_KEY, 0)
+        with self.lock:
+            if version != self.version:
+                self.routes.clear()
+                self.version = version
+            missing = [r for r in set(route_ids) if r is not None and r not in self.routes]
+
+        if missing:
+            points = defaultdict(list)
+            rows = RoutePoint.objects.filter(route_id__in=missing).order_by(
+                'route_id', 'order'
+            ).values_list('route_id', 'latitude', 'longitude')
+            for route_id, lat, lon in rows:
+                points[route_id].append((lat, lon))
+
+            loaded = {}
+            for route_id in missing:
+                coords = points.get(route_id)
+                # Routes with fewer than two points have no geometry
+                if coords and len(coords) >= 2:
+                    lats, lons = zip(*coords)
+                    loaded[route_id] = RouteGeometry(route_id, lats, lons)
+                else:
+                    loaded[route_id] = None
+            with self.lock:
+                self.routes.update(loaded)
+
+        with self.lock:
+            return {r: self.routes.get(r) for r in route_ids if r is not None}
+
+    def get(self, route_id):
+        return self.get_many([route_id]).get(route_id)
+
+
+geometries = GeometryCache()
+
+
+def snap_positions(positions):
+    """
+    Snap many buses at once. positions is a list of (key, route_id, lat, lon);
+    returns {key: (distance_along, offset, geometry)} for buses whose route
+    has a geometry. One vectorised pass per distinct route.
+    """
+    by_route = defaultdict(list)
+    for key, route_id, lat, lon in positions:
+        by_route[route_id].append((key, lat, lon))
+
+    route_geometries = geometries.get_many(list(by_route))
+    result = {}
+    for route_id, items in by_route.items():
+        geometry = route_geometries.get(route_id)
+        if geometry is None:
+            continue
+        keys, lats, lons = zip(*items)
+        distance, offset, _ = geometry.snap(lats, lons)
+        for i, key in enumerate(keys):
+            result[key] = (float(distance[i]), float(offset[i]), geometry)
+    return result
+
+
+def stop_distances(geometry, stops):
+    """Distance along the route of each stop (objects with .station), in schedule order."""
+    distance, _, _ = geometry.snap(
+        [s.station.latitude for s in stops],
+        [s.station.longitude for s in stops],
+    )
+    # Stops are in schedule order, so their positions along the route only grow
+    return np.maximum.accumulate(distance)
+
+
+def next_stop(geometry, distance_along, stops):
+    """
+    Given a schedule's stops (objects with .station), return (stop, metres to
+    go) for the first stop beyond distance_along, or None past the last one.
+    """
+    if not stops:
+        return None
+    distances = stop_distances(geometry, stops)
+    i = int(np.searchsorted(distances, distance_along, side='right'))
+    if i >= len(stops):
+        return None
+    return stops[i], float(distances[i] - distance_along)
+
+
+def progress_data(distance_along, offset, geometry, stops=None):
+    data = {
+        'distance_along': round(distance_along, 1),
+        'route_length': round(geometry.length, 1),
+        'offset': round(offset, 1),
+        'off_route': offset > OFF_ROUTE_METERS,
+        'next_stop': None
+    }
+    upcoming = next_stop(geometry, distance_along, stops)
+    if upcoming is not None:
+        stop, remaining = upcoming
+        data['next_stop'] = {
+            'id': stop.station.id,
+            'name': stop.station.name,
+            'distance': round(remaining, 1)
+        }
+    return data
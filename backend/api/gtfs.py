@@ -0,0 +1,536 @@
+"""
+Stream GTFS feeds into and out of the timetable models.
+
+GTFS describes service patterns: a trip runs on every date its service_id is
+active in calendar.txt / calendar_dates.txt. Schedule rows are dated trips,
+so the importer expands each trip over a date window. Buses are not part of
+GTFS; each route and block_id gets one Bus.
+
+The importer reads each file in the zip row by row and never holds
+stop_times.txt in memory. It needs stop_times.txt grouped by trip_id, which
+is how feeds are published. Stops, routes and trips are kept as id maps. Of
+shapes.txt only the one shape kept per route is buffered. Schedules and stop
+times are flushed every BATCH_SIZE rows. Bulk writes skip model signals, so
+the caches and dashboard counters are refreshed once at the end.
+
+The exporter writes the dated schedules back out as one trip per schedule,
+each with a single-date service in calendar_dates.txt. It reads every table
+with server-side iterators.
+"""
+import csv
+import io
+import zipfile
+from collections import Counter, defaultdict
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import counters, polyline, response_cache
+from .eta import eta_engine
+from .geo import station_index
+from .geometry import geometries
+from .journeys import planner
+from .models import Booking, Bus, Route, RoutePoint, Schedule, Station, StationSchedule
+from .schedule_templates import delete_rows, delete_schedules, insert_stop_times
+
+BATCH_SIZE = 5000
+PROGRESS_EVERY = 100000
+ITERATOR_CHUNK = 10000
+
+# route_type for bus in GTFS
+ROUTE_TYPE_BUS = 3
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+class GtfsError(ValueError):
+    pass
+
+
+class FeedTooLarge(GtfsError):
+    pass
+
+
+class _Row(dict):
+    """A CSV row that reports a missing or malformed field with its file and line."""
+
+    def __init__(self, values, name, line):
+        super().__init__(values)
+        self.where = f"{name} line {line}"
+
+    def __missing__(self, key):
+        raise GtfsError(f"{self.where}: no {key}")
+
+    def parse(self, key, convert):
+        value = self[key]
+        try:
+            return convert(value)
+        except GtfsError as e:
+            raise GtfsError(f"{self.where}: {e}")
+        except (TypeError, ValueError):
+            raise GtfsError(f"{self.where}: invalid {key} {value!r}")
+
+
+def _rows(feed, name, required=True):
+    try:
+        info = feed.getinfo(name)
+    except KeyError:
+        if required:
+            raise GtfsError(f"{name} is missing from the feed")
+        return
+    with feed.open(info) as raw:
+        reader = csv.DictReader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+        try:
+            for values in reader:
+                yield _Row(values, name, reader.line_num)
+        # The DictReader's line_num only moves on rows it returns
+        except UnicodeDecodeError:
+            raise GtfsError(f"{name} is not UTF-8 (after line {reader.reader.line_num})")
+        except csv.Error as e:
+            raise GtfsError(f"{name} line {reader.reader.line_num}: {e}")
+        except zipfile.BadZipFile as e:
+            raise GtfsError(f"{name} is damaged: {e}")
+
+
+def parse_time(value):
+    """GTFS HH:MM:SS (hours may pass 24) to seconds after the service day starts."""
+    if not value:
+        return None
+    try:
+        hours, minutes, seconds = value.strip().split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    except ValueError:
+        raise GtfsError(f"Invalid time {value!r}")
+
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value.strip(), '%Y%m%d').date()
+    except ValueError:
+        raise GtfsError(f"Invalid date {value!r}")
+
+
+def service_dates(feed, start_date, end_date):
+    """{service_id: [dates]} for services active in [start_date, end_date)."""
+    dates = defaultdict(set)
+    for row in _rows(feed, 'calendar.txt', required=False):
+        first = max(row.parse('start_date', parse_date), start_date)
+        last = min(row.parse('end_date', parse_date), end_date - timedelta(days=1))
+        runs = [row[day] == '1' for day in WEEKDAYS]
+        day = first
+        while day <= last:
+            if runs[day.weekday()]:
+                dates[row['service_id']].add(day)
+            day += timedelta(days=1)
+    for row in _rows(feed, 'calendar_dates.txt', required=False):
+        day = row.parse('date', parse_date)
+        if not start_date <= day < end_date:
+            continue
+        if row['exception_type'] == '1':
+            dates[row['service_id']].add(day)
+        else:
+            dates[row['service_id']].discard(day)
+    return {service_id: sorted(days) for service_id, days in dates.items() if days}
+
+
+class Importer:
+    def __init__(self, feed, start_date, days=7, bus_capacity=50, log=None):
+        self.feed = feed
+        self.start_date = start_date
+        self.end_date = start_date + timedelta(days=days)
+        self.bus_capacity = bus_capacity
+        self.log = log or (lambda message: None)
+        self.stations = {}
+        self.routes = {}
+        self.trips = {}
+        self.counts = Counter()
+
+    @transaction.atomic
+    def run(self):
+        self.tz = self._timezone()
+        self.services = service_dates(self.feed, self.start_date, self.end_date)
+        self._import_stops()
+        self._import_routes()
+        self._import_trips()
+        self._import_shapes()
+        self._import_stop_times()
+
+        route_ids = list(self.routes.values())
+        bus_ids = set(self.buses.values())
+
+        def notify():
+            station_index.invalidate()
+            response_cache.bump(Station, Route, RoutePoint)
+            for route_id in route_ids:
+                geometries.invalidate(route_id)
+            planner.invalidate_all()
+            for bus_id in bus_ids:
+                eta_engine.invalidate(bus_id=bus_id)
+        transaction.on_commit(notify)
+        counters.reconcile()
+        return dict(self.counts)
+
+    def _timezone(self):
+        for row in _rows(self.feed, 'agency.txt', required=False):
+            try:
+                return ZoneInfo(row['agency_timezone'])
+            except (KeyError, ZoneInfoNotFoundError):
+                break
+        return timezone.get_current_timezone()
+
+    def _import_stops(self):
+        existing = dict(Station.objects.filter(gtfs_id__isnull=False).values_list('gtfs_id', 'id'))
+        new, changed = [], []
+        for row in _rows(self.feed, 'stops.txt'):
+            # Only boarding points; stations, entrances and nodes have no buses
+            if row.get('location_type') not in (None, '', '0'):
+                continue
+            fields = {
+                'name': (row['stop_name'] or '')[:100],
+                'address': row.get('stop_desc') or '',
+                'latitude': row.parse('stop_lat', float),
+                'longitude': row.parse('stop_lon', float),
+            }
+            if row['stop_id'] in existing:
+                changed.append(Station(id=existing[row['stop_id']], **fields))
+            else:
+                new.append(Station(gtfs_id=row['stop_id'], capacity=0, **fields))
+
+        Station.objects.bulk_update(changed, ['name', 'address', 'latitude', 'longitude'], batch_size=BATCH_SIZE)
+        Station.objects.bulk_create(new, batch_size=BATCH_SIZE)
+        self.stations = {**existing, **{station.gtfs_id: station.id for station in new}}
+        self.counts['stops'] = len(new) + len(changed)
+        self.log(f"stops: {len(new)} new, {len(changed)} updated")
+
+    def _import_routes(self):
+        existing = dict(Route.objects.filter(gtfs_id__isnull=False).values_list('gtfs_id', 'id'))
+        new, changed = [], []
+        self.route_names = {}
+        for row in _rows(self.feed, 'routes.txt'):
+            name = (row.get('route_short_name') or row.get('route_long_name') or row['route_id'])[:100]
+            fields = {'name': name, 'description': row.get('route_long_name') or row.get('route_desc') or None}
+            self.route_names[row['route_id']] = name
+            if row['route_id'] in existing:
+                changed.append(Route(id=existing[row['route_id']], **fields))
+            else:
+                new.append(Route(gtfs_id=row['route_id'], **fields))
+
+        Route.objects.bulk_update(changed, ['name', 'description'], batch_size=BATCH_SIZE)
+        Route.objects.bulk_create(new, batch_size=BATCH_SIZE)
+        self.routes = {**existing, **{route.gtfs_id: route.id for route in new}}
+        self.counts['routes'] = len(new) + len(changed)
+        self.log(f"routes: {len(new)} new, {len(changed)} updated")
+
+    def _import_trips(self):
+        self.buses = dict(Bus.objects.filter(gtfs_id__isnull=False).values_list('gtfs_id', 'id'))
+        numbers = set(Bus.objects.values_list('number', flat=True))
+        new_buses = {}
+        self.shape_use = defaultdict(Counter)
+        n = 0
+        for row in _rows(self.feed, 'trips.txt'):
+            route_id = self.routes.get(row['route_id'])
+            if route_id is None:
+                raise GtfsError(f"{row.where}: trip {row['trip_id']!r} is on unknown route {row['route_id']!r}")
+            n += 1
+            if row['service_id'] not in self.services:
+                # Does not run inside the import window
+                continue
+            block = row.get('block_id') or ''
+            bus_key = f"{row['route_id']}/{block}"[:200]
+            if bus_key not in self.buses and bus_key not in new_buses:
+                number = (block or self.route_names[row['route_id']])[:16]
+                suffix = 1
+                candidate = number
+                while candidate in numbers:
+                    suffix += 1
+                    candidate = f"{number}-{suffix}"[-20:]
+                numbers.add(candidate)
+                new_buses[bus_key] = Bus(number=candidate, capacity=self.bus_capacity, route_id=route_id,
+                                         gtfs_id=bus_key)
+            self.trips[row['trip_id']] = (route_id, bus_key, row['service_id'])
+            if row.get('shape_id'):
+                self.shape_use[row['route_id']][row['shape_id']] += 1
+
+        Bus.objects.bulk_create(new_buses.values(), batch_size=BATCH_SIZE)
+        self.buses.update((key, bus.id) for key, bus in new_buses.items())
+        self.counts['trips'] = len(self.trips)
+        self.log(f"trips: {n} in feed, {len(self.trips)} run between {self.start_date} and {self.end_date}; "
+                 f"{len(new_buses)} buses created")
+
+    def _import_shapes(self):
+        # One shape per route: the one most of its trips follow
+        chosen = {
+            uses.most_common(1)[0][0]: self.routes[route_gtfs_id]
+            for route_gtfs_id, uses in self.shape_use.items()
+        }
+        if not chosen:
+            return
+        points = defaultdict(list)
+        for row in _rows(self.feed, 'shapes.txt', required=False):
+            if row['shape_id'] in chosen:
+                points[row['shape_id']].append((
+                    row.parse('shape_pt_sequence', int), row.parse('shape_pt_lat', float),
+                    row.parse('shape_pt_lon', float),
+                ))
+
+        route_ids = [chosen[shape_id] for shape_id in points]
+        delete_rows(RoutePoint, 'route_id', route_ids)
+        rows = [
+            RoutePoint(route_id=chosen[shape_id], latitude=lat, longitude=lon, order=order)
+            for shape_id, shape in points.items()
+            for order, (_, lat, lon) in enumerate(sorted(shape))
+        ]
+        RoutePoint.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+        for route_id in route_ids:
+            polyline.rebuild(route_id)
+        self.counts['shape_points'] = len(rows)
+        self.log(f"shapes: {len(rows)} points on {len(route_ids)} routes")
+
+    def _replace_window(self):
+        """Drop earlier imports in the window, except trips people have booked."""
+        imported = Schedule.objects.filter(
+            gtfs_trip_id__isnull=False, service_date__gte=self.start_date, service_date__lt=self.end_date
+        )
+        self.kept = set(
+            Booking.objects.filter(schedule__in=imported).values_list(
+                'schedule__gtfs_trip_id', 'schedule__service_date'
+            ).distinct()
+        )
+        deleted, _ = delete_schedules(imported.exclude(
+            id__in=Booking.objects.filter(schedule__in=imported).values('schedule_id')
+        ))
+        self.counts['replaced_schedules'] = len(deleted)
+
+    def _import_stop_times(self):
+        self._replace_window()
+        self.pending_schedules = []
+        self.pending_stops = []
+        done = set()
+        trip_id, stops = None, []
+        n = 0
+        for row in _rows(self.feed, 'stop_times.txt'):
+            if row['trip_id'] != trip_id:
+                if trip_id is not None:
+                    self._add_trip(trip_id, stops)
+                    done.add(trip_id)
+                trip_id, stops = row['trip_id'], []
+                if trip_id in done:
+                    raise GtfsError(f"{row.where}: stop_times.txt must be grouped by trip_id")
+            stops.append((
+                row.parse('stop_sequence', int), row['stop_id'],
+                row.parse('arrival_time', parse_time) if row.get('arrival_time') else None,
+                row.parse('departure_time', parse_time) if row.get('departure_time') else None,
+            ))
+            n += 1
+            if n % PROGRESS_EVERY == 0:
+                self.log(f"stop_times: {n:,} rows read, {self.counts['schedules']:,} schedules written")
+        if trip_id is not None:
+            self._add_trip(trip_id, stops)
+        self._flush()
+        self.counts['stop_time_rows'] = n
+        self.log(f"stop_times: {n:,} rows read, {self.counts['schedules']:,} schedules and "
+                 f"{self.counts['stop_times']:,} stop times written")
+
+    def _add_trip(self, trip_id, stops):
+        trip = self.trips.get(trip_id)
+        if trip is None or len(stops) < 2:
+            return
+        route_id, bus_key, service_id = trip
+        stops.sort()
+        resolved = []
+        for sequence, stop_id, arrival, departure in stops:
+            station_id = self.stations.get(stop_id)
+            if station_id is None:
+                raise GtfsError(f"Trip {trip_id!r} stops at unknown stop {stop_id!r}")
+            resolved.append((station_id, sequence, arrival if arrival is not None else departure,
+                             departure if departure is not None else arrival))
+        first_departure, last_arrival = resolved[0][3], resolved[-1][2]
+        if first_departure is None or last_arrival is None:
+            raise GtfsError(f"Trip {trip_id!r} has no time at its first or last stop")
+
+        for day in self.services[service_id]:
+            if (trip_id, day) in self.kept:
+                continue
+            base = datetime.combine(day, time.min, tzinfo=self.tz)
+            self.pending_schedules.append(Schedule(
+                bus_id=self.buses[bus_key],
+                start_station_id=resolved[0][0],
+                end_station_id=resolved[-1][0],
+                departure_time=base + timedelta(seconds=first_departure),
+                arrival_time=base + timedelta(seconds=last_arrival),
+                service_date=day,
+                gtfs_trip_id=trip_id,
+            ))
+            index = len(self.pending_schedules) - 1
+            for station_id, sequence, arrival, departure in resolved:
+                self.pending_stops.append((
+                    index, station_id, sequence,
+                    base + timedelta(seconds=arrival) if arrival is not None else None,
+                    base + timedelta(seconds=departure) if departure is not None else None,
+                ))
+        if len(self.pending_stops) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        Schedule.objects.bulk_create(self.pending_schedules, batch_size=BATCH_SIZE)
+        insert_stop_times([
+            (self.pending_schedules[index].id, station_id, order, arrival, departure)
+            for index, station_id, order, arrival, departure in self.pending_stops
+        ])
+        self.counts['schedules'] += len(self.pending_schedules)
+        self.counts['stop_times'] += len(self.pending_stops)
+        self.pending_schedules = []
+        self.pending_stops = []
+
+
+def import_feed(file, start_date, days=7, bus_capacity=50, log=None, max_size=None):
+    """
+    Import a GTFS zip (path or file object). Returns row counts per kind.
+    With max_size, a feed whose files add up to more bytes uncompressed is
+    refused with FeedTooLarge before anything is read.
+    """
+    try:
+        feed = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise GtfsError("The feed is not a zip file")
+    with feed:
+        if max_size is not None:
+            size = sum(info.file_size for info in feed.infolist())
+            if size > max_size:
+                raise FeedTooLarge(f"The feed is {size:,} bytes uncompressed, over the {max_size:,} "
+                                   f"that can be imported here")
+        return Importer(feed, start_date, days, bus_capacity, log).run()
+
+
+class _Writer:
+    """A CSV file inside the zip, streamed as it is written."""
+
+    def __init__(self, feed, name, header):
+        self.raw = feed.open(name, 'w', force_zip64=True)
+        self.text = io.TextIOWrapper(self.raw, encoding='utf-8', newline='')
+        self.csv = csv.writer(self.text)
+        self.csv.writerow(header)
+        self.rows = 0
+
+    def write(self, row):
+        self.csv.writerow(row)
+        self.rows += 1
+
+    def close(self):
+        self.text.close()
+
+
+def _stop_id(pk, gtfs_id):
+    return gtfs_id or f"station-{pk}"
+
+
+def _route_id(pk, gtfs_id):
+    return gtfs_id or f"route-{pk}"
+
+
+def _trip_id(pk, gtfs_trip_id, service_date):
+    return f"{gtfs_trip_id}:{service_date:%Y%m%d}" if gtfs_trip_id else f"schedule-{pk}"
+
+
+def export_feed(file, agency_name='Bus Routes', agency_url='https://example.com', log=None):
+    """Write every station, route and schedule as a GTFS zip to a path or writable file object."""
+    log = log or (lambda message: None)
+    tz = timezone.get_default_timezone()
+    counts = {}
+
+    def local_date(service_date, departure):
+        return service_date or timezone.localtime(departure, tz).date()
+
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as feed:
+        out = _Writer(feed, 'agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'])
+        out.write(['1', agency_name, agency_url, timezone.get_default_timezone_name()])
+        out.close()
+
+        out = _Writer(feed, 'stops.txt', ['stop_id', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon'])
+        stations = Station.objects.order_by('id').values_list('id', 'gtfs_id', 'name', 'address', 'latitude',
+                                                               'longitude')
+        for pk, gtfs_id, name, address, lat, lon in stations.iterator(chunk_size=ITERATOR_CHUNK):
+            out.write([_stop_id(pk, gtfs_id), name, address, lat, lon])
+        out.close()
+        counts['stops'] = out.rows
+
+        out = _Writer(feed, 'routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name',
+                                           'route_type'])
+        for pk, gtfs_id, name, description in Route.objects.order_by('id').values_list(
+                'id', 'gtfs_id', 'name', 'description').iterator(chunk_size=ITERATOR_CHUNK):
+            out.write([_route_id(pk, gtfs_id), '1', name, description or '', ROUTE_TYPE_BUS])
+        out.close()
+        counts['routes'] = out.rows
+
+        # One shape per route, named after it
+        out = _Writer(feed, 'shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'])
+        for gtfs_id, route_pk, lat, lon, order in RoutePoint.objects.order_by('route_id', 'order').values_list(
+                'route__gtfs_id', 'route_id', 'latitude', 'longitude', 'order').iterator(chunk_size=ITERATOR_CHUNK):
+            out.write([_route_id(route_pk, gtfs_id), lat, lon, order])
+        out.close()
+        counts['shape_points'] = out.rows
+        shaped = set(RoutePoint.objects.values_list('route_id', flat=True).distinct())
+
+        out = _Writer(feed, 'trips.txt', ['route_id', 'service_id', 'trip_id', 'shape_id', 'block_id'])
+        dates = set()
+        skipped = 0
+        trips = Schedule.objects.order_by('id').values_list(
+            'id', 'gtfs_trip_id', 'service_date', 'departure_time', 'bus__route_id', 'bus__route__gtfs_id',
+            'bus__number'
+        )
+        for pk, gtfs_trip_id, service_date, departure, route_pk, route_gtfs_id, bus_number in trips.iterator(
+                chunk_size=ITERATOR_CHUNK):
+            if route_pk is None:
+                # GTFS trips must belong to a route
+                skipped += 1
+                continue
+            day = local_date(service_date, departure)
+            dates.add(day)
+            route_id = _route_id(route_pk, route_gtfs_id)
+            out.write([route_id, f"{day:%Y%m%d}", _trip_id(pk, gtfs_trip_id, day),
+                       route_id if route_pk in shaped else '', bus_number])
+        out.close()
+        counts['trips'] = out.rows
+        counts['skipped_trips'] = skipped
+
+        out = _Writer(feed, 'calendar_dates.txt', ['service_id', 'date', 'exception_type'])
+        for day in sorted(dates):
+            out.write([f"{day:%Y%m%d}", f"{day:%Y%m%d}", 1])
+        out.close()
+
+        out = _Writer(feed, 'stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id',
+                                               'stop_sequence'])
+        stop_times = StationSchedule.objects.filter(schedule__bus__route__isnull=False).order_by(
+            'schedule_id', 'order'
+        ).values_list(
+            'schedule_id', 'schedule__gtfs_trip_id', 'schedule__service_date', 'schedule__departure_time',
+            'station_id', 'station__gtfs_id', 'arrival_time', 'departure_time', 'order'
+        )
+        current, base, trip_id = None, None, None
+        for (schedule_id, gtfs_trip_id, service_date, trip_departure, station_pk, station_gtfs_id,
+             arrival, departure, order) in stop_times.iterator(chunk_size=ITERATOR_CHUNK):
+            if schedule_id != current:
+                current = schedule_id
+                day = local_date(service_date, trip_departure)
+                base = datetime.combine(day, time.min, tzinfo=tz)
+                trip_id = _trip_id(schedule_id, gtfs_trip_id, day)
+            out.write([
+                trip_id,
+                format_time((arrival - base).total_seconds()) if arrival else '',
+                format_time((departure - base).total_seconds()) if departure else '',
+                _stop_id(station_pk, station_gtfs_id),
+                order,
+            ])
+            if out.rows % PROGRESS_EVERY == 0:
+                log(f"stop_times: {out.rows:,} rows written")
+        out.close()
+        counts['stop_times'] = out.rows
+    log(f"exported {counts}")
+    return counts
@@ -0,0 +1,130 @@
+"""
+Append-only location history and its per-minute rollup.
+
+Raw fixes go to BusLocationHistory in bulk from the ingest path. Once they
+are older than the raw retention window, downsample() folds them into one
+BusLocationMinute row per bus and minute and deletes the raw rows, an hour
+of data at a time so memory and transaction size stay bounded.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Min
+from django.db.models.functions import TruncMinute
+from django.utils import timezone
+
+from .models import BusLocationHistory, BusLocationMinute
+
+INSERT_BATCH_SIZE = 2000
+
+# Raw fixes older than this are rolled up into per-minute rows
+RAW_RETENTION = timedelta(days=7)
+
+# Per-minute rows older than this are deleted
+MINUTE_RETENTION = timedelta(days=365)
+
+CHUNK = timedelta(hours=1)
+
+
+def record_fixes(fixes):
+    """
+    Append parsed fixes (bus_id, lat, lon, speed, heading, timestamp) to the
+    history. Fixes already stored for the same bus and timestamp are skipped.
+    """
+    rows = [
+        BusLocationHistory(
+            bus_id=bus_id,
+            timestamp=timestamp,
+            lat_e6=round(lat * 1e6),
+            lon_e6=round(lon * 1e6),
+            speed=round(speed),
+            heading=round(heading) % 360,
+        )
+        for bus_id, lat, lon, speed, heading, timestamp in fixes
+    ]
+    BusLocationHistory.objects.bulk_create(rows, batch_size=INSERT_BATCH_SIZE, ignore_conflicts=True)
+
+
+def locations_between(bus_id, start, end, resolution='raw'):
+    """Fixes for one bus in [start, end), oldest first, as a values() queryset."""
+    if resolution == 'minute':
+        return BusLocationMinute.objects.filter(
+            bus_id=bus_id, minute__gte=start, minute__lt=end
+        ).order_by('minute').values(
+            'minute', 'lat_e6', 'lon_e6', 'avg_speed', 'max_speed', 'fixes'
+        )
+    return BusLocationHistory.objects.filter(
+        bus_id=bus_id, timestamp__gte=start, timestamp__lt=end
+    ).order_by('timestamp').values(
+        'timestamp', 'lat_e6', 'lon_e6', 'speed', 'heading'
+    )
+
+
+def _downsample_chunk(start, end):
+    raw = BusLocationHistory.objects.filter(timestamp__gte=start, timestamp__lt=end)
+    buckets = raw.annotate(
+        bucket=TruncMinute('timestamp')
+    ).values('bus_id', 'bucket').annotate(
+        lat=Avg('lat_e6'),
+        lon=Avg('lon_e6'),
+        avg_speed=Avg('speed'),
+        max_speed=Max('speed'),
+        fixes=Count('id'),
+    ).order_by()
+
+    rows = [
+        BusLocationMinute(
+            bus_id=b['bus_id'],
+            minute=b['bucket'],
+            lat_e6=round(b['lat']),
+            lon_e6=round(b['lon']),
+            avg_speed=round(b['avg_speed']),
+            max_speed=b['max_speed'],
+            fixes=min(b['fixes'], 32767),
+        )
+        for b in buckets
+    ]
+    # Re-running over a chunk that was partly rolled up replaces its rows
+    BusLocationMinute.objects.bulk_create(
+        rows,
+        batch_size=INSERT_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['bus', 'minute'],
+        update_fields=['lat_e6', 'lon_e6', 'avg_speed', 'max_speed', 'fixes'],
+    )
+    raw.delete()
+    return len(rows)
+
+
+def downsample(now=None, raw_retention=RAW_RETENTION, minute_retention=MINUTE_RETENTION, log=None):
+    """
+    Roll raw fixes older than raw_retention into per-minute rows and expire
+    per-minute rows older than minute_retention. Returns (minutes, expired).
+    """
+    now = now or timezone.now()
+    # Chunk boundaries fall on the hour so no minute is split across chunks
+    cutoff = (now - raw_retention).replace(minute=0, second=0, microsecond=0)
+
+    oldest = BusLocationHistory.objects.filter(timestamp__lt=cutoff).aggregate(t=Min('timestamp'))['t']
+    minutes = 0
+    if oldest is not None:
+        start = oldest.replace(minute=0, second=0, microsecond=0)
+        while start < cutoff:
+            end = min(start + CHUNK, cutoff)
+            with transaction.atomic():
+                written = _downsample_chunk(start, end)
+            minutes += written
+            if log and written:
+                log(f"{start:%Y-%m-%d %H:%M}: {written} minute rows")
+            start = end
+            if not written:
+                # Skip over gaps in the history instead of walking them hourly
+                oldest = BusLocationHistory.objects.filter(
+                    timestamp__gte=start, timestamp__lt=cutoff
+                ).aggregate(t=Min('timestamp'))['t']
+                if oldest is None:
+                    break
+                start = oldest.replace(minute=0, second=0, microsecond=0)
+
+    expired, _ = BusLocationMinute.objects.filter(minute__lt=now - minute_retention).delete()
+    return minutes, expired
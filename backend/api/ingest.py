@@ -0,0 +1,198 @@
+"""
+Batch ingest of GPS fixes from the bus trackers.
+
+Fixes are validated with plain Python checks rather than a serializer per
+point, collapsed to the newest fix per bus, and written with one
+INSERT ... ON CONFLICT statement per batch. The conflict clause only
+overwrites a stored location with a strictly newer fix, so duplicates and
+out-of-order deliveries are dropped by the database. Every accepted fix,
+late or not, is also appended to the location history, and the newest fix
+per bus refreshes its arrival predictions and is pushed to live streams.
+"""
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .eta import eta_engine
+from .history import record_fixes
+from .streaming import broadcaster
+from .models import Bus, BusLocation
+
+MAX_BATCH_SIZE = 5000
+
+# Fixes stamped further than this into the future are rejected
+MAX_CLOCK_SKEW = timedelta(minutes=2)
+
+
+class InvalidFix(ValueError):
+    pass
+
+
+def _number(raw, key, low, high, default=None):
+    value = raw.get(key, default)
+    if value is None:
+        raise InvalidFix(f"{key} is required")
+    # float() would take JSON true and false as 1 and 0
+    if isinstance(value, bool):
+        raise InvalidFix(f"{key} must be a number")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise InvalidFix(f"{key} must be a number")
+    if math.isnan(value) or not low <= value <= high:
+        raise InvalidFix(f"{key} out of range")
+    return value
+
+
+def _timestamp(raw, now):
+    value = raw.get('timestamp')
+    if value is None:
+        return now
+    return parse_timestamp(value, now)
+
+
+def parse_timestamp(value, now):
+    """Epoch seconds or ISO 8601 as an aware datetime, no later than MAX_CLOCK_SKEW past `now`."""
+    if isinstance(value, bool):
+        raise InvalidFix("timestamp must be epoch seconds or ISO 8601")
+    if isinstance(value, (int, float)):
+        try:
+            value = datetime.fromtimestamp(value, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise InvalidFix("timestamp out of range")
+    else:
+        try:
+            value = parse_datetime(str(value))
+        except ValueError:
+            # Well formed but impossible, such as February 30
+            raise InvalidFix("timestamp is not a valid date and time")
+        if value is None:
+            raise InvalidFix("timestamp must be epoch seconds or ISO 8601")
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, dt_timezone.utc)
+    if value > now + MAX_CLOCK_SKEW:
+        raise InvalidFix("timestamp is in the future")
+    return value
+
+
+def parse_fix(raw, now):
+    """Validate one fix dict and return (bus_id, lat, lon, speed, heading, timestamp)."""
+    if not isinstance(raw, dict):
+        raise InvalidFix("fix must be an object")
+    try:
+        bus_id = int(raw.get('bus_id'))
+    except (TypeError, ValueError):
+        raise InvalidFix("bus_id must be an integer")
+    return (
+        bus_id,
+        _number(raw, 'latitude', -90, 90),
+        _number(raw, 'longitude', -180, 180),
+        _number(raw, 'speed', 0, 500, default=0),
+        _number(raw, 'heading', 0, 360, default=0),
+        _timestamp(raw, now),
+    )
+
+
+def parse_batch(payload):
+    """
+    Accept a single fix, a list of fixes or {"fixes": [...]}. Returns
+    (fixes, errors) where errors is a list of {"index", "error"} dicts.
+    """
+    if isinstance(payload, dict) and 'fixes' in payload:
+        payload = payload['fixes']
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list):
+        raise InvalidFix("expected a fix, a list of fixes or {\"fixes\": [...]}")
+    if len(payload) > MAX_BATCH_SIZE:
+        raise InvalidFix(f"at most {MAX_BATCH_SIZE} fixes per batch")
+
+    now = timezone.now()
+    fixes = []
+    errors = []
+    for index, raw in enumerate(payload):
+        try:
+            fixes.append(parse_fix(raw, now))
+        except InvalidFix as e:
+            errors.append({'index': index, 'error': str(e)})
+    return fixes, errors
+
+
+def latest_per_bus(fixes):
+    latest = {}
+    for fix in fixes:
+        current = latest.get(fix[0])
+        if current is None or fix[5] > current[5]:
+            latest[fix[0]] = fix
+    return latest
+
+
+def upsert_locations(fixes):
+    """
+    Store the newest fix per bus in a single statement. Returns the ids of
+    the buses whose BusLocation was inserted or moved forward; older fixes
+    are ignored.
+    """
+    if not fixes:
+        return set()
+
+    qn = connection.ops.quote_name
+    table = qn(BusLocation._meta.db_table)
+    columns = ['bus_id', 'latitude', 'longitude', 'speed', 'heading', 'timestamp']
+    placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(fixes))
+    adapt = connection.ops.adapt_datetimefield_value
+    params = []
+    for bus_id, lat, lon, speed, heading, timestamp in fixes:
+        params.extend((bus_id, lat, lon, speed, heading, adapt(timestamp)))
+    updates = ', '.join(f"{qn(c)} = EXCLUDED.{qn(c)}" for c in columns[1:])
+    sql = (
+        f"INSERT INTO {table} ({', '.join(qn(c) for c in columns)}) "
+        f"VALUES {placeholders} "
+        f"ON CONFLICT ({qn('bus_id')}) DO UPDATE SET {updates} "
+        f"WHERE {table}.{qn('timestamp')} < EXCLUDED.{qn('timestamp')} "
+        f"RETURNING {qn('bus_id')}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {row[0] for row in cursor.fetchall()}
+
+
+def ingest(payload):
+    """Validate and store a batch of fixes. Returns a summary for the response."""
+    fixes, errors = parse_batch(payload)
+    latest = latest_per_bus(fixes)
+
+    routes = dict(Bus.objects.filter(id__in=list(latest)).values_list('id', 'route_id'))
+    known = set(routes)
+    for bus_id in set(latest) - known:
+        del latest[bus_id]
+    unknown = sum(1 for fix in fixes if fix[0] not in known)
+
+    moved = upsert_locations(list(latest.values()))
+    record_fixes([fix for fix in fixes if fix[0] in known])
+    # A late or replayed fix is history only; the live position and its
+    # predictions stay with the newer fix already stored
+    for bus_id in set(latest) - moved:
+        del latest[bus_id]
+    eta_engine.update([
+        (bus_id, routes[bus_id], lat, lon, timestamp)
+        for bus_id, lat, lon, speed, heading, timestamp in latest.values()
+    ])
+    broadcaster.publish([
+        {
+            'bus_id': bus_id, 'route_id': routes[bus_id],
+            'latitude': lat, 'longitude': lon,
+            'speed': speed, 'heading': heading, 'timestamp': timestamp,
+        }
+        for bus_id, lat, lon, speed, heading, timestamp in latest.values()
+    ])
+    return {
+        'received': len(fixes) + len(errors),
+        'accepted': len(fixes) - unknown,
+        'updated': len(moved),
+        'unknown_bus': unknown,
+        'errors': errors,
+    }
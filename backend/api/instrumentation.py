@@ -0,0 +1,266 @@
+"""
+Per-request SQL and timing instrumentation for the api views.
+
+InstrumentationMiddleware times each request to an api view and splits it
+into database time (from a connection execute wrapper, so it works without
+DEBUG and costs two clock reads per query), view time outside the
+database, and render time (from the view returning its response until the
+rendered response comes back). Query count and response size are recorded
+too. Everything goes into fixed-bucket histograms labelled by view, which
+metrics_text() writes in the Prometheus text format.
+
+The histograms are per process: with several workers, each serves its own
+numbers and Prometheus adds them up across scrape targets.
+
+The middleware runs in sync and async stacks alike. Under ASGI a sync view
+runs in a worker thread with its own database connection, so the recorder
+is found through a context variable, which follows the request into that
+thread, by a wrapper installed on every connection as it is opened.
+
+Requests slower than API_SLOW_REQUEST_MS (settings, default 1000; None
+turns it off) are logged to the "api.slow_requests" logger with their
+slowest queries. Only the few slowest statements of each request are kept,
+in a small heap, so this is cheap enough to leave on.
+"""
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger('api.slow_requests')
+
+SLOW_REQUEST_MS = 1000
+# Statements kept per request for the slow request log
+TOP_QUERIES = 5
+SQL_LOG_CHARS = 500
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.series = {}
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for labels, counts, total in sorted(series):
+            label_text = _labels(labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}'
+            cumulative += counts[-1]
+            yield f'{self.name}_bucket{{{label_text},le="+Inf"}} {cumulative}'
+            yield f"{self.name}_sum{{{label_text}}} {total}"
+            yield f"{self.name}_count{{{label_text}}} {cumulative}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{{{_labels(labels)}}} {value}"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    # Series are keyed by tuples of (name, value) pairs
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+requests_total = Counter('api_requests_total', "Requests to api views")
+request_seconds = Histogram('api_request_duration_seconds', "Time spent on the request", SECONDS_BUCKETS)
+db_seconds = Histogram('api_request_db_seconds', "Time spent in SQL queries", SECONDS_BUCKETS)
+view_seconds = Histogram('api_request_view_seconds', "Time spent in the view outside SQL, "
+                         "mostly serialization", SECONDS_BUCKETS)
+render_seconds = Histogram('api_request_render_seconds', "Time spent rendering the response",
+                           SECONDS_BUCKETS)
+queries = Histogram('api_request_queries', "SQL queries per request", QUERY_BUCKETS)
+response_bytes = Histogram('api_response_bytes', "Response body size", BYTES_BUCKETS)
+
+METRICS = [requests_total, request_seconds, db_seconds, view_seconds, render_seconds, queries, response_bytes]
+
+
+def metrics_text():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.lines())
+    return '\n'.join(lines) + '\n'
+
+
+class QueryRecorder:
+    """Execute wrapper counting and timing every statement of one request."""
+
+    def __init__(self, keep=TOP_QUERIES):
+        self.count = 0
+        self.seconds = 0.0
+        self.keep = keep
+        # Min-heap of (duration, sequence, sql): the slowest statements so far
+        self.top = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.seconds += duration
+            if self.keep:
+                if len(self.top) < self.keep:
+                    heapq.heappush(self.top, (duration, self.count, sql))
+                elif duration > self.top[0][0]:
+                    heapq.heapreplace(self.top, (duration, self.count, sql))
+
+    def slowest(self):
+        return sorted(self.top, reverse=True)
+
+
+# The QueryRecorder of the request being handled, if any
+_recorder = ContextVar('api_query_recorder', default=None)
+
+
+def _record(execute, sql, params, many, context):
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def _install(connection, **kwargs):
+    # Wrappers outlive reconnects, so only add it once per connection object
+    if _record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record)
+
+
+connection_created.connect(_install)
+
+
+def _is_api_view(func):
+    # Viewsets and class-based views are wrapped; their class says where they live
+    owner = getattr(func, 'cls', None) or getattr(func, 'view_class', None) or func
+    return getattr(owner, '__module__', '').startswith('api.')
+
+
+class InstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_seconds = getattr(settings, 'API_SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+        if self.slow_seconds is not None:
+            self.slow_seconds /= 1000
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = self.start(request)
+        start = time.perf_counter()
+        # The connection may have been opened before this module was imported
+        _install(connection)
+        token = _recorder.set(recorder)
+        try:
+            response = self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self.finish(request, response, recorder, start, time.perf_counter())
+        return response
+
+    async def __acall__(self, request):
+        recorder = self.start(request)
+        start = time.perf_counter()
+        token = _recorder.set(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self.finish(request, response, recorder, start, time.perf_counter())
+        return response
+
+    def start(self, request):
+        request._instrumentation = {'view': None, 'returned': None}
+        return QueryRecorder(keep=TOP_QUERIES if self.slow_seconds is not None else 0)
+
+    def finish(self, request, response, recorder, start, end):
+        state = request._instrumentation
+        if state['view'] is None:
+            return
+
+        returned = state['returned'] or end
+        labels = (('view', state['view']), ('method', request.method))
+        total = end - start
+        requests_total.inc(labels + (('status', response.status_code),))
+        request_seconds.observe(labels, total)
+        db_seconds.observe(labels, recorder.seconds)
+        # The view's own time excludes SQL; rendering runs after it returns
+        view_seconds.observe(labels, max(returned - start - recorder.seconds, 0.0))
+        render_seconds.observe(labels, end - returned)
+        queries.observe(labels, recorder.count)
+        size = None
+        if not response.streaming:
+            size = len(response.content)
+            response_bytes.observe(labels, size)
+
+        if self.slow_seconds is not None and total >= self.slow_seconds:
+            logger.warning(
+                "Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms, render %.0f ms, %s bytes\n%s",
+                request.method, request.get_full_path(), state['view'], total * 1000,
+                recorder.count, recorder.seconds * 1000, (end - returned) * 1000, size,
+                '\n'.join(f"  {duration * 1000:8.1f} ms  {sql[:SQL_LOG_CHARS]}"
+                          for duration, _, sql in recorder.slowest()),
+            )
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if _is_api_view(view_func):
+            match = request.resolver_match
+            request._instrumentation['view'] = match.view_name or match.route
+
+    def process_template_response(self, request, response):
+        # Called with the view's unrendered response; rendering follows
+        request._instrumentation['returned'] = time.perf_counter()
+        return response
@@ -0,0 +1,361 @@
+"""
+In-memory RAPTOR journey planner over Schedule / StationSchedule.
+
+Schedules with the same sequence of stations are grouped into patterns. Each
+pattern keeps its stop times in flat, column-major arrays (one column per stop,
+trips sorted by departure), so boarding the earliest catchable trip at a stop
+is a bisect over a contiguous slice.
+
+The timetable is built once per process and patched in place when schedules
+change: signals mark schedule ids dirty and only the patterns those schedules
+belong to are rebuilt on the next query.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Schedule, StationSchedule
+
+# How far ahead of now schedules are loaded; the window slides forward by
+# rebuilding once half of it has elapsed
+HORIZON = timedelta(days=2)
+
+# Minimum time to change buses at the same station
+MIN_TRANSFER_SECONDS = 120
+
+MAX_TRANSFERS = 4
+
+VERSION_KEY = 'journeys:timetable-version'
+
+INFINITY = 2 ** 62
+
+
+def _epoch(dt):
+    return int(dt.timestamp())
+
+
+def _stop_times(schedule, stops):
+    """
+    Return (arrivals, departures) in epoch seconds for a schedule's stops,
+    filling gaps from the neighbouring stops or the schedule endpoints.
+    """
+    n = len(stops)
+    known = []
+    for stop in stops:
+        arrival = stop.arrival_time or stop.departure_time
+        departure = stop.departure_time or stop.arrival_time
+        known.append((
+            _epoch(arrival) if arrival else None,
+            _epoch(departure) if departure else None,
+        ))
+
+    if known[0][1] is None:
+        known[0] = (_epoch(schedule.departure_time), _epoch(schedule.departure_time))
+    if known[-1][0] is None:
+        known[-1] = (_epoch(schedule.arrival_time), _epoch(schedule.arrival_time))
+
+    # Interpolate stops that carry no times at all
+    i = 0
+    while i < n:
+        if known[i][0] is not None:
+            i += 1
+            continue
+        j = i
+        while known[j][0] is None:
+            j += 1
+        before, after = known[i - 1][1], known[j][0]
+        for k in range(i, j):
+            t = before + (after - before) * (k - i + 1) // (j - i + 1)
+            known[k] = (t, t)
+        i = j
+
+    return [a for a, _ in known], [d for _, d in known]
+
+
+class Pattern:
+    """A group of trips with the same stop sequence that never overtake each other."""
+
+    __slots__ = ('stops', 'schedule_ids', 'arrivals', 'departures', 'n_trips')
+
+    def __init__(self, stops, trips):
+        # trips: list of (schedule_id, arrivals, departures), sorted by first departure
+        self.stops = array('i', stops)
+        self.n_trips = len(trips)
+        self.schedule_ids = array('q', [t[0] for t in trips])
+        self.arrivals = array('q', [0]) * (len(stops) * self.n_trips)
+        self.departures = array('q', [0]) * (len(stops) * self.n_trips)
+        for t, (_, arrivals, departures) in enumerate(trips):
+            for i in range(len(stops)):
+                self.arrivals[i * self.n_trips + t] = arrivals[i]
+                self.departures[i * self.n_trips + t] = departures[i]
+
+    def earliest_trip(self, position, ready):
+        """Index of the first trip leaving stop `position` at or after `ready`, or None."""
+        lo = position * self.n_trips
+        t = bisect_left(self.departures, ready, lo, lo + self.n_trips) - lo
+        return t if t < self.n_trips else None
+
+    def arrival(self, trip, position):
+        return self.arrivals[position * self.n_trips + trip]
+
+    def departure(self, trip, position):
+        return self.departures[position * self.n_trips + trip]
+
+
+def _split_fifo(trips):
+    """Split trips sharing a stop sequence into overtaking-free groups."""
+    trips.sort(key=lambda t: (t[2][0], t[0]))
+    groups = []
+    for trip in trips:
+        for group in groups:
+            last = group[-1]
+            if all(a >= b for a, b in zip(trip[1], last[1])) and \
+                    all(a >= b for a, b in zip(trip[2], last[2])):
+                group.append(trip)
+                break
+        else:
+            groups.append([trip])
+    return groups
+
+
+class Timetable:
+    def __init__(self):
+        self.window_start = None
+        self.window_end = None
+        # schedule_id -> (stop sequence, arrivals, departures)
+        self.trips = {}
+        # stop sequence -> {schedule_id, ...}
+        self.sequence_trips = defaultdict(set)
+        # stop sequence -> [Pattern, ...]
+        self.patterns = {}
+        # station_id -> [(Pattern, position), ...]
+        self.station_patterns = {}
+
+    def _load(self, schedule_filter):
+        schedules = {
+            s.id: s for s in Schedule.objects.filter(
+                schedule_filter,
+                is_active=True,
+                arrival_time__gte=self.window_start,
+                departure_time__lt=self.window_end,
+            ).only('id', 'departure_time', 'arrival_time')
+        }
+        stops = defaultdict(list)
+        rows = StationSchedule.objects.filter(
+            schedule_id__in=list(schedules)
+        ).only(
+            'schedule_id', 'station_id', 'arrival_time', 'departure_time', 'order'
+        ).order_by('schedule_id', 'order')
+        for stop in rows:
+            stops[stop.schedule_id].append(stop)
+
+        loaded = {}
+        for schedule_id, schedule_stops in stops.items():
+            if len(schedule_stops) < 2:
+                continue
+            arrivals, departures = _stop_times(schedules[schedule_id], schedule_stops)
+            sequence = tuple(s.station_id for s in schedule_stops)
+            loaded[schedule_id] = (sequence, arrivals, departures)
+        return loaded
+
+    def _add_trips(self, loaded):
+        for schedule_id, trip in loaded.items():
+            self.trips[schedule_id] = trip
+            self.sequence_trips[trip[0]].add(schedule_id)
+
+    def _rebuild_patterns(self, sequences):
+        for sequence in sequences:
+            trips = [
+                (schedule_id, self.trips[schedule_id][1], self.trips[schedule_id][2])
+                for schedule_id in self.sequence_trips.get(sequence, ())
+            ]
+            if trips:
+                self.patterns[sequence] = [Pattern(sequence, g) for g in _split_fifo(trips)]
+            else:
+                self.patterns.pop(sequence, None)
+                self.sequence_trips.pop(sequence, None)
+
+        station_patterns = defaultdict(list)
+        for patterns in self.patterns.values():
+            for pattern in patterns:
+                for position, station_id in enumerate(pattern.stops):
+                    station_patterns[station_id].append((pattern, position))
+        self.station_patterns = dict(station_patterns)
+
+    def build(self, now):
+        self.window_start = now
+        self.window_end = now + HORIZON
+        self._add_trips(self._load(Q()))
+        self._rebuild_patterns(set(self.sequence_trips))
+
+    def update(self, schedule_ids):
+        touched = set()
+        for schedule_id in schedule_ids:
+            old = self.trips.pop(schedule_id, None)
+            if old:
+                touched.add(old[0])
+                self.sequence_trips[old[0]].discard(schedule_id)
+        loaded = self._load(Q(id__in=list(schedule_ids)))
+        touched.update(trip[0] for trip in loaded.values())
+        self._add_trips(loaded)
+        self._rebuild_patterns(touched)
+
+    def is_stale(self, now):
+        return self.window_start is None or now >= self.window_start + HORIZON / 2
+
+    def plan(self, origin, destination, departure, max_transfers):
+        """
+        Run RAPTOR from origin at `departure` (epoch seconds). Returns one
+        journey per number of legs that improves on the arrival time of every
+        journey with fewer legs, i.e. the Pareto set over arrival vs. transfers.
+        """
+        if origin not in self.station_patterns or destination not in self.station_patterns:
+            return []
+
+        best = defaultdict(lambda: INFINITY)
+        best[origin] = departure
+        # Arrival labels and the leg that produced them, one dict per round
+        labels = [{origin: departure}]
+        parents = [{}]
+        marked = {origin}
+        journeys = []
+        best_at_target = INFINITY
+
+        for round_ in range(1, max_transfers + 2):
+            previous = labels[-1]
+            current = dict(previous)
+            current_parents = dict(parents[-1])
+
+            # Earliest marked position in every pattern touched by a marked stop
+            queue = {}
+            for station_id in marked:
+                for pattern, position in self.station_patterns.get(station_id, ()):
+                    if position < queue.get(id(pattern), (None, INFINITY))[1]:
+                        queue[id(pattern)] = (pattern, position)
+
+            marked = set()
+            for pattern, start in queue.values():
+                trip = None
+                board = None
+                for position in range(start, len(pattern.stops)):
+                    station_id = pattern.stops[position]
+                    if trip is not None:
+                        arrival = pattern.arrival(trip, position)
+                        if arrival < best[station_id] and arrival < best_at_target:
+                            best[station_id] = arrival
+                            current[station_id] = arrival
+                            current_parents[station_id] = (pattern, trip, board, position)
+                            marked.add(station_id)
+                            if station_id == destination:
+                                best_at_target = arrival
+
+                    ready = previous.get(station_id)
+                    if ready is None:
+                        continue
+                    if station_id != origin:
+                        ready += MIN_TRANSFER_SECONDS
+                    if trip is None or ready <= pattern.departure(trip, position):
+                        earlier = pattern.earliest_trip(position, ready)
+                        if earlier is not None and (trip is None or earlier < trip):
+                            trip = earlier
+                            board = position
+
+            labels.append(current)
+            parents.append(current_parents)
+
+            if destination in marked:
+                journeys.append(self._reconstruct(parents, round_, destination))
+            if not marked:
+                break
+
+        return journeys
+
+    def _reconstruct(self, parents, round_, destination):
+        legs = []
+        station_id = destination
+        while round_ > 0:
+            pattern, trip, board, alight = parents[round_][station_id]
+            legs.append({
+                'schedule_id': pattern.schedule_ids[trip],
+                'from_station': pattern.stops[board],
+                'to_station': pattern.stops[alight],
+                'departure_time': pattern.departure(trip, board),
+                'arrival_time': pattern.arrival(trip, alight),
+            })
+            station_id = pattern.stops[board]
+            round_ -= 1
+            # Labels are carried forward between rounds, so step back to the
+            # round in which the boarding stop was actually reached
+            while round_ > 0 and parents[round_ - 1].get(station_id) == parents[round_].get(station_id):
+                round_ -= 1
+        legs.reverse()
+        return legs
+
+
+class JourneyPlanner:
+    """Process-wide timetable, rebuilt lazily and patched from dirty schedule ids."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timetable = Timetable()
+        self.dirty = set()
+        self.version = None
+
+    def invalidate(self, schedule_id):
+        self.invalidate_many([schedule_id])
+
+    def invalidate_many(self, schedule_ids):
+        with self.lock:
+            self.dirty.update(schedule_ids)
+        # Let other worker processes know their copy is out of date
+        cache.add(VERSION_KEY, 0, None)
+        try:
+            version = cache.incr(VERSION_KEY)
+        except ValueError:
+            return
+        with self.lock:
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def invalidate_all(self):
+        """Force every process to rebuild its timetable, e.g. after a bulk import."""
+        cache.add(VERSION_KEY, 0, None)
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            pass
+        with self.lock:
+            self.version = None
+
+    def get_timetable(self):
+        now = timezone.now()
+        version = cache.get(VERSION_KEY, 0)
+        with self.lock:
+            if self.timetable.is_stale(now) or version != self.version:
+                self.timetable = Timetable()
+                self.timetable.build(now)
+                self.dirty.clear()
+            elif self.dirty:
+                self.timetable.update(self.dirty)
+                self.dirty.clear()
+            self.version = version
+            return self.timetable
+
+    def plan(self, origin, destination, departure, max_transfers=2):
+        timetable = self.get_timetable()
+        max_transfers = max(0, min(max_transfers, MAX_TRANSFERS))
+        journeys = timetable.plan(origin, destination, _epoch(departure), max_transfers)
+        for legs in journeys:
+            for leg in legs:
+                leg['departure_time'] = datetime.fromtimestamp(leg['departure_time'], tz=dt_timezone.utc)
+                leg['arrival_time'] = datetime.fromtimestamp(leg['arrival_time'], tz=dt_timezone.utc)
+        return journeys
+
+
+planner = JourneyPlanner()
@@ -0,0 +1,104 @@
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api import counters
+from api.models import Alert, Booking, Bus, Route, Schedule, Station
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_stats():
+    """The seven-COUNT implementation the dashboard used before counters."""
+    today = timezone.now().date()
+    return {
+        'total_buses': Bus.objects.count(),
+        'active_buses': Bus.objects.filter(is_active=True).count(),
+        'total_stations': Station.objects.count(),
+        'total_routes': Route.objects.count(),
+        'today_bookings': Booking.objects.filter(booking_time__date=today).count(),
+        'active_schedules': Schedule.objects.filter(is_active=True, departure_time__gte=timezone.now()).count(),
+        'unresolved_alerts': Alert.objects.filter(is_resolved=False).count(),
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare dashboard stats from counters with the old COUNT queries (changes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=2_000_000)
+        parser.add_argument('--days', type=int, default=60,
+                            help="Spread the bookings over this many past days")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['bookings'], options['days'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, n_bookings, n_days, repeat):
+        now = timezone.now()
+        user = User.objects.create(username='bench-dashboard')
+        stations = Station.objects.bulk_create(
+            Station(name=f"Bench {i}", address="", latitude=37.7, longitude=-122.4, capacity=0)
+            for i in range(2)
+        )
+        bus = Bus.objects.create(number='BENCH-DASH', capacity=50)
+        schedule = Schedule.objects.create(
+            bus=bus, start_station=stations[0], end_station=stations[1],
+            departure_time=now + timedelta(hours=1), arrival_time=now + timedelta(hours=2)
+        )
+
+        # bulk_create skips the counter signals, so the counters are rebuilt afterwards
+        self.stdout.write(f"Creating {n_bookings:,} bookings over {n_days} days...")
+        per_day = n_bookings // n_days
+        for day in range(n_days):
+            last_id = Booking.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            Booking.objects.bulk_create(
+                (Booking(user=user, schedule=schedule, boarding_station=stations[0],
+                         destination_station=stations[1]) for _ in range(per_day)),
+                batch_size=5000
+            )
+            Booking.objects.filter(id__gt=last_id).update(booking_time=now - timedelta(days=day))
+
+        t0 = time.perf_counter()
+        counters.reconcile()
+        self.stdout.write(f"reconcile: {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+        expected = legacy_stats()
+        actual = counters.read()
+        if actual != expected:
+            self.stderr.write(f"Mismatch: legacy {expected}, counters {actual}")
+
+        for name, func in [('legacy COUNT queries', legacy_stats), ('counters', counters.read)]:
+            timings = []
+            for _ in range(repeat):
+                with CaptureQueriesContext(connection) as queries:
+                    t0 = time.perf_counter()
+                    func()
+                    timings.append(time.perf_counter() - t0)
+            timings.sort()
+            self.stdout.write(
+                f"{name}: {len(queries)} queries, p50 {timings[len(timings) // 2] * 1000:.2f} ms, "
+                f"max {timings[-1] * 1000:.2f} ms"
+            )
+
+        # Signal path cost: one booking through the ORM, with its counter update
+        t0 = time.perf_counter()
+        for _ in range(200):
+            Booking.objects.create(user=user, schedule=schedule, boarding_station=stations[0],
+                                   destination_station=stations[1])
+        self.stdout.write(f"Booking.objects.create with counter signal: "
+                          f"{(time.perf_counter() - t0) / 200 * 1000:.2f} ms each")
+        if counters.read()['today_bookings'] != expected['today_bookings'] + 200:
+            self.stderr.write("Counter did not follow the new bookings")
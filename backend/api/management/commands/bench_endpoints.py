@@ -0,0 +1,261 @@
+import json
+import os
+import random
+import resource
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api import seats
+from api.models import Alert, Booking, Bus, BusLocation, Route, RoutePoint, Schedule, Station, StationSchedule
+
+# Requests per endpoint traced for allocation peaks; tracing slows them down,
+# so they are not part of the timed run
+TRACED_REQUESTS = 10
+
+# A metric regresses when it grows by more than --tolerance and by more than this
+REGRESSION_FLOOR = {'p50_ms': 0.5, 'p99_ms': 1.0, 'queries_max': 0, 'peak_alloc_kb': 64}
+
+DATASET_MODELS = [Station, Route, RoutePoint, Bus, BusLocation, Schedule, StationSchedule, Booking, Alert]
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Sample:
+    """Request parameters drawn from the data already in the database."""
+
+    def __init__(self, rng, size=200):
+        now = timezone.now()
+        upcoming = list(Schedule.objects.filter(
+            departure_time__gte=now, departure_time__lt=now + timedelta(hours=6), is_active=True
+        ).order_by('departure_time').values_list('id', flat=True)[:5000])
+        if not upcoming:
+            upcoming = list(Schedule.objects.order_by('-departure_time').values_list('id', flat=True)[:5000])
+        if not upcoming:
+            raise CommandError("No schedules to benchmark against; run generate_city first")
+        schedules = Schedule.objects.in_bulk(rng.sample(upcoming, min(size, len(upcoming))))
+
+        # (schedule, boarding station, destination station, departure)
+        self.trips = []
+        for schedule in schedules.values():
+            stops = seats.load_stops(schedule.id)
+            if len(stops) < 2:
+                continue
+            i = rng.randrange(len(stops) - 1)
+            j = rng.randrange(i + 1, len(stops))
+            self.trips.append((schedule.id, stops[i][1], stops[j][1], schedule.departure_time))
+        if not self.trips:
+            raise CommandError("No schedules with stops to benchmark against")
+
+        bus_ids = list(Bus.objects.filter(is_active=True).values_list('id', flat=True)[:5000])
+        self.bus_ids = rng.sample(bus_ids, min(size, len(bus_ids)))
+        self.route_ids = list(Route.objects.values_list('id', flat=True)[:size])
+        self.rng = rng
+
+    def trip(self):
+        return self.rng.choice(self.trips)
+
+
+def _search(sample):
+    _, start, end, departure = sample.trip()
+    at = timezone.localtime(departure - timedelta(minutes=30))
+    return 'GET', f"/buses/search/?startStation={start}&endStation={end}&time={at:%H:%M}", None
+
+
+def _booking(sample):
+    schedule_id, start, end, _ = sample.trip()
+    return 'POST', '/bookings/', {
+        'schedule': schedule_id, 'boarding_station': start, 'destination_station': end
+    }
+
+
+def _departures_after(sample):
+    now = timezone.now().strftime('%Y-%m-%dT%H:%M:%S')
+    return 'GET', f"/admin/schedules/?departure_after={now}", None
+
+
+# name -> function(sample) returning (method, path, body); paths are under /api
+SCENARIOS = {
+    'stations': lambda s: ('GET', '/stations/', None),
+    'search_buses': _search,
+    'bus_details': lambda s: ('GET', f"/buses/{s.rng.choice(s.bus_ids)}/", None),
+    'route_shape': lambda s: ('GET', f"/routes/{s.rng.choice(s.route_ids)}/shape/?zoom=14", None),
+    'schedule_seats': lambda s: ('GET', f"/schedules/{s.trip()[0]}/seats/", None),
+    'create_booking': _booking,
+    'admin_bus_status': lambda s: ('GET', '/admin/buses/status/', None),
+    'admin_dashboard_stats': lambda s: ('GET', '/admin/dashboard/stats/', None),
+    'admin_buses': lambda s: ('GET', '/admin/buses/', None),
+    'admin_stations': lambda s: ('GET', '/admin/stations/', None),
+    'admin_routes': lambda s: ('GET', '/admin/routes/', None),
+    'admin_schedules': _departures_after,
+    'admin_schedules_by_bus': lambda s: ('GET', f"/admin/schedules/?bus={s.rng.choice(s.bus_ids)}", None),
+    'admin_alerts_unresolved': lambda s: ('GET', '/admin/alerts/?is_resolved=false', None),
+    'admin_alerts_by_bus': lambda s: ('GET', f"/admin/alerts/?bus={s.rng.choice(s.bus_ids)}", None),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the API endpoints against the data in the database (see generate_city): "
+        "latency percentiles, SQL queries and memory per endpoint, saved as JSON and optionally "
+        "compared with an earlier run. Changes made by the requests are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Timed requests per endpoint")
+        parser.add_argument('--only', action='append', choices=sorted(SCENARIOS),
+                            help="Only this endpoint (repeatable)")
+        parser.add_argument('--output', default=None,
+                            help="Where to write the results (default bench-results/endpoints-<time>.json)")
+        parser.add_argument('--compare', default=None, help="Earlier results file to compare against")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Relative growth of a metric reported as a regression")
+        parser.add_argument('--fail-on-regression', action='store_true')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError("--requests must be at least 1")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        try:
+            with transaction.atomic():
+                results = self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+        output = options['output'] or os.path.join(
+            'bench-results', f"endpoints-{timezone.now():%Y%m%d-%H%M%S}.json"
+        )
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        self.stdout.write(f"Results written to {output}")
+
+        if baseline is not None:
+            regressions = self.compare(baseline, results, options['tolerance'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"{len(regressions)} regressions against {options['compare']}")
+
+    def run(self, options):
+        rng = random.Random(options['seed'])
+        dataset = {model._meta.label: model.objects.count() for model in DATASET_MODELS}
+        sample = Sample(rng)
+        user = User.objects.create(username='bench-endpoints', is_staff=True, is_superuser=True)
+        factory = APIRequestFactory()
+
+        endpoints = {}
+        for name in options['only'] or SCENARIOS:
+            endpoints[name] = self.measure(name, SCENARIOS[name], sample, factory, user, options['requests'])
+            result = endpoints[name]
+            self.stdout.write(
+                f"{name:26} p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+                f"queries {result['queries_mean']:5.1f} (max {result['queries_max']})  "
+                f"peak {result['peak_alloc_kb']:8.0f} KB  status {result['status']}"
+            )
+        return {
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'requests': options['requests'],
+            'dataset': dataset,
+            'endpoints': endpoints,
+        }
+
+    def call(self, scenario, sample, factory, user):
+        method, path, body = scenario(sample)
+        match = resolve(path.partition('?')[0], urlconf='api.urls')
+        if method == 'GET':
+            request = factory.get(f"/api{path}")
+        else:
+            request = factory.post(f"/api{path}", body, format='json')
+        force_authenticate(request, user=user)
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        return f"/api/{match.route}", response
+
+    def measure(self, name, scenario, sample, factory, user, n_requests):
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # The first request fills whatever caches the endpoint has
+        t0 = time.perf_counter()
+        route, _ = self.call(scenario, sample, factory, user)
+        cold = time.perf_counter() - t0
+
+        latencies, queries, sizes, status = [], [], [], {}
+        for _ in range(n_requests):
+            with CaptureQueriesContext(connection) as captured:
+                t0 = time.perf_counter()
+                _, response = self.call(scenario, sample, factory, user)
+                latencies.append(time.perf_counter() - t0)
+            queries.append(len(captured))
+            sizes.append(len(response.content))
+            status[str(response.status_code)] = status.get(str(response.status_code), 0) + 1
+
+        peak = 0
+        tracemalloc.start()
+        try:
+            for _ in range(min(TRACED_REQUESTS, n_requests)):
+                tracemalloc.reset_peak()
+                self.call(scenario, sample, factory, user)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+
+        latencies.sort()
+        return {
+            'route': route,
+            'requests': n_requests,
+            'status': status,
+            'cold_ms': round(cold * 1000, 3),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+            'p90_ms': round(percentile(latencies, 0.9) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+            'queries_mean': round(sum(queries) / len(queries), 2),
+            'queries_max': max(queries),
+            'response_bytes': round(sum(sizes) / len(sizes)),
+            'peak_alloc_kb': round(peak / 1024, 1),
+            # ru_maxrss is in kilobytes on Linux
+            'rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+        }
+
+    def compare(self, baseline, results, tolerance):
+        regressions = []
+        for name, result in results['endpoints'].items():
+            before = baseline.get('endpoints', {}).get(name)
+            if before is None:
+                continue
+            for metric, floor in REGRESSION_FLOOR.items():
+                old, new = before.get(metric), result.get(metric)
+                if old is None or new is None:
+                    continue
+                if new > old * (1 + tolerance) and new - old > floor:
+                    regressions.append((name, metric, old, new))
+
+        if baseline.get('dataset') != results['dataset']:
+            self.stdout.write(self.style.WARNING("The dataset differs from the baseline run"))
+        for name, metric, old, new in regressions:
+            self.stdout.write(self.style.ERROR(f"REGRESSION {name} {metric}: {old} -> {new}"))
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS(f"No regressions against the baseline ({tolerance:.0%} tolerance)"))
+        return regressions
@@ -0,0 +1,77 @@
+import json
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.models import Bus
+from api.views import update_bus_locations
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Measure GPS ingest throughput through /api/bus/location/update/ (changes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buses', type=int, default=500)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--batches', type=int, default=40)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['buses'], options['batch_size'], options['batches'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, n_buses, batch_size, n_batches):
+        buses = Bus.objects.bulk_create(
+            Bus(number=f"BENCH-{i}", capacity=50) for i in range(n_buses)
+        )
+        bus_ids = [bus.id for bus in buses]
+        user = User.objects.create(username='bench-ingest')
+        factory = APIRequestFactory()
+
+        # Pre-encode the request bodies so only the endpoint is timed
+        start = time.time() - n_batches * 5
+        bodies = []
+        for b in range(n_batches):
+            fixes = []
+            for i in range(batch_size):
+                fixes.append({
+                    'bus_id': random.choice(bus_ids),
+                    'latitude': 37.7 + random.random() * 0.1,
+                    'longitude': -122.4 + random.random() * 0.1,
+                    'speed': random.uniform(0, 60),
+                    'heading': random.uniform(0, 359),
+                    # Mix in some stale and duplicate fixes
+                    'timestamp': start + b * 5 + random.choice([0, 0, 0, -10, i * 0.001]),
+                })
+            bodies.append(json.dumps({'fixes': fixes}))
+
+        latencies = []
+        updated = 0
+        began = time.perf_counter()
+        for body in bodies:
+            request = factory.post('/api/bus/location/update/', body, content_type='application/json')
+            force_authenticate(request, user=user)
+            t0 = time.perf_counter()
+            response = update_bus_locations(request)
+            latencies.append(time.perf_counter() - t0)
+            updated += response.data['updated']
+        elapsed = time.perf_counter() - began
+
+        latencies.sort()
+        total = n_batches * batch_size
+        self.stdout.write(f"{total} fixes in {n_batches} batches of {batch_size} for {n_buses} buses")
+        self.stdout.write(f"throughput: {total / elapsed:,.0f} fixes/s")
+        self.stdout.write(f"batch latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+                          f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+        self.stdout.write(f"rows written: {updated}")
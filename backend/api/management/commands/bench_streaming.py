@@ -0,0 +1,222 @@
+import asyncio
+import json
+import random
+import resource
+import time
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.streaming import broadcaster, issue_ticket
+
+
+# Longest wait for every stream to deliver its snapshot
+CONNECT_TIMEOUT = 120
+
+
+def _percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1000
+
+
+class Command(BaseCommand):
+    help = ("Load test live location streams: hold many SSE connections open against a running ASGI server "
+            "and publish fleet updates to them through Redis")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help="Base URL of the running server")
+        parser.add_argument('--connections', type=int, default=2000)
+        parser.add_argument('--connect-concurrency', type=int, default=200,
+                            help="Connections being opened at the same time")
+        parser.add_argument('--buses', type=int, default=800)
+        parser.add_argument('--routes', type=int, default=50)
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--interval', type=float, default=0.5,
+                            help="Seconds between published batches (a full fleet report each)")
+        parser.add_argument('--slow-fraction', type=float, default=0.1,
+                            help="Share of clients that only read once a second")
+        parser.add_argument('--server-pid', type=int, help="Report this server process's memory (Linux)")
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'STREAM_REDIS_URL', None):
+            raise CommandError("STREAM_REDIS_URL is not set, so the server would not hear what this command "
+                               "publishes")
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError("Only plain http:// servers are supported")
+        self.host, self.port = url.hostname, url.port or 80
+        self.path = url.path.rstrip('/') + '/api/buses/stream/'
+        self.user = User.objects.filter(is_active=True, is_superuser=True).first()
+        if self.user is None:
+            raise CommandError("Create an active superuser to open the streams as")
+
+        # One descriptor per connection
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        if options['connections'] + 100 > hard:
+            raise CommandError(f"The open file limit ({hard}) is too low for {options['connections']} connections")
+        asyncio.run(self.run(options))
+
+    async def read_body(self, reader, chunked):
+        if not chunked:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                yield data
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                return
+            yield (await reader.readexactly(size + 2))[:-2]
+
+    async def connect(self, query):
+        """Open a stream and return (reader, writer, chunked) once the response headers are in."""
+        query = {**query, 'ticket': await asyncio.to_thread(issue_ticket, self.user)}
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(
+            f"GET {self.path}?{urlencode(query)} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Accept: text/event-stream\r\n\r\n".encode()
+        )
+        status_line = await reader.readline()
+        if b' 200 ' not in status_line:
+            writer.close()
+            raise ConnectionError(status_line.decode(errors='replace').strip())
+        chunked = False
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'transfer-encoding:') and b'chunked' in line.lower():
+                chunked = True
+        return reader, writer, chunked
+
+    async def run(self, options):
+        n_buses, n_routes = options['buses'], options['routes']
+        bus_routes = {bus_id: bus_id % n_routes for bus_id in range(1, n_buses + 1)}
+        positions = {bus_id: (37.6 + random.random() * 0.4, -122.5 + random.random() * 0.4)
+                     for bus_id in bus_routes}
+
+        connect_times = []
+        latencies = []
+        delivered = [0]
+        failures = []
+        open_streams = [0]
+        gate = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def client(i, connected):
+            kind = i % 3
+            if kind == 0:
+                query = {'buses': ','.join(str(b) for b in random.sample(list(bus_routes), 3))}
+            elif kind == 1:
+                query = {'route': random.randrange(n_routes)}
+            else:
+                lat, lon = 37.6 + random.random() * 0.35, -122.5 + random.random() * 0.35
+                query = {'bbox': f"{lat},{lon},{lat + 0.05},{lon + 0.05}"}
+            slow = random.random() < options['slow_fraction']
+            start = time.perf_counter()
+            try:
+                async with gate:
+                    reader, writer, chunked = await self.connect(query)
+            except (OSError, ConnectionError) as e:
+                failures.append(str(e))
+                connected.set_result(None)
+                return
+            open_streams[0] += 1
+            buffer = b''
+            try:
+                async for data in self.read_body(reader, chunked):
+                    buffer += data
+                    *events, buffer = buffer.split(b'\n\n')
+                    now = time.time()
+                    for event in events:
+                        if event.startswith(b'event: snapshot'):
+                            connect_times.append(time.perf_counter() - start)
+                            if not connected.done():
+                                connected.set_result(None)
+                        elif event.startswith(b'data: '):
+                            updates = json.loads(event[6:])
+                            delivered[0] += len(updates)
+                            if not slow and random.random() < 0.02:
+                                latencies.extend(now - update['sent'] for update in updates[:5])
+                    if slow:
+                        await asyncio.sleep(1)
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                failures.append(str(e))
+            finally:
+                open_streams[0] -= 1
+                writer.close()
+                if not connected.done():
+                    connected.set_result(None)
+
+        began = time.perf_counter()
+        tasks, ready = [], []
+        for i in range(options['connections']):
+            connected = asyncio.get_running_loop().create_future()
+            ready.append(connected)
+            tasks.append(asyncio.create_task(client(i, connected)))
+        await asyncio.wait(ready, timeout=CONNECT_TIMEOUT)
+        self.stdout.write(f"{open_streams[0]} of {options['connections']} streams open after "
+                          f"{time.perf_counter() - began:.1f} s, {len(failures)} failed")
+        if failures:
+            self.stdout.write(f"  first failure: {failures[0]}")
+        server_rss = self.server_rss(options['server_pid'])
+        if server_rss:
+            self.stdout.write(f"server RSS {server_rss / 1024:.0f} MB")
+
+        publish_times = []
+        began = time.perf_counter()
+        for _ in range(options['rounds']):
+            updates = []
+            sent = time.time()
+            for bus_id, (lat, lon) in positions.items():
+                lat += random.uniform(-0.0005, 0.0005)
+                lon += random.uniform(-0.0005, 0.0005)
+                positions[bus_id] = (lat, lon)
+                updates.append({
+                    'bus_id': bus_id, 'route_id': bus_routes[bus_id],
+                    'latitude': lat, 'longitude': lon, 'speed': 10, 'heading': 0,
+                    'timestamp': timezone.now(), 'sent': sent,
+                })
+            t0 = time.perf_counter()
+            # Off the loop, so the clients keep reading while Redis is called
+            await asyncio.to_thread(broadcaster.publish, updates)
+            publish_times.append(time.perf_counter() - t0)
+            await asyncio.sleep(options['interval'])
+        await asyncio.sleep(1.5)
+        elapsed = time.perf_counter() - began
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        connect_times.sort()
+        latencies.sort()
+        published = options['rounds'] * n_buses
+        if connect_times:
+            self.stdout.write(f"time to snapshot p50 {_percentile(connect_times, 0.5):.1f} ms, "
+                              f"p99 {_percentile(connect_times, 0.99):.1f} ms")
+        self.stdout.write(f"published {published} updates in {options['rounds']} batches over {elapsed:.1f} s")
+        self.stdout.write(f"received {delivered[0]} coalesced updates ({delivered[0] / elapsed:,.0f}/s)")
+        if latencies:
+            # From the publish call to the event being parsed here, through Redis and the server
+            self.stdout.write(f"delivery latency to fast clients p50 {_percentile(latencies, 0.5):.1f} ms, "
+                              f"p99 {_percentile(latencies, 0.99):.1f} ms")
+        self.stdout.write(f"publish call p50 {_percentile(sorted(publish_times), 0.5):.2f} ms")
+        server_rss = self.server_rss(options['server_pid'])
+        if server_rss:
+            self.stdout.write(f"server RSS {server_rss / 1024:.0f} MB")
+
+    def server_rss(self, pid):
+        """Resident memory of `pid` in kB, from /proc."""
+        if pid is None:
+            return None
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            return None
@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.eta import learn_speed_profiles
+
+
+class Command(BaseCommand):
+    help = "Learn per-segment, per-hour route speeds from location history for the ETA engine"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=28,
+                            help="Use history from this many days back")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days'])
+        written = learn_speed_profiles(since, log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} segment speeds"))
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from api.history import downsample, RAW_RETENTION, MINUTE_RETENTION
+
+
+class Command(BaseCommand):
+    help = "Roll old raw location history into per-minute rows and expire old rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--raw-days', type=int, default=RAW_RETENTION.days,
+                            help="Keep raw fixes for this many days")
+        parser.add_argument('--minute-days', type=int, default=MINUTE_RETENTION.days,
+                            help="Keep per-minute rows for this many days")
+
+    def handle(self, *args, **options):
+        minutes, expired = downsample(
+            raw_retention=timedelta(days=options['raw_days']),
+            minute_retention=timedelta(days=options['minute_days']),
+            log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {minutes} minute rows, expired {expired} old rows"
+        ))
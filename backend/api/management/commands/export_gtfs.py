@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from api.gtfs import export_feed
+
+
+class Command(BaseCommand):
+    help = "Write all stations, routes and schedules out as a GTFS zip"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the zip to write")
+        parser.add_argument('--agency-name', default='Bus Routes')
+        parser.add_argument('--agency-url', default='https://example.com')
+
+    def handle(self, *args, **options):
+        counts = export_feed(
+            options['output'],
+            agency_name=options['agency_name'],
+            agency_url=options['agency_url'],
+            log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Exported {counts}"))
@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.arrivals import fill_actual_times
+
+
+class Command(BaseCommand):
+    help = "Fill actual arrival and departure times on scheduled stops from the station event log"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=60,
+                            help="Use events from this many minutes back; overlapping runs are harmless")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(minutes=options['minutes'])
+        updated = fill_actual_times(since, log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} scheduled stops"))
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.synthetic import build_city
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with a synthetic network (stations, routes with shapes, buses, "
+        "days of schedules, bookings and alerts) for benchmarking. Adds to what is there; "
+        "use a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stations', type=int, default=2000)
+        parser.add_argument('--routes', type=int, default=100)
+        parser.add_argument('--stops-per-route', type=int, default=25)
+        parser.add_argument('--points-per-segment', type=int, default=8,
+                            help="Shape points traced between consecutive stops")
+        parser.add_argument('--buses-per-route', type=int, default=8)
+        parser.add_argument('--days', type=int, default=3,
+                            help="Service days of schedules, starting today")
+        parser.add_argument('--headway', type=int, default=15, help="Minutes between trips on a route")
+        parser.add_argument('--bookings', type=int, default=200000)
+        parser.add_argument('--alerts', type=int, default=50000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['stops_per_route'] < 2 or options['stations'] < options['stops_per_route']:
+            raise CommandError("Routes need at least two stops, and no more than there are stations")
+        if options['routes'] < 1 or options['buses_per_route'] < 1 or options['headway'] < 1:
+            raise CommandError("routes, buses-per-route and headway must be at least 1")
+        if options['bookings'] and options['users'] < 1:
+            raise CommandError("Bookings need at least one user")
+
+        t0 = time.perf_counter()
+        counts = build_city(
+            stations=options['stations'],
+            routes=options['routes'],
+            stops_per_route=options['stops_per_route'],
+            points_per_segment=options['points_per_segment'],
+            buses_per_route=options['buses_per_route'],
+            days=options['days'],
+            headway_minutes=options['headway'],
+            bookings=options['bookings'],
+            alerts=options['alerts'],
+            users=options['users'],
+            seed=options['seed'],
+            log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Generated {counts} in {time.perf_counter() - t0:.1f} s"))
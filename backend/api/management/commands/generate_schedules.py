@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import ScheduleTemplate
+from api.schedule_templates import generate, TemplateError
+
+
+class Command(BaseCommand):
+    help = "Expand active schedule templates into schedules for the coming days (unchanged days are skipped)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7)
+        parser.add_argument('--template', type=int, action='append',
+                            help="Only this template id (repeatable)")
+
+    def handle(self, *args, **options):
+        # Inactive templates are included so their future days get removed
+        templates = ScheduleTemplate.objects.all()
+        if options['template']:
+            templates = templates.filter(id__in=options['template'])
+        start_date = timezone.localdate()
+        for template in templates:
+            try:
+                result = generate(template, start_date, options['days'])
+            except TemplateError as e:
+                self.stderr.write(f"{template.name}: {e}")
+                continue
+            self.stdout.write(
+                f"{template.name}: {result['created']} new, {result['replaced']} replaced, "
+                f"{result['unchanged']} unchanged, {result['removed']} removed, "
+                f"{result['locked']} kept for bookings; {result['stop_times']} stop times written"
+            )
@@ -0,0 +1,31 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.gtfs import import_feed, GtfsError
+
+
+class Command(BaseCommand):
+    help = "Import stops, routes, shapes, trips and stop times from a GTFS zip, expanded over a date window"
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', help="Path to the GTFS zip")
+        parser.add_argument('--start-date', type=date.fromisoformat, default=None,
+                            help="First service date to import (YYYY-MM-DD, default today)")
+        parser.add_argument('--days', type=int, default=7)
+        parser.add_argument('--bus-capacity', type=int, default=50,
+                            help="Capacity of the buses created for imported trips")
+
+    def handle(self, *args, **options):
+        try:
+            counts = import_feed(
+                options['feed'],
+                options['start_date'] or timezone.localdate(),
+                days=options['days'],
+                bus_capacity=options['bus_capacity'],
+                log=self.stdout.write,
+            )
+        except GtfsError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Imported {counts}"))
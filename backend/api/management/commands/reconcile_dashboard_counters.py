@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from api.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = "Recompute the admin dashboard counters from the source tables, fixing any drift"
+
+    def handle(self, *args, **options):
+        drift = reconcile()
+        for key, (old, new) in sorted(drift.items()):
+            self.stdout.write(f"{key}: {old} -> {new}")
+        self.stdout.write(self.style.SUCCESS(f"Reconciled dashboard counters, {len(drift)} corrected"))
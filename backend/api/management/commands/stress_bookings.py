@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api import seats
+from api.models import Booking, Bus, Schedule, Station, StationSchedule
+from api.views import create_booking
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire many parallel bookings at one schedule through /api/bookings/ and check "
+        "that no leg is oversold. Creates its own data and deletes it afterwards; run it "
+        "against a database with real row locks (PostgreSQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=3000)
+        parser.add_argument('--workers', type=int, default=32)
+        parser.add_argument('--capacity', type=int, default=50)
+        parser.add_argument('--stops', type=int, default=20)
+        parser.add_argument('--max-p99-ms', type=float, default=500,
+                            help="Fail if the 99th percentile request latency is above this")
+
+    def handle(self, *args, **options):
+        n_stops = options['stops']
+        bus = Bus.objects.create(number='STRESS-SEATS', capacity=options['capacity'])
+        stations = Station.objects.bulk_create(
+            Station(name=f"Stress {i}", address='', latitude=37.7, longitude=-122.4 + i * 0.01, capacity=0)
+            for i in range(n_stops)
+        )
+        now = timezone.now()
+        schedule = Schedule.objects.create(
+            bus=bus, start_station=stations[0], end_station=stations[-1],
+            departure_time=now + timedelta(hours=1), arrival_time=now + timedelta(hours=3)
+        )
+        StationSchedule.objects.bulk_create(
+            StationSchedule(schedule=schedule, station=station, order=i)
+            for i, station in enumerate(stations)
+        )
+        user = User.objects.create(username='stress-seats')
+
+        try:
+            results = self.fire(schedule, stations, user, options['bookings'], options['workers'])
+            self.check(schedule, stations, options, results)
+        finally:
+            Booking.objects.filter(schedule=schedule).delete()
+            bus.delete()
+            Station.objects.filter(id__in=[s.id for s in stations]).delete()
+            user.delete()
+
+    def fire(self, schedule, stations, user, n_bookings, n_workers):
+        factory = APIRequestFactory()
+        n_stops = len(stations)
+        requests = []
+        for _ in range(n_bookings):
+            i = random.randrange(n_stops - 1)
+            j = random.randrange(i + 1, n_stops)
+            requests.append({
+                'schedule': schedule.id,
+                'boarding_station': stations[i].id,
+                'destination_station': stations[j].id,
+            })
+
+        start = threading.Barrier(n_workers)
+
+        def worker(chunk):
+            start.wait()
+            out = []
+            try:
+                for body in chunk:
+                    request = factory.post('/api/bookings/', body, format='json')
+                    force_authenticate(request, user=user)
+                    t0 = time.perf_counter()
+                    response = create_booking(request)
+                    out.append((response.status_code, time.perf_counter() - t0))
+            finally:
+                connection.close()
+            return out
+
+        chunks = [requests[k::n_workers] for k in range(n_workers)]
+        began = time.perf_counter()
+        with ThreadPoolExecutor(n_workers) as pool:
+            results = [r for chunk in pool.map(worker, chunks) for r in chunk]
+        elapsed = time.perf_counter() - began
+        self.stdout.write(f"{n_bookings} requests from {n_workers} workers in {elapsed:.2f} s "
+                          f"({n_bookings / elapsed:,.0f}/s)")
+        return results
+
+    def check(self, schedule, stations, options, results):
+        codes = {}
+        for code, _ in results:
+            codes[code] = codes.get(code, 0) + 1
+        latencies = sorted(latency for _, latency in results)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        self.stdout.write(f"responses: {codes}")
+        self.stdout.write(f"latency p50 {p50:.1f} ms, p99 {p99:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+        unexpected = set(codes) - {201, 409}
+        if unexpected:
+            raise CommandError(f"Unexpected response codes: {sorted(unexpected)}")
+
+        # Recount every leg from the committed bookings
+        stops = seats.load_stops(schedule.id)
+        counted = seats.count_bookings(schedule.id, stops)
+        capacity = options['capacity']
+        oversold = [leg for leg, taken in enumerate(counted) if taken > capacity]
+        sold = Booking.objects.filter(schedule=schedule).count()
+        self.stdout.write(f"{sold} seats sold, busiest leg carries {max(counted)} of {capacity}")
+        if sold != codes.get(201, 0):
+            raise CommandError(f"{codes.get(201, 0)} bookings confirmed but {sold} stored")
+        if oversold:
+            raise CommandError(f"Oversold legs: {oversold}")
+        if list(seats.availability(schedule.id, stops)) != list(counted):
+            raise CommandError("Seat inventory does not match the bookings")
+        if p99 > options['max_p99_ms']:
+            raise CommandError(f"p99 latency {p99:.1f} ms is above {options['max_p99_ms']} ms")
+        self.stdout.write(self.style.SUCCESS("No oversold legs"))
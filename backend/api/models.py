@@ -7,6 +7,8 @@ class Station(models.Model):
     latitude = models.FloatField()
     longitude = models.FloatField()
     capacity = models.IntegerField()
+    # stop_id in the GTFS feed this station was imported from
+    gtfs_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -16,6 +18,7 @@ class Station(models.Model):
 class Route(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
+    gtfs_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -34,6 +37,18 @@ class RoutePoint(models.Model):
     def __str__(self):
         return f"{self.route.name} - Point {self.order}"
 
+class RouteShape(models.Model):
+    # RoutePoints encoded as polylines at several simplification tolerances,
+    # {"<tolerance m>": {"polyline": ..., "points": n}}; see polyline.py
+    route = models.OneToOneField(Route, related_name='shape', on_delete=models.CASCADE, primary_key=True)
+    levels = models.JSONField()
+    # Latitude of the first point, for turning a map zoom into metres
+    latitude = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Shape of {self.route.name}"
+
 class BusType(models.TextChoices):
     REGULAR = 'regular', 'Regular'
     FAST = 'fast', 'Fast'
@@ -45,6 +60,8 @@ class Bus(models.Model):
     capacity = models.IntegerField()
     route = models.ForeignKey(Route, related_name='buses', on_delete=models.SET_NULL, null=True)
     is_active = models.BooleanField(default=True)
+    # GTFS has no vehicles; imported trips run on one bus per route and block
+    gtfs_id = models.CharField(max_length=200, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -58,9 +75,25 @@ class Schedule(models.Model):
     departure_time = models.DateTimeField()
     arrival_time = models.DateTimeField()
     is_active = models.BooleanField(default=True)
+    # Set on schedules expanded from a ScheduleTemplate
+    template = models.ForeignKey('ScheduleTemplate', related_name='schedules', on_delete=models.SET_NULL,
+                                 null=True, blank=True)
+    service_date = models.DateField(null=True, blank=True)
+    # trip_id of the GTFS trip this schedule is one day's run of
+    gtfs_trip_id = models.CharField(max_length=100, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            # Regeneration replaces one template's trips day by day
+            models.Index(fields=['template', 'service_date']),
+            models.Index(fields=['service_date', 'gtfs_trip_id']),
+            # Admin listing pages by departure, optionally for one bus
+            models.Index(fields=['departure_time']),
+            models.Index(fields=['bus', 'departure_time']),
+        ]
+    
     def __str__(self):
         return f"{self.bus.number}: {self.start_station.name} to {self.end_station.name}"
 
@@ -70,9 +103,16 @@ class StationSchedule(models.Model):
     arrival_time = models.DateTimeField(null=True, blank=True)
     departure_time = models.DateTimeField(null=True, blank=True)
     order = models.IntegerField()
+    # Filled in from StationEvent by arrivals.fill_actual_times()
+    actual_arrival_time = models.DateTimeField(null=True, blank=True)
+    actual_departure_time = models.DateTimeField(null=True, blank=True)
     
     class Meta:
         ordering = ['order']
+        indexes = [
+            # Boarding lookups in search start from the station
+            models.Index(fields=['station', 'schedule', 'order']),
+        ]
     
     def __str__(self):
         return f"{self.schedule.bus.number} at {self.station.name}"
@@ -88,6 +128,126 @@ class BusLocation(models.Model):
     def __str__(self):
         return f"Location of {self.bus.number}"
 
+class BusLocationHistory(models.Model):
+    # Append-only log of every fix. Coordinates are stored as integer
+    # microdegrees and speed/heading as small ints to keep rows narrow.
+    id = models.BigAutoField(primary_key=True)
+    bus = models.ForeignKey(Bus, related_name='location_history', on_delete=models.CASCADE)
+    timestamp = models.DateTimeField()
+    lat_e6 = models.IntegerField()
+    lon_e6 = models.IntegerField()
+    speed = models.SmallIntegerField(default=0)
+    heading = models.SmallIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            # Doubles as the index for "bus X between t1 and t2" range scans
+            models.UniqueConstraint(fields=['bus', 'timestamp'], name='unique_bus_fix_time'),
+        ]
+        indexes = [
+            # Lets the rollup job walk all buses by time
+            models.Index(fields=['timestamp']),
+        ]
+    
+    @property
+    def latitude(self):
+        return self.lat_e6 / 1e6
+    
+    @property
+    def longitude(self):
+        return self.lon_e6 / 1e6
+    
+    def __str__(self):
+        return f"Bus {self.bus_id} at {self.timestamp}"
+
+class BusLocationMinute(models.Model):
+    # Per-minute rollup of BusLocationHistory, kept after raw fixes expire
+    id = models.BigAutoField(primary_key=True)
+    bus = models.ForeignKey(Bus, related_name='location_minutes', on_delete=models.CASCADE)
+    minute = models.DateTimeField()
+    lat_e6 = models.IntegerField()
+    lon_e6 = models.IntegerField()
+    avg_speed = models.SmallIntegerField()
+    max_speed = models.SmallIntegerField()
+    fixes = models.SmallIntegerField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bus', 'minute'], name='unique_bus_minute'),
+        ]
+    
+    @property
+    def latitude(self):
+        return self.lat_e6 / 1e6
+    
+    @property
+    def longitude(self):
+        return self.lon_e6 / 1e6
+    
+    def __str__(self):
+        return f"Bus {self.bus_id} during {self.minute}"
+
+class StationEvent(models.Model):
+    # Append-only log of buses arriving at and leaving stations, derived from
+    # the sightings the stations' receivers report. Rows are never updated.
+    ARRIVAL = 'arrival'
+    DEPARTURE = 'departure'
+    KIND_CHOICES = [
+        (ARRIVAL, 'Arrival'),
+        (DEPARTURE, 'Departure'),
+    ]
+    
+    id = models.BigAutoField(primary_key=True)
+    station = models.ForeignKey(Station, related_name='events', on_delete=models.CASCADE)
+    bus = models.ForeignKey(Bus, related_name='station_events', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    timestamp = models.DateTimeField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            # fill_actual_times() walks recent events by time
+            models.Index(fields=['timestamp']),
+        ]
+    
+    def __str__(self):
+        return f"Bus {self.bus_id} {self.kind} at station {self.station_id} at {self.timestamp}"
+
+class StationVisit(models.Model):
+    # A bus a station's receiver currently hears: when it was last heard and
+    # whether its arrival has been logged. Deleted when the bus leaves.
+    # Reports lock the station row before reading these.
+    station = models.ForeignKey(Station, related_name='visits', on_delete=models.CASCADE)
+    bus = models.ForeignKey(Bus, related_name='station_visits', on_delete=models.CASCADE)
+    seen = models.DateTimeField()
+    arrived = models.BooleanField(default=False)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['station', 'bus'], name='unique_station_visit'),
+        ]
+    
+    def __str__(self):
+        return f"Bus {self.bus_id} at station {self.station_id}"
+
+class SegmentSpeed(models.Model):
+    # Learned average speed over one fixed-length stretch of a route during
+    # one hour of the day, used by the ETA engine
+    route = models.ForeignKey(Route, related_name='segment_speeds', on_delete=models.CASCADE)
+    segment = models.IntegerField()
+    hour = models.SmallIntegerField()
+    speed = models.FloatField()  # m/s
+    samples = models.IntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['route', 'segment', 'hour'], name='unique_route_segment_hour'),
+        ]
+    
+    def __str__(self):
+        return f"{self.route.name} segment {self.segment} at {self.hour}:00"
+
 class Alert(models.Model):
     ALERT_TYPES = [
         ('delay', 'Delay'),
@@ -104,6 +264,15 @@ class Alert(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            # Admin listing pages newest first, optionally filtered
+            models.Index(fields=['-created_at']),
+            models.Index(fields=['is_resolved', '-created_at']),
+            models.Index(fields=['bus', '-created_at']),
+            models.Index(fields=['station', '-created_at']),
+        ]
+    
     def __str__(self):
         return f"{self.alert_type} alert for {self.bus or self.station}"
 
@@ -114,6 +283,89 @@ class Booking(models.Model):
     destination_station = models.ForeignKey(Station, related_name='destinations', on_delete=models.CASCADE)
     booking_time = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, default='confirmed')
+    # Stop orders the seat is held between; empty on bookings made before
+    # seat inventory existed
+    boarding_order = models.IntegerField(null=True, blank=True)
+    destination_order = models.IntegerField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Booking by {self.user.username} for {self.schedule.bus.number}"
+
+class DashboardCounter(models.Model):
+    # Running totals behind the admin dashboard, kept current by signals.
+    # Hot counters are spread over a few shards so concurrent writers do not
+    # all queue on one row; a counter's value is the sum of its shards.
+    key = models.CharField(max_length=50)
+    shard = models.SmallIntegerField(default=0)
+    value = models.BigIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['key', 'shard'], name='unique_counter_shard'),
+        ]
+    
+    def __str__(self):
+        return f"{self.key}[{self.shard}] = {self.value}"
+
+class SeatInventory(models.Model):
+    # Seats taken on each leg of a schedule, as a packed array of unsigned
+    # 16-bit counts: entry i covers the ride from stop i to stop i + 1.
+    # Bookings lock this row, so it is the single point of truth for sales.
+    schedule = models.OneToOneField(Schedule, related_name='seat_inventory', on_delete=models.CASCADE,
+                                    primary_key=True)
+    occupancy = models.BinaryField()
+    version = models.IntegerField(default=0)
+    
+    def __str__(self):
+        return f"Seats on schedule {self.schedule_id} (v{self.version})"
+
+class ScheduleTemplate(models.Model):
+    # A repeating service: one stop pattern run every headway_minutes from
+    # first_departure to last_departure on the listed weekdays, spread over
+    # the template's buses. Expanded into Schedule rows by
+    # schedule_templates.generate().
+    name = models.CharField(max_length=100)
+    route = models.ForeignKey(Route, related_name='schedule_templates', on_delete=models.CASCADE,
+                              null=True, blank=True)
+    buses = models.ManyToManyField(Bus, related_name='schedule_templates')
+    first_departure = models.TimeField()
+    last_departure = models.TimeField()
+    headway_minutes = models.PositiveIntegerField()
+    weekdays = models.CharField(max_length=7, default='0123456')  # Monday is 0
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return self.name
+
+class TemplateStop(models.Model):
+    template = models.ForeignKey(ScheduleTemplate, related_name='stops', on_delete=models.CASCADE)
+    station = models.ForeignKey(Station, on_delete=models.CASCADE)
+    order = models.IntegerField()
+    # Seconds after the trip leaves its first stop
+    arrival_offset = models.IntegerField()
+    departure_offset = models.IntegerField()
+    
+    class Meta:
+        ordering = ['order']
+    
+    def __str__(self):
+        return f"{self.template.name} stop {self.order}"
+
+class ScheduleTemplateDay(models.Model):
+    # Fingerprint of what a template expanded to on one date, so regeneration
+    # can leave unchanged days alone
+    template = models.ForeignKey(ScheduleTemplate, related_name='days', on_delete=models.CASCADE)
+    service_date = models.DateField()
+    fingerprint = models.CharField(max_length=64)
+    trips = models.IntegerField()
+    generated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['template', 'service_date'], name='unique_template_day'),
+        ]
     
     def __str__(self):
-        return f"Booking by {self.user.username} for {self.schedule.bus.number}"
\ No newline at end of file
+        return f"{self.template.name} on {self.service_date}"
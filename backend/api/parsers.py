@@ -0,0 +1,32 @@
+"""
+Request body parsers.
+
+The GPS trackers upload their backlog gzip-compressed; DRF ignores
+Content-Encoding, so the body is inflated here before it is parsed as JSON.
+Inflation stops at MAX_INFLATED_BYTES so a small hostile body cannot expand
+without limit.
+"""
+import gzip
+import io
+import zlib
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+# Well above a full batch of 5000 fixes
+MAX_INFLATED_BYTES = 16 * 1024 * 1024
+
+
+class GzipJSONParser(JSONParser):
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = (parser_context or {}).get('request')
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '') if request is not None else ''
+        if encoding.strip().lower() == 'gzip':
+            try:
+                data = gzip.GzipFile(fileobj=stream).read(MAX_INFLATED_BYTES + 1)
+            except (OSError, EOFError, zlib.error):
+                raise ParseError("Malformed gzip body")
+            if len(data) > MAX_INFLATED_BYTES:
+                raise ParseError("Request body is too large once inflated")
+            stream = io.BytesIO(data)
+        return super().parse(stream, media_type, parser_context)
@@ -0,0 +1,174 @@
+"""
+Compact route geometry for clients.
+
+Each route's RoutePoints are simplified with Douglas-Peucker at a few fixed
+tolerances and every level is stored as a Google encoded polyline on a
+RouteShape row. A row is dropped when its route's points change and rebuilt
+by the next read, so serving geometry is one row read with no per-point
+work. Clients pick a level with a tolerance in metres, or with the map zoom
+they draw at.
+"""
+import math
+
+import numpy as np
+
+from .geometry import EARTH_RADIUS_M
+from .models import RoutePoint, RouteShape
+
+# Simplification tolerances in metres; 0 keeps every point
+LEVELS = [0, 2, 8, 32, 128]
+
+PRECISION = 5
+
+
+def encode(lats, lons, precision=PRECISION):
+    """Google encoded polyline for the given coordinates."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lon = 0
+    for lat, lon in zip(lats, lons):
+        lat, lon = round(lat * factor), round(lon * factor)
+        for delta in (lat - prev_lat, lon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return ''.join(out)
+
+
+def decode(encoded, precision=PRECISION):
+    """Inverse of encode(): a list of (lat, lon)."""
+    factor = 10 ** precision
+    coords = []
+    index = lat = lon = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        coords.append((lat / factor, lon / factor))
+    return coords
+
+
+def simplify(lats, lons, tolerance):
+    """Indices of the points Douglas-Peucker keeps at `tolerance` metres."""
+    n = len(lats)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+    lat0 = math.radians(lats[0])
+    x = np.radians(np.asarray(lons) - lons[0]) * math.cos(lat0) * EARTH_RADIUS_M
+    y = np.radians(np.asarray(lats) - lats[0]) * EARTH_RADIUS_M
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = math.hypot(dx, dy)
+        if length > 0:
+            # Distance from the chord, or from its end points beyond them
+            t = np.clip((px * dx + py * dy) / (length * length), 0.0, 1.0)
+            dist = np.hypot(px - t * dx, py - t * dy)
+        else:
+            dist = np.hypot(px, py)
+        worst = int(np.argmax(dist))
+        if dist[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+
+def build_levels(lats, lons):
+    levels = {}
+    for tolerance in LEVELS:
+        kept = simplify(lats, lons, tolerance)
+        levels[str(tolerance)] = {
+            'polyline': encode([lats[i] for i in kept], [lons[i] for i in kept]),
+            'points': len(kept),
+        }
+    return levels
+
+
+def rebuild(route_id):
+    """Recompute and store a route's encoded levels. Returns the RouteShape, or None without points."""
+    points = list(RoutePoint.objects.filter(route_id=route_id).order_by('order').values_list(
+        'latitude', 'longitude'
+    ))
+    if not points:
+        RouteShape.objects.filter(route_id=route_id).delete()
+        return None
+    lats, lons = zip(*points)
+    shape, _ = RouteShape.objects.update_or_create(
+        route_id=route_id, defaults={'levels': build_levels(lats, lons), 'latitude': lats[0]}
+    )
+    return shape
+
+
+def invalidate(route_id):
+    """Drop a route's stored levels; the next read rebuilds them."""
+    RouteShape.objects.filter(route_id=route_id).delete()
+
+
+def get_shapes(route_ids):
+    """{route_id: RouteShape} for routes with points, building any that are missing."""
+    shapes = RouteShape.objects.in_bulk(list(route_ids))
+    for route_id in set(route_ids) - set(shapes):
+        shape = rebuild(route_id)
+        if shape is not None:
+            shapes[route_id] = shape
+    return shapes
+
+
+def tolerance_for_zoom(zoom, latitude=0.0):
+    """Metres per screen pixel at a web map zoom level; detail finer than that is invisible."""
+    return 156543.03392 * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+
+def pick_level(levels, tolerance=None):
+    """The coarsest stored level that is no coarser than `tolerance`."""
+    chosen = '0'
+    if tolerance:
+        for level in LEVELS:
+            if level <= tolerance and str(level) in levels:
+                chosen = str(level)
+    return int(chosen), levels[chosen]
+
+
+def parse_detail(query_params):
+    """
+    ('tolerance', metres) or ('zoom', level) from the query string, or None
+    for full detail. Raises ValueError on bad numbers.
+    """
+    if query_params.get('tolerance') is not None:
+        return ('tolerance', max(float(query_params['tolerance']), 0.0))
+    if query_params.get('zoom') is not None:
+        return ('zoom', min(max(float(query_params['zoom']), 0.0), 30.0))
+    return None
+
+
+def shape_data(shape, detail=None):
+    if shape is None:
+        return None
+    tolerance = None
+    if detail is not None:
+        kind, value = detail
+        tolerance = tolerance_for_zoom(value, shape.latitude) if kind == 'zoom' else value
+    level, data = pick_level(shape.levels, tolerance)
+    return {'polyline': data['polyline'], 'points': data['points'], 'tolerance': level}
@@ -0,0 +1,140 @@
+"""
+Versioned response caching for read-mostly endpoints.
+
+Each cached table has a version counter in the shared cache, bumped by
+signals after a row is saved or deleted. A cached view derives its ETag
+from the versions of the tables it reads, so If-None-Match is answered with
+304 before any query runs. A table change makes every older ETag and cache
+entry unreachable; nothing has to be purged. Rendered bodies are kept per
+process in a bounded LRU, so a hit costs a cache lookup and a dict access.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+MAX_ENTRIES = 256
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def _version_key(model):
+    return f"tables:{model._meta.label_lower}:version"
+
+
+def _initial_version():
+    # Counters start from the clock, so a flushed cache never brings an old
+    # version (and with it an old ETag) back
+    return time.time_ns() // 1000
+
+
+def bump(*models):
+    """Mark the tables of `models` as changed, in every process."""
+    for model in models:
+        key = _version_key(model)
+        cache.add(key, _initial_version(), None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+
+
+def versions(models):
+    keys = [_version_key(model) for model in models]
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        for key in missing:
+            cache.add(key, _initial_version(), None)
+        found.update(cache.get_many(missing))
+    return tuple(found.get(key) for key in keys)
+
+
+class ResponseLRU:
+    """Rendered (body, content_type) pairs by ETag, bounded by count and total size."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, content_type):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (body, content_type)
+            self.size += len(body)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+responses = ResponseLRU()
+
+
+class CachedResponseMixin:
+    """
+    Serve a DRF view's list and retrieve actions from the response cache.
+    cache_models lists every model the response is built from.
+    """
+    cache_models = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, view, request, *args, **kwargs):
+        # The browsable API renders per user and per request; leave it alone
+        if getattr(request.accepted_renderer, 'format', None) == 'api':
+            return view(request, *args, **kwargs)
+
+        variant = f"{type(self).__name__}|{request.get_full_path()}|{request.accepted_media_type}"
+        digest = hashlib.sha1(f"{variant}|{versions(self.cache_models)}".encode()).hexdigest()
+        etag = f'"{digest}"'
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        entry = responses.get(etag)
+        if entry is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = self.get_renderer_context()
+            response.render()
+            entry = (response.content, response['Content-Type'])
+            responses.put(etag, *entry)
+
+        body, content_type = entry
+        response = HttpResponse(body, content_type=content_type)
+        response['ETag'] = etag
+        # Clients must revalidate, which is a cheap 304 while nothing changed
+        response['Cache-Control'] = 'private, no-cache'
+        return response
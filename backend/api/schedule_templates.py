@@ -0,0 +1,287 @@
+"""
+Expand frequency-based schedule templates into Schedule rows.
+
+A template is a stop pattern with run-time offsets, a headway and a window
+of first and last departures. generate() turns it into one Schedule plus
+its StationSchedules per trip and per service date in one transaction:
+schedules with chunked bulk_create, stop times with batched executemany.
+
+Each generated day is fingerprinted, covering the pattern, the timings and
+the buses. Running generate() again rewrites only the days whose
+fingerprint changed, and removes the days the template no longer runs on.
+Days that already have bookings are never rewritten.
+
+Rows are written in bulk without model signals, so the journey planner
+and the ETA engine are told about the change directly.
+"""
+import hashlib
+import heapq
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .eta import eta_engine
+from .journeys import planner
+from .models import Booking, Schedule, ScheduleTemplateDay, SeatInventory, StationSchedule
+
+SCHEDULE_BATCH_SIZE = 1000
+STOP_BATCH_SIZE = 5000
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def departures(template, day):
+    """Local departure times of every trip on `day`, or [] if the template does not run then."""
+    if not template.is_active or str(day.weekday()) not in template.weekdays:
+        return []
+    first = datetime.combine(day, template.first_departure)
+    last = datetime.combine(day, template.last_departure)
+    headway = timedelta(minutes=template.headway_minutes)
+    times = []
+    while first <= last:
+        departure = local_time(first)
+        if departure is not None:
+            times.append(departure)
+        first += headway
+    return times
+
+
+def local_time(naive):
+    """
+    A wall-clock time in the current time zone as an aware datetime, or None
+    if the clock skips it when DST starts. An hour repeated when DST ends is
+    taken at its first occurrence (fold=0).
+    """
+    aware = timezone.make_aware(naive.replace(fold=0))
+    # A time inside the gap comes back moved by the jump. Via UTC, as
+    # astimezone() to the same zone returns the value unchanged.
+    if timezone.localtime(aware.astimezone(dt_timezone.utc)).replace(tzinfo=None) != naive:
+        return None
+    return aware
+
+
+def validate(template, stops, bus_ids):
+    if len(stops) < 2:
+        raise TemplateError("A template needs at least two stops")
+    if not template.headway_minutes:
+        raise TemplateError("Headway must be at least one minute")
+    if template.last_departure < template.first_departure:
+        raise TemplateError("Last departure is before the first departure")
+    if not bus_ids:
+        raise TemplateError("A template needs at least one bus")
+    if stops[0].departure_offset != 0:
+        raise TemplateError("The first stop must depart at offset 0")
+    previous = 0
+    for stop in stops:
+        if stop.arrival_offset < previous or stop.departure_offset < stop.arrival_offset:
+            raise TemplateError(f"Stop {stop.order} is timed before the stop it follows")
+        previous = stop.departure_offset
+
+
+def assign_buses(times, run_seconds, bus_ids):
+    """Give each trip the bus that has been free longest; fail if none has finished its last trip."""
+    if not times:
+        return []
+    free = [(times[0], bus_id) for bus_id in bus_ids]
+    heapq.heapify(free)
+    run = timedelta(seconds=run_seconds)
+    assigned = []
+    for departure in times:
+        free_at, bus_id = heapq.heappop(free)
+        if free_at > departure:
+            raise TemplateError(
+                f"Not enough buses for this headway: the trip at {timezone.localtime(departure):%H:%M} "
+                f"has no bus free"
+            )
+        assigned.append(bus_id)
+        heapq.heappush(free, (departure + run, bus_id))
+    return assigned
+
+
+def fingerprint(template, stops, bus_ids, times):
+    digest = hashlib.sha256()
+    digest.update(repr([(s.station_id, s.order, s.arrival_offset, s.departure_offset) for s in stops]).encode())
+    digest.update(repr(bus_ids).encode())
+    digest.update(repr([t.isoformat() for t in times]).encode())
+    return digest.hexdigest()
+
+
+def _expand(template, stops, bus_ids, day, times):
+    assigned = assign_buses(times, stops[-1].arrival_offset, bus_ids)
+    schedules = []
+    stop_times = []
+    for departure, bus_id in zip(times, assigned):
+        schedules.append(Schedule(
+            bus_id=bus_id,
+            start_station_id=stops[0].station_id,
+            end_station_id=stops[-1].station_id,
+            departure_time=departure,
+            arrival_time=departure + timedelta(seconds=stops[-1].arrival_offset),
+            is_active=True,
+            template=template,
+            service_date=day,
+        ))
+        stop_times.append([
+            (stop.station_id, stop.order,
+             departure + timedelta(seconds=stop.arrival_offset),
+             departure + timedelta(seconds=stop.departure_offset))
+            for stop in stops
+        ])
+    return schedules, stop_times
+
+
+def delete_rows(model, column, ids):
+    """
+    DELETE the rows of `model` whose `column` is in `ids`, as one plain
+    statement: no signals, no cascades. Callers do the bookkeeping.
+    """
+    if not ids:
+        return 0
+    qn = connection.ops.quote_name
+    sql = (
+        f"DELETE FROM {qn(model._meta.db_table)} "
+        f"WHERE {qn(column)} IN ({', '.join(['%s'] * len(ids))})"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, list(ids))
+        return cursor.rowcount
+
+
+def insert_stop_times(rows):
+    """
+    Insert (schedule_id, station_id, order, arrival, departure) rows with
+    executemany, skipping per-object ORM work; this is most of the volume.
+    """
+    qn = connection.ops.quote_name
+    columns = ['schedule_id', 'station_id', 'order', 'arrival_time', 'departure_time']
+    sql = (
+        f"INSERT INTO {qn(StationSchedule._meta.db_table)} ({', '.join(qn(c) for c in columns)}) "
+        f"VALUES (%s, %s, %s, %s, %s)"
+    )
+    # Trips repeat the same clock times, so adapt each distinct one once
+    adapted = {}
+    adapt = connection.ops.adapt_datetimefield_value
+
+    def value(dt):
+        if dt not in adapted:
+            adapted[dt] = adapt(dt)
+        return adapted[dt]
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), STOP_BATCH_SIZE):
+            cursor.executemany(sql, [
+                (schedule_id, station_id, order, value(arrival), value(departure))
+                for schedule_id, station_id, order, arrival, departure in rows[start:start + STOP_BATCH_SIZE]
+            ])
+
+
+def delete_schedules(schedules):
+    """
+    Remove a Schedule queryset and its stops in bulk, without per-row
+    signals. The schedules must not have bookings. Returns (ids, bus_ids)
+    for the caller to do the bookkeeping once.
+    """
+    rows = list(schedules.values_list('id', 'bus_id'))
+    ids = [row[0] for row in rows]
+    for start in range(0, len(ids), SCHEDULE_BATCH_SIZE):
+        chunk = ids[start:start + SCHEDULE_BATCH_SIZE]
+        SeatInventory.objects.filter(schedule_id__in=chunk).delete()
+        delete_rows(StationSchedule, 'schedule_id', chunk)
+        delete_rows(Schedule, 'id', chunk)
+    return ids, {row[1] for row in rows}
+
+
+@transaction.atomic
+def generate(template, start_date, days=7):
+    """
+    Expand `template` over `days` service dates starting at `start_date`.
+    Returns counts of days created, replaced, unchanged, removed and locked
+    (left alone because they have bookings), plus trips and stop times written.
+    """
+    stops = list(template.stops.order_by('order'))
+    bus_ids = sorted(template.buses.values_list('id', flat=True))
+    validate(template, stops, bus_ids)
+
+    dates = [start_date + timedelta(days=n) for n in range(days)]
+    existing = dict(
+        ScheduleTemplateDay.objects.filter(template=template, service_date__in=dates).values_list(
+            'service_date', 'fingerprint'
+        )
+    )
+
+    plans = {}
+    unchanged = 0
+    removed_days = []
+    for day in dates:
+        times = departures(template, day)
+        if not times:
+            if day in existing:
+                removed_days.append(day)
+            continue
+        fp = fingerprint(template, stops, bus_ids, times)
+        if existing.get(day) == fp:
+            unchanged += 1
+        else:
+            plans[day] = (fp, times)
+
+    # Never drop a trip someone holds a ticket for
+    locked = set(Booking.objects.filter(
+        schedule__template=template,
+        schedule__service_date__in=list(plans) + removed_days
+    ).values_list('schedule__service_date', flat=True).distinct())
+    for day in locked:
+        plans.pop(day, None)
+    removed_days = [day for day in removed_days if day not in locked]
+
+    deleted_ids, touched_buses = delete_schedules(
+        Schedule.objects.filter(template=template, service_date__in=list(plans) + removed_days)
+    )
+    ScheduleTemplateDay.objects.filter(template=template, service_date__in=removed_days).delete()
+
+    schedules = []
+    stop_times = []
+    for day, (fp, times) in plans.items():
+        day_schedules, day_stop_times = _expand(template, stops, bus_ids, day, times)
+        schedules.extend(day_schedules)
+        stop_times.extend(day_stop_times)
+
+    Schedule.objects.bulk_create(schedules, batch_size=SCHEDULE_BATCH_SIZE)
+    rows = [
+        (schedule.id, station_id, order, arrival, departure)
+        for schedule, trip in zip(schedules, stop_times)
+        for station_id, order, arrival, departure in trip
+    ]
+    insert_stop_times(rows)
+
+    ScheduleTemplateDay.objects.bulk_create(
+        [
+            ScheduleTemplateDay(template=template, service_date=day, fingerprint=fp, trips=len(times))
+            for day, (fp, times) in plans.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['template', 'service_date'],
+        update_fields=['fingerprint', 'trips', 'generated_at'],
+    )
+
+    touched_buses.update(s.bus_id for s in schedules)
+    changed_ids = deleted_ids + [s.id for s in schedules]
+
+    def notify():
+        planner.invalidate_many(changed_ids)
+        for bus_id in touched_buses:
+            eta_engine.invalidate(bus_id=bus_id)
+    transaction.on_commit(notify)
+
+    replaced = sum(1 for day in plans if day in existing)
+    return {
+        'created': len(plans) - replaced,
+        'replaced': replaced,
+        'unchanged': unchanged,
+        'removed': len(removed_days),
+        'locked': len(locked),
+        'trips': len(schedules),
+        'stop_times': len(rows),
+    }
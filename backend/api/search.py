@@ -0,0 +1,120 @@
+from collections import defaultdict
+
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+from .eta import eta_engine, predicted_times
+from .models import StationSchedule, BusLocation
+
+
+def find_boardings(start_station_id, end_station_id, after):
+    """
+    Return the boarding StationSchedule rows for every active schedule that
+    stops at start_station before end_station, leaving at or after `after`.
+    Runs as a single query; the bus, its location and the schedule endpoints
+    are joined in.
+    """
+    boardings = StationSchedule.objects.filter(
+        station_id=start_station_id,
+        schedule__is_active=True,
+        schedule__station_schedules__station_id=end_station_id,
+        schedule__station_schedules__order__gt=F('order'),
+    ).annotate(
+        boarding_time=Coalesce('departure_time', 'arrival_time', 'schedule__departure_time')
+    ).filter(
+        boarding_time__gte=after
+    ).select_related(
+        'schedule__bus__location',
+        'schedule__start_station',
+        'schedule__end_station',
+    ).order_by('boarding_time', 'schedule_id')
+
+    # A schedule that passes the destination more than once joins to several
+    # rows; keep the first boarding per schedule
+    seen = set()
+    result = []
+    for boarding in boardings:
+        if boarding.schedule_id in seen:
+            continue
+        seen.add(boarding.schedule_id)
+        result.append(boarding)
+    return result
+
+
+def load_stops(schedule_ids):
+    """Return {schedule_id: [StationSchedule, ...]} for all schedules in one query."""
+    stops = defaultdict(list)
+    if not schedule_ids:
+        return stops
+
+    rows = StationSchedule.objects.filter(
+        schedule_id__in=schedule_ids
+    ).select_related('station').order_by('schedule_id', 'order')
+
+    for stop in rows:
+        stops[stop.schedule_id].append(stop)
+    return stops
+
+
+def stop_data(stop):
+    return {
+        'id': stop.station.id,
+        'name': stop.station.name,
+        'arrival_time': stop.arrival_time,
+        'departure_time': stop.departure_time
+    }
+
+
+def location_data(bus):
+    # Reverse one-to-one, already joined in by select_related
+    try:
+        location = bus.location
+    except BusLocation.DoesNotExist:
+        return None
+    return {
+        'latitude': location.latitude,
+        'longitude': location.longitude
+    }
+
+
+def search_schedules(start_station_id, end_station_id, after):
+    """
+    Find every schedule a rider can take from start_station to end_station
+    after the given time, including trips where both are intermediate stops.
+    Costs two queries regardless of how many schedules match, plus one cache
+    read for live arrival predictions.
+    """
+    boardings = find_boardings(start_station_id, end_station_id, after)
+    stops = load_stops([b.schedule_id for b in boardings])
+    predictions = eta_engine.predictions({b.schedule.bus_id for b in boardings})
+
+    data = []
+    for boarding in boardings:
+        schedule = boarding.schedule
+        schedule_stops = stops[schedule.id]
+
+        alighting = None
+        for stop in schedule_stops:
+            if stop.order > boarding.order and stop.station_id == end_station_id:
+                alighting = stop
+                break
+        alighting_time = alighting and (alighting.arrival_time or alighting.departure_time)
+        predicted = predicted_times(predictions.get(schedule.bus_id), schedule.id)
+
+        data.append({
+            'id': schedule.id,
+            'bus_number': schedule.bus.number,
+            'bus_type': schedule.bus.type,
+            'departure_time': schedule.departure_time,
+            'arrival_time': schedule.arrival_time,
+            'start_station': schedule.start_station.name,
+            'end_station': schedule.end_station.name,
+            'boarding_time': boarding.boarding_time,
+            'alighting_time': alighting_time or schedule.arrival_time,
+            'predicted_boarding_time': predicted.get(boarding.order),
+            'predicted_alighting_time': predicted.get(alighting.order) if alighting else None,
+            'current_location': location_data(schedule.bus),
+            'stops': [stop_data(stop) for stop in schedule_stops]
+        })
+
+    return data
@@ -0,0 +1,156 @@
+"""
+Seat inventory per schedule.
+
+Each schedule has one SeatInventory row holding how many seats are taken on
+every leg between consecutive stops. A ride from stop i to stop j needs a
+free seat on legs i..j-1, so availability is one pass over at most the
+number of legs. A booking locks the inventory row, checks and bumps its legs
+and inserts the Booking in one transaction, so two buyers can never both get
+the last seat. The version column is bumped and compared on every write as
+well, which keeps sales safe on databases that ignore row locks.
+
+The counts are derived data: when a schedule's stops change or a booking is
+deleted the row is dropped, and the next booking rebuilds it from Booking.
+"""
+from array import array
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import Booking, Schedule, SeatInventory, StationSchedule
+
+# Lost version races retried before a booking gives up
+MAX_RETRIES = 5
+
+
+class InvalidSegment(ValueError):
+    pass
+
+
+class SeatsUnavailable(Exception):
+    pass
+
+
+def load_stops(schedule_id):
+    """(order, station_id) for each stop of a schedule, in stop order."""
+    return list(
+        StationSchedule.objects.filter(schedule_id=schedule_id).order_by('order').values_list('order', 'station_id')
+    )
+
+
+def find_segment(stops, boarding_station_id, destination_station_id):
+    """Positions (i, j) of the boarding and destination stops, with i < j."""
+    for i, (_, station_id) in enumerate(stops):
+        if station_id == boarding_station_id:
+            for j in range(i + 1, len(stops)):
+                if stops[j][1] == destination_station_id:
+                    return i, j
+            break
+    raise InvalidSegment("Selected stations are not on this bus route in that order")
+
+
+def pack(counts):
+    return array('H', counts).tobytes()
+
+
+def unpack(data):
+    counts = array('H')
+    counts.frombytes(bytes(data))
+    return counts
+
+
+def count_bookings(schedule_id, stops):
+    """Seats taken per leg, computed from the confirmed bookings."""
+    counts = array('H', bytes(2 * max(len(stops) - 1, 0)))
+    positions = {order: i for i, (order, _) in enumerate(stops)}
+    bookings = Booking.objects.filter(schedule_id=schedule_id, status='confirmed').values_list(
+        'boarding_order', 'destination_order', 'boarding_station_id', 'destination_station_id'
+    )
+    for boarding_order, destination_order, boarding_id, destination_id in bookings:
+        i, j = positions.get(boarding_order), positions.get(destination_order)
+        if i is None or j is None or i >= j:
+            # Older booking, or the stops have been renumbered since
+            try:
+                i, j = find_segment(stops, boarding_id, destination_id)
+            except InvalidSegment:
+                # The stop is no longer served; the booking holds no seat
+                continue
+        for leg in range(i, j):
+            counts[leg] += 1
+    return counts
+
+
+def seats_free(counts, capacity, i, j):
+    return max(capacity - max(counts[i:j], default=0), 0)
+
+
+def availability(schedule_id, stops=None):
+    """Seats taken per leg without locking anything, for display."""
+    stops = load_stops(schedule_id) if stops is None else stops
+    occupancy = SeatInventory.objects.filter(schedule_id=schedule_id).values_list('occupancy', flat=True).first()
+    if occupancy is not None:
+        counts = unpack(occupancy)
+        if len(counts) == max(len(stops) - 1, 0):
+            return counts
+    return count_bookings(schedule_id, stops)
+
+
+def _locked_inventory(schedule_id, stops):
+    inventory = SeatInventory.objects.select_for_update().filter(schedule_id=schedule_id).first()
+    if inventory is None:
+        try:
+            with transaction.atomic():
+                SeatInventory.objects.create(
+                    schedule_id=schedule_id, occupancy=pack(count_bookings(schedule_id, stops))
+                )
+        except IntegrityError:
+            # Another booking created it first
+            pass
+        inventory = SeatInventory.objects.select_for_update().get(schedule_id=schedule_id)
+
+    counts = unpack(inventory.occupancy)
+    if len(counts) != max(len(stops) - 1, 0):
+        counts = count_bookings(schedule_id, stops)
+    return inventory, counts
+
+
+def book(user, schedule_id, boarding_station_id, destination_station_id):
+    """
+    Sell one seat from the boarding to the destination station and return
+    the Booking. Raises Schedule.DoesNotExist, InvalidSegment or
+    SeatsUnavailable.
+    """
+    for _ in range(MAX_RETRIES):
+        with transaction.atomic():
+            schedule = Schedule.objects.select_related('bus').get(id=schedule_id, is_active=True)
+            stops = load_stops(schedule_id)
+            i, j = find_segment(stops, boarding_station_id, destination_station_id)
+
+            inventory, counts = _locked_inventory(schedule_id, stops)
+            if not seats_free(counts, schedule.bus.capacity, i, j):
+                raise SeatsUnavailable("No seats left between these stations")
+            for leg in range(i, j):
+                counts[leg] += 1
+
+            updated = SeatInventory.objects.filter(
+                schedule_id=schedule_id, version=inventory.version
+            ).update(occupancy=pack(counts), version=F('version') + 1)
+            if not updated:
+                # Someone else wrote in between; only possible without row locks
+                continue
+
+            return Booking.objects.create(
+                user=user,
+                schedule=schedule,
+                boarding_station_id=boarding_station_id,
+                destination_station_id=destination_station_id,
+                boarding_order=stops[i][0],
+                destination_order=stops[j][0],
+                status='confirmed'
+            )
+    raise SeatsUnavailable("Seats on this bus are changing too fast, please try again")
+
+
+def invalidate(schedule_id):
+    """Drop a schedule's counts so the next booking rebuilds them from Booking."""
+    SeatInventory.objects.filter(schedule_id=schedule_id).delete()
@@ -2,8 +2,9 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import (
     Station, Route, RoutePoint, Bus, Schedule, 
-    StationSchedule, BusLocation, Alert, Booking
+    StationSchedule, BusLocation, Alert, Booking, ScheduleTemplate, TemplateStop, RouteShape
 )
+from . import dead_reckoning, polyline
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -21,16 +22,43 @@ class RoutePointSerializer(serializers.ModelSerializer):
         fields = ['id', 'latitude', 'longitude', 'order']
 
 class RouteSerializer(serializers.ModelSerializer):
+    # Geometry goes out as encoded polylines; the per-point list only on
+    # request with ?geometry=points
+    shape = serializers.SerializerMethodField()
     points = RoutePointSerializer(many=True, read_only=True)
     
     class Meta:
         model = Route
-        fields = ['id', 'name', 'description', 'points', 'created_at', 'updated_at']
+        fields = ['id', 'name', 'description', 'shape', 'points', 'created_at', 'updated_at']
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.query_params.get('geometry') != 'points':
+            self.fields.pop('points')
+    
+    def get_shape(self, route):
+        request = self.context.get('request')
+        try:
+            detail = polyline.parse_detail(request.query_params) if request else None
+        except ValueError:
+            raise serializers.ValidationError({'zoom': "zoom and tolerance must be numbers"})
+        try:
+            shape = route.shape
+        except RouteShape.DoesNotExist:
+            shape = polyline.rebuild(route.id)
+        return polyline.shape_data(shape, detail)
 
 class BusLocationSerializer(serializers.ModelSerializer):
+    # The last fix, plus where it puts the bus now
+    estimated = serializers.SerializerMethodField()
+    
     class Meta:
         model = BusLocation
-        fields = ['latitude', 'longitude', 'speed', 'heading', 'timestamp']
+        fields = ['latitude', 'longitude', 'speed', 'heading', 'timestamp', 'estimated']
+    
+    def get_estimated(self, location):
+        return dead_reckoning.estimate(location)
 
 class BusSerializer(serializers.ModelSerializer):
     route_name = serializers.CharField(source='route.name', read_only=True)
@@ -46,7 +74,9 @@ class StationScheduleSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = StationSchedule
-        fields = ['id', 'station', 'station_name', 'arrival_time', 'departure_time', 'order']
+        fields = ['id', 'station', 'station_name', 'arrival_time', 'departure_time', 'order',
+                  'actual_arrival_time', 'actual_departure_time']
+        read_only_fields = ['actual_arrival_time', 'actual_departure_time']
 
 class ScheduleSerializer(serializers.ModelSerializer):
     bus_number = serializers.CharField(source='bus.number', read_only=True)
@@ -59,7 +89,46 @@ class ScheduleSerializer(serializers.ModelSerializer):
         model = Schedule
         fields = ['id', 'bus', 'bus_number', 'bus_type', 'start_station', 'start_station_name',
                   'end_station', 'end_station_name', 'departure_time', 'arrival_time',
-                  'is_active', 'station_schedules', 'created_at', 'updated_at']
+                  'is_active', 'template', 'service_date', 'station_schedules', 'created_at', 'updated_at']
+        read_only_fields = ['template', 'service_date']
+
+class TemplateStopSerializer(serializers.ModelSerializer):
+    station_name = serializers.CharField(source='station.name', read_only=True)
+    
+    class Meta:
+        model = TemplateStop
+        fields = ['id', 'station', 'station_name', 'order', 'arrival_offset', 'departure_offset']
+
+class ScheduleTemplateSerializer(serializers.ModelSerializer):
+    stops = TemplateStopSerializer(many=True)
+    
+    class Meta:
+        model = ScheduleTemplate
+        fields = ['id', 'name', 'route', 'buses', 'first_departure', 'last_departure',
+                  'headway_minutes', 'weekdays', 'is_active', 'stops', 'created_at', 'updated_at']
+    
+    def validate_weekdays(self, value):
+        if not value or any(day not in '0123456' for day in value):
+            raise serializers.ValidationError("Use the digits 0 (Monday) to 6 (Sunday)")
+        return value
+    
+    def create(self, validated_data):
+        stops = validated_data.pop('stops')
+        template = super().create(validated_data)
+        self._save_stops(template, stops)
+        return template
+    
+    def update(self, instance, validated_data):
+        stops = validated_data.pop('stops', None)
+        template = super().update(instance, validated_data)
+        if stops is not None:
+            # The stop pattern is replaced as a whole
+            template.stops.all().delete()
+            self._save_stops(template, stops)
+        return template
+    
+    def _save_stops(self, template, stops):
+        TemplateStop.objects.bulk_create(TemplateStop(template=template, **stop) for stop in stops)
 
 class AlertSerializer(serializers.ModelSerializer):
     bus_number = serializers.CharField(source='bus.number', read_only=True)
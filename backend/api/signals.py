@@ -0,0 +1,72 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import counters, polyline, response_cache, seats
+from .eta import eta_engine
+from .geo import station_index
+from .geometry import geometries
+from .journeys import planner
+from .models import Station, Route, RoutePoint, Schedule, StationSchedule, Booking
+
+
+@receiver([post_save, post_delete], sender=Station)
+def station_changed(sender, instance, **kwargs):
+    transaction.on_commit(station_index.invalidate)
+    transaction.on_commit(lambda: response_cache.bump(Station))
+
+
+@receiver([post_save, post_delete], sender=Route)
+def route_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: response_cache.bump(Route))
+
+
+@receiver([post_save, post_delete], sender=RoutePoint)
+def route_point_changed(sender, instance, **kwargs):
+    route_id = instance.route_id
+    # Encoded shapes are rebuilt on the next read
+    polyline.invalidate(route_id)
+    transaction.on_commit(lambda: geometries.invalidate(route_id))
+    transaction.on_commit(lambda: response_cache.bump(RoutePoint))
+
+
+@receiver(post_delete, sender=Route)
+def route_deleted(sender, instance, **kwargs):
+    route_id = instance.id
+    transaction.on_commit(lambda: geometries.invalidate(route_id))
+
+
+@receiver([post_save, post_delete], sender=Schedule)
+def schedule_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: planner.invalidate(instance.id))
+    transaction.on_commit(lambda: eta_engine.invalidate(schedule_id=instance.id, bus_id=instance.bus_id))
+
+
+@receiver([post_save, post_delete], sender=StationSchedule)
+def station_schedule_changed(sender, instance, **kwargs):
+    schedule_id = instance.schedule_id
+    transaction.on_commit(lambda: planner.invalidate(schedule_id))
+    transaction.on_commit(lambda: eta_engine.invalidate(schedule_id=schedule_id))
+    # Leg counts are indexed by stop position; rebuild them for the new stops
+    seats.invalidate(schedule_id)
+
+
+@receiver(post_save, sender=Booking)
+def booking_saved(sender, instance, created, **kwargs):
+    # New bookings are counted by seats.book(); edits (a cancelled status,
+    # moved stations) need the counts rebuilt
+    if not created:
+        seats.invalidate(instance.schedule_id)
+
+
+@receiver(post_delete, sender=Booking)
+def booking_deleted(sender, instance, **kwargs):
+    seats.invalidate(instance.schedule_id)
+
+
+# Dashboard counters are updated inside the writer's transaction, so a rolled
+# back change never reaches them.
+for model in counters.COUNTED_MODELS:
+    pre_save.connect(counters.remember_old_state, sender=model, dispatch_uid=f'counters-pre-{model.__name__}')
+    post_save.connect(counters.model_saved, sender=model, dispatch_uid=f'counters-save-{model.__name__}')
+    post_delete.connect(counters.model_deleted, sender=model, dispatch_uid=f'counters-delete-{model.__name__}')
@@ -0,0 +1,297 @@
+"""
+Push live bus locations to subscribed clients over Server-Sent Events.
+
+The ingest path publishes each batch once. Subscribers are indexed by bus,
+by route and by a coarse lat/lon grid for bounding boxes, so a fix only
+touches the subscribers that want it. Each subscriber keeps just the newest
+pending position per bus: a slow client that has not drained its queue has
+the entry overwritten rather than a backlog built up.
+
+Subscribers live on an asyncio event loop and the index for a loop is only
+touched from that loop; publishers in worker threads hand batches over with
+call_soon_threadsafe.
+
+Fixes are ingested by whichever worker process takes the request, while a
+stream is held open by another. With STREAM_REDIS_URL set, publish() sends
+each batch to a Redis pub/sub channel, and every process holding streams
+runs one listener thread that hands what it hears to its own subscribers.
+Without it, batches only reach streams in the publishing process, which is
+enough for a single-process server.
+
+EventSource cannot send an Authorization header, so a browser first asks
+for a ticket with its usual credentials and opens the stream with
+?ticket=. A ticket is signed, expires after TICKET_SECONDS and is only
+accepted once, so one copied out of a server or proxy log is useless.
+"""
+import asyncio
+import json
+import logging
+import math
+import secrets
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+# Grid cell size for bounding-box subscriptions, in degrees
+CELL_DEGREES = 0.05
+
+# Boxes spanning more cells than this are matched by a linear check instead
+MAX_BBOX_CELLS = 400
+
+MAX_SUBSCRIBED_BUSES = 500
+
+HEARTBEAT_SECONDS = 15
+
+# Redis pub/sub channel carrying published batches between processes
+CHANNEL = 'api:bus-locations'
+RECONNECT_SECONDS = 2
+
+TICKET_SECONDS = 30
+TICKET_SALT = 'api.streaming.ticket'
+
+
+def _cell(lat, lon):
+    return (math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES))
+
+
+class Subscriber:
+    __slots__ = ('bus_ids', 'route_id', 'bbox', 'pending', 'event', 'cells')
+
+    def __init__(self, bus_ids=None, route_id=None, bbox=None):
+        self.bus_ids = frozenset(bus_ids or ())
+        self.route_id = route_id
+        self.bbox = bbox
+        self.pending = {}
+        self.event = asyncio.Event()
+        self.cells = None
+
+    def in_bbox(self, lat, lon):
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+
+    def push(self, update):
+        # Overwrite rather than queue: only the newest position per bus matters
+        self.pending[update['bus_id']] = update
+        self.event.set()
+
+    async def updates(self):
+        """Yield lists of coalesced updates, or None after a quiet heartbeat interval."""
+        while True:
+            try:
+                await asyncio.wait_for(self.event.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            self.event.clear()
+            pending, self.pending = self.pending, {}
+            yield list(pending.values())
+
+
+class LoopIndex:
+    """Subscribers attached to one event loop. Only used from that loop."""
+
+    def __init__(self):
+        self.by_bus = defaultdict(set)
+        self.by_route = defaultdict(set)
+        self.by_cell = defaultdict(set)
+        self.large_boxes = set()
+        self.count = 0
+
+    def add(self, sub):
+        for bus_id in sub.bus_ids:
+            self.by_bus[bus_id].add(sub)
+        if sub.route_id is not None:
+            self.by_route[sub.route_id].add(sub)
+        if sub.bbox is not None:
+            min_cell = _cell(sub.bbox[0], sub.bbox[1])
+            max_cell = _cell(sub.bbox[2], sub.bbox[3])
+            n = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+            if n > MAX_BBOX_CELLS:
+                self.large_boxes.add(sub)
+            else:
+                sub.cells = [
+                    (a, b)
+                    for a in range(min_cell[0], max_cell[0] + 1)
+                    for b in range(min_cell[1], max_cell[1] + 1)
+                ]
+                for cell in sub.cells:
+                    self.by_cell[cell].add(sub)
+        self.count += 1
+
+    def remove(self, sub):
+        for bus_id in sub.bus_ids:
+            self.by_bus[bus_id].discard(sub)
+            if not self.by_bus[bus_id]:
+                del self.by_bus[bus_id]
+        if sub.route_id is not None:
+            self.by_route[sub.route_id].discard(sub)
+            if not self.by_route[sub.route_id]:
+                del self.by_route[sub.route_id]
+        for cell in sub.cells or ():
+            self.by_cell[cell].discard(sub)
+            if not self.by_cell[cell]:
+                del self.by_cell[cell]
+        self.large_boxes.discard(sub)
+        self.count -= 1
+
+    def fanout(self, updates):
+        for update in updates:
+            lat, lon = update['latitude'], update['longitude']
+            targets = set(self.by_bus.get(update['bus_id'], ()))
+            targets.update(self.by_route.get(update['route_id'], ()))
+            for sub in self.by_cell.get(_cell(lat, lon), ()):
+                if sub.in_bbox(lat, lon):
+                    targets.add(sub)
+            for sub in self.large_boxes:
+                if sub.in_bbox(lat, lon):
+                    targets.add(sub)
+            for sub in targets:
+                sub.push(update)
+
+
+class Broadcaster:
+    def __init__(self, redis_url=None):
+        self.lock = threading.Lock()
+        self.loops = {}
+        # Newest timestamp delivered per bus, so late fixes never move a bus backwards
+        self.last_seen = {}
+        self.redis_url = redis_url
+        self.client = None
+        self.listener = None
+
+    def subscribe(self, sub):
+        """Register a subscriber; must be called from the loop that will consume it."""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            index = self.loops.get(loop)
+            if index is None:
+                index = self.loops[loop] = LoopIndex()
+            if self.redis_url and self.listener is None:
+                self.listener = threading.Thread(target=self.listen, name='bus-location-listener', daemon=True)
+                self.listener.start()
+        index.add(sub)
+
+    def unsubscribe(self, sub):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            index = self.loops.get(loop)
+        if index is None:
+            return
+        index.remove(sub)
+        if not index.count:
+            with self.lock:
+                self.loops.pop(loop, None)
+
+    def publish(self, updates):
+        """
+        Send a batch to the subscribers of every process. Each update is a
+        dict with bus_id, route_id, latitude, longitude, speed, heading and
+        timestamp. Safe to call from any thread.
+        """
+        if not updates:
+            return
+        if not self.redis_url:
+            self.deliver(updates)
+            return
+        import redis
+
+        try:
+            if self.client is None:
+                self.client = redis.Redis.from_url(self.redis_url)
+            # isoformat() keeps the microseconds that DjangoJSONEncoder drops, so
+            # fixes within a millisecond still order correctly
+            message = [{**update, 'timestamp': update['timestamp'].isoformat()} for update in updates]
+            self.client.publish(CHANNEL, json.dumps(message, cls=DjangoJSONEncoder, separators=(',', ':')))
+        except redis.RedisError as e:
+            # Live positions are best effort; the fixes themselves are stored
+            logger.warning("Could not publish %d bus locations: %s", len(updates), e)
+
+    def listen(self):
+        """Deliver batches published by any process to this one's subscribers. Runs in its own thread."""
+        import redis
+
+        while True:
+            try:
+                pubsub = redis.Redis.from_url(self.redis_url).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for message in pubsub.listen():
+                    updates = json.loads(message['data'])
+                    for update in updates:
+                        update['timestamp'] = parse_datetime(update['timestamp'])
+                    self.deliver(updates)
+            except redis.RedisError as e:
+                logger.warning("Bus location listener lost Redis, reconnecting: %s", e)
+                time.sleep(RECONNECT_SECONDS)
+
+    def deliver(self, updates):
+        """Fan a batch out to every loop with subscribers in this process."""
+        with self.lock:
+            fresh = []
+            for update in updates:
+                last = self.last_seen.get(update['bus_id'])
+                if last is None or update['timestamp'] > last:
+                    self.last_seen[update['bus_id']] = update['timestamp']
+                    fresh.append(update)
+            loops = list(self.loops.items())
+        if not fresh:
+            return
+        for loop, index in loops:
+            try:
+                loop.call_soon_threadsafe(index.fanout, fresh)
+            except RuntimeError:
+                # The loop has been closed
+                with self.lock:
+                    self.loops.pop(loop, None)
+
+
+broadcaster = Broadcaster(getattr(settings, 'STREAM_REDIS_URL', None))
+
+
+def issue_ticket(user):
+    """A short-lived, single-use credential for opening one stream as `user`."""
+    return signing.dumps({'user': user.pk, 'nonce': secrets.token_urlsafe(12)}, salt=TICKET_SALT)
+
+
+def redeem_ticket(ticket):
+    """The id of the user a ticket was issued to, or None if it is forged, expired or already used."""
+    try:
+        data = signing.loads(ticket, salt=TICKET_SALT, max_age=TICKET_SECONDS)
+    except signing.BadSignature:
+        return None
+    if not cache.add(f"stream-ticket:{data['nonce']}", 1, TICKET_SECONDS):
+        return None
+    return data['user']
+
+
+def sse_event(data, event=None):
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')))
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+async def stream(sub, load_snapshot):
+    """
+    SSE body: the current snapshot, then coalesced updates until the client
+    leaves. The subscription is taken before the snapshot is read, so a fix
+    stored in between is sent after the snapshot rather than lost.
+    """
+    broadcaster.subscribe(sub)
+    try:
+        yield sse_event(await load_snapshot(), event='snapshot')
+        async for updates in sub.updates():
+            if updates is None:
+                yield b": ping\n\n"
+            else:
+                yield sse_event(updates)
+    finally:
+        broadcaster.unsubscribe(sub)
@@ -0,0 +1,290 @@
+"""
+Build a synthetic bus network for load testing.
+
+Stations sit on a jittered grid around a city centre. Each route is a walk
+through neighbouring grid cells with a RoutePoint shape traced between its
+stops, and gets a handful of buses. Every route runs a full service day at a
+fixed headway, alternating direction, for the requested number of days.
+Bookings, alerts and a current location per bus are spread over that
+network.
+
+Everything is written with bulk inserts and without model signals, so the
+caches and the dashboard counters are refreshed once at the end, the same
+way the GTFS importer does it. The generator never deletes anything; point
+it at a scratch database.
+"""
+import math
+import random
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from . import counters, polyline, response_cache
+from .eta import eta_engine
+from .geo import station_index
+from .geometry import EARTH_RADIUS_M, geometries
+from .journeys import planner
+from .models import Alert, Booking, Bus, BusLocation, Route, RoutePoint, Schedule, Station
+from .schedule_templates import insert_stop_times
+
+BATCH_SIZE = 5000
+
+# Grid spacing between neighbouring stations
+STATION_SPACING_M = 400
+# Average running speed and dwell time, for stop times
+SPEED_KMH = 20
+DWELL_SECONDS = 30
+
+SERVICE_START = time(5, 0)
+SERVICE_END = time(23, 0)
+
+
+class City:
+    def __init__(self, stations=2000, routes=100, stops_per_route=25, points_per_segment=8,
+                 buses_per_route=8, days=3, headway_minutes=15, bookings=200000, alerts=50000,
+                 users=1000, centre=(37.7749, -122.4194), seed=0, log=None):
+        self.n_stations = stations
+        self.n_routes = routes
+        self.stops_per_route = stops_per_route
+        self.points_per_segment = points_per_segment
+        self.buses_per_route = buses_per_route
+        self.days = days
+        self.headway = timedelta(minutes=headway_minutes)
+        self.n_bookings = bookings
+        self.n_alerts = alerts
+        self.n_users = users
+        self.centre = centre
+        self.random = random.Random(seed)
+        self.log = log or (lambda message: None)
+        self.counts = {}
+
+    @transaction.atomic
+    def build(self):
+        self._stations()
+        self._routes()
+        self._buses()
+        self._schedules()
+        self._bookings()
+        self._alerts()
+
+        route_ids = [route.id for route in self.routes]
+        bus_ids = [bus.id for bus in self.buses]
+        for route_id in route_ids:
+            polyline.rebuild(route_id)
+
+        def notify():
+            station_index.invalidate()
+            response_cache.bump(Station, Route, RoutePoint)
+            for route_id in route_ids:
+                geometries.invalidate(route_id)
+            planner.invalidate_all()
+            for bus_id in bus_ids:
+                eta_engine.invalidate(bus_id=bus_id)
+        transaction.on_commit(notify)
+        counters.reconcile()
+        return dict(self.counts)
+
+    def _offset(self, north_m, east_m):
+        lat0, lon0 = self.centre
+        lat = lat0 + math.degrees(north_m / EARTH_RADIUS_M)
+        lon = lon0 + math.degrees(east_m / (EARTH_RADIUS_M * math.cos(math.radians(lat0))))
+        return lat, lon
+
+    def _stations(self):
+        self.side = max(2, math.ceil(math.sqrt(self.n_stations)))
+        half = self.side / 2
+        jitter = STATION_SPACING_M * 0.3
+        stations = []
+        for n in range(self.n_stations):
+            row, col = divmod(n, self.side)
+            lat, lon = self._offset(
+                (row - half) * STATION_SPACING_M + self.random.uniform(-jitter, jitter),
+                (col - half) * STATION_SPACING_M + self.random.uniform(-jitter, jitter),
+            )
+            stations.append(Station(name=f"Synthetic {n}", address=f"Grid {row}/{col}",
+                                    latitude=lat, longitude=lon, capacity=self.random.randint(20, 200)))
+        self.stations = Station.objects.bulk_create(stations, batch_size=BATCH_SIZE)
+        self.counts['stations'] = len(self.stations)
+        self.log(f"stations: {len(self.stations)}")
+
+    def _walk(self):
+        """Grid cells of one route: mostly straight on, never revisiting a cell."""
+        directions = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+        cell = self.random.randrange(self.n_stations)
+        heading = self.random.choice(directions)
+        cells = [cell]
+        while len(cells) < self.stops_per_route:
+            row, col = divmod(cells[-1], self.side)
+            options = []
+            for d in directions:
+                r, c = row + d[0], col + d[1]
+                n = r * self.side + c
+                if 0 <= r < self.side and 0 <= c < self.side and n < self.n_stations and n not in cells:
+                    options.append((d, n))
+            if not options:
+                break
+            straight = [option for option in options if option[0] == heading]
+            if straight and self.random.random() < 0.7:
+                heading, cell = straight[0]
+            else:
+                heading, cell = self.random.choice(options)
+            cells.append(cell)
+        return cells
+
+    def _routes(self):
+        self.routes = Route.objects.bulk_create(
+            Route(name=f"Synthetic {n}", description="Generated for load testing") for n in range(self.n_routes)
+        )
+        self.route_stops = {}
+        points = []
+        for route in self.routes:
+            stops = [self.stations[cell] for cell in self._walk()]
+            self.route_stops[route.id] = stops
+            order = 0
+            for a, b in zip(stops, stops[1:]):
+                for k in range(self.points_per_segment):
+                    t = k / self.points_per_segment
+                    points.append(RoutePoint(
+                        route=route,
+                        latitude=a.latitude + (b.latitude - a.latitude) * t + self.random.gauss(0, 0.00003),
+                        longitude=a.longitude + (b.longitude - a.longitude) * t + self.random.gauss(0, 0.00003),
+                        order=order,
+                    ))
+                    order += 1
+            points.append(RoutePoint(route=route, latitude=stops[-1].latitude,
+                                     longitude=stops[-1].longitude, order=order))
+        RoutePoint.objects.bulk_create(points, batch_size=BATCH_SIZE)
+        self.counts['routes'] = len(self.routes)
+        self.counts['route_points'] = len(points)
+        self.log(f"routes: {len(self.routes)} with {len(points)} shape points")
+
+    def _buses(self):
+        buses = []
+        for route in self.routes:
+            for k in range(self.buses_per_route):
+                buses.append(Bus(number=f"SYN-{route.id}-{k}", type=self.random.choice(['regular', 'fast']),
+                                 capacity=self.random.choice([40, 50, 60]), route=route))
+        self.buses = Bus.objects.bulk_create(buses, batch_size=BATCH_SIZE)
+        self.route_buses = {}
+        for bus in self.buses:
+            self.route_buses.setdefault(bus.route_id, []).append(bus)
+
+        locations = []
+        for bus in self.buses:
+            stop = self.random.choice(self.route_stops[bus.route_id])
+            locations.append(BusLocation(bus=bus, latitude=stop.latitude, longitude=stop.longitude,
+                                         speed=self.random.uniform(0, 50), heading=self.random.uniform(0, 359)))
+        BusLocation.objects.bulk_create(locations, batch_size=BATCH_SIZE)
+        self.counts['buses'] = len(self.buses)
+        self.log(f"buses: {len(self.buses)}")
+
+    def _run_times(self, stops):
+        """Seconds from departure to arrival at, and departure from, each stop."""
+        times = [(0, 0)]
+        clock = 0
+        for a, b in zip(stops, stops[1:]):
+            metres = math.hypot(
+                math.radians(b.latitude - a.latitude) * EARTH_RADIUS_M,
+                math.radians(b.longitude - a.longitude) * EARTH_RADIUS_M * math.cos(math.radians(a.latitude)),
+            )
+            clock += round(metres / (SPEED_KMH / 3.6))
+            times.append((clock, clock + DWELL_SECONDS))
+            clock += DWELL_SECONDS
+        times[-1] = (times[-1][0], times[-1][0])
+        return times
+
+    def _schedules(self):
+        today = timezone.localdate()
+        # (schedule, stations in trip order) for the bookings
+        self.trips = []
+        n_schedules = n_stop_times = 0
+        for route in self.routes:
+            forward = self.route_stops[route.id]
+            buses = self.route_buses[route.id]
+            for day in (today + timedelta(days=n) for n in range(self.days)):
+                departure = timezone.make_aware(datetime.combine(day, SERVICE_START))
+                last = timezone.make_aware(datetime.combine(day, SERVICE_END))
+                schedules, patterns = [], []
+                trip = 0
+                while departure <= last:
+                    stops = forward if trip % 2 == 0 else forward[::-1]
+                    run_times = self._run_times(stops)
+                    schedules.append(Schedule(
+                        bus=buses[trip % len(buses)], start_station=stops[0], end_station=stops[-1],
+                        departure_time=departure, arrival_time=departure + timedelta(seconds=run_times[-1][0]),
+                        service_date=day,
+                    ))
+                    patterns.append((stops, run_times))
+                    departure += self.headway
+                    trip += 1
+                Schedule.objects.bulk_create(schedules, batch_size=BATCH_SIZE)
+                rows = [
+                    (schedule.id, station.id, order,
+                     schedule.departure_time + timedelta(seconds=arrive),
+                     schedule.departure_time + timedelta(seconds=leave))
+                    for schedule, (stops, run_times) in zip(schedules, patterns)
+                    for order, (station, (arrive, leave)) in enumerate(zip(stops, run_times))
+                ]
+                insert_stop_times(rows)
+                self.trips.extend((schedule, stops) for schedule, (stops, _) in zip(schedules, patterns))
+                n_schedules += len(schedules)
+                n_stop_times += len(rows)
+        self.counts['schedules'] = n_schedules
+        self.counts['stop_times'] = n_stop_times
+        self.log(f"schedules: {n_schedules} with {n_stop_times} stop times")
+
+    def _users(self):
+        """The synthetic-N accounts, creating only those an earlier run did not."""
+        names = [f"synthetic-{n}" for n in range(self.n_users)]
+        existing = set(User.objects.filter(username__in=names).values_list('username', flat=True))
+        User.objects.bulk_create(
+            [User(username=name) for name in names if name not in existing], batch_size=BATCH_SIZE
+        )
+        return list(User.objects.filter(username__in=names).order_by('username'))
+
+    def _bookings(self):
+        if self.n_bookings and self.n_users < 1:
+            raise ValueError("Bookings need at least one user")
+        users = self._users() if self.n_bookings else []
+        batch = []
+        for _ in range(self.n_bookings):
+            schedule, stops = self.random.choice(self.trips)
+            i = self.random.randrange(len(stops) - 1)
+            j = self.random.randrange(i + 1, len(stops))
+            batch.append(Booking(user=self.random.choice(users), schedule=schedule,
+                                 boarding_station=stops[i], destination_station=stops[j],
+                                 boarding_order=i, destination_order=j))
+            if len(batch) == BATCH_SIZE:
+                Booking.objects.bulk_create(batch)
+                batch = []
+        Booking.objects.bulk_create(batch)
+        self.counts['bookings'] = self.n_bookings
+        self.log(f"bookings: {self.n_bookings}")
+
+    def _alerts(self):
+        now = timezone.now()
+        alerts = []
+        for _ in range(self.n_alerts):
+            on_bus = self.random.random() < 0.7
+            alerts.append(Alert(
+                bus=self.random.choice(self.buses) if on_bus else None,
+                station=None if on_bus else self.random.choice(self.stations),
+                alert_type=self.random.choice(['delay', 'delay', 'breakdown', 'accident', 'other']),
+                message="Synthetic alert",
+                is_resolved=self.random.random() < 0.9,
+            ))
+        alerts = Alert.objects.bulk_create(alerts, batch_size=BATCH_SIZE)
+        # created_at is stamped on insert; spread the alerts over the last
+        # 30 days afterwards
+        for alert in alerts:
+            alert.created_at = now - timedelta(seconds=self.random.randrange(30 * 86400))
+        Alert.objects.bulk_update(alerts, ['created_at'], batch_size=1000)
+        self.counts['alerts'] = len(alerts)
+        self.log(f"alerts: {len(alerts)}")
+
+
+def build_city(log=None, **options):
+    """Generate a synthetic network; see City for the options. Returns row counts."""
+    return City(log=log, **options).build()
@@ -0,0 +1,301 @@
+import io
+import random
+import threading
+import time
+import zipfile
+from datetime import date, timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from . import counters, seats
+from .arrivals import ingest_reports
+from .gtfs import FeedTooLarge, GtfsError, import_feed
+from .ingest import ingest
+from .models import (
+    Booking, Bus, BusLocation, Schedule, SeatInventory, Station, StationEvent, StationSchedule, StationVisit,
+)
+from .search import search_schedules
+from .streaming import TICKET_SECONDS, issue_ticket, redeem_ticket
+
+
+def make_stations(n):
+    return [
+        Station.objects.create(name=f"Station {i}", address='', latitude=37.7, longitude=-122.4 + i * 0.01,
+                               capacity=10)
+        for i in range(n)
+    ]
+
+
+def make_schedule(bus, stations, departure):
+    schedule = Schedule.objects.create(
+        bus=bus, start_station=stations[0], end_station=stations[-1],
+        departure_time=departure, arrival_time=departure + timedelta(minutes=5 * len(stations)),
+    )
+    StationSchedule.objects.bulk_create(
+        StationSchedule(
+            schedule=schedule, station=station, order=i,
+            arrival_time=departure + timedelta(minutes=5 * i),
+            departure_time=departure + timedelta(minutes=5 * i + 1),
+        )
+        for i, station in enumerate(stations)
+    )
+    return schedule
+
+
+class SearchQueryCountTests(TestCase):
+    def setUp(self):
+        self.stations = make_stations(5)
+        self.after = timezone.now().replace(microsecond=0)
+
+    def add_schedules(self, n):
+        for i in range(n):
+            bus = Bus.objects.create(number=f"S{Bus.objects.count()}", capacity=40)
+            make_schedule(bus, self.stations, self.after + timedelta(minutes=10 + i))
+
+    def search(self):
+        # Both ends are intermediate stops of every schedule
+        return search_schedules(self.stations[1].id, self.stations[3].id, self.after)
+
+    def test_query_count_does_not_grow_with_matches(self):
+        self.add_schedules(2)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.search()), 2)
+
+        self.add_schedules(40)
+        with self.assertNumQueries(2):
+            results = self.search()
+        self.assertEqual(len(results), 42)
+        self.assertEqual([len(r['stops']) for r in results], [5] * 42)
+
+
+class IngestTests(TestCase):
+    def fix(self, bus, timestamp, latitude):
+        return {'bus_id': bus.id, 'latitude': latitude, 'longitude': -122.4, 'timestamp': timestamp}
+
+    def test_late_fix_does_not_replace_live_predictions(self):
+        buses = [Bus.objects.create(number=f"L{i}", capacity=40) for i in range(2)]
+        now = time.time()
+        ingest([self.fix(buses[0], now, 37.70)])
+        with mock.patch('api.ingest.eta_engine.update') as update:
+            result = ingest([self.fix(buses[0], now - 60, 37.60), self.fix(buses[1], now - 60, 37.61)])
+        self.assertEqual(result['updated'], 1)
+        self.assertEqual([args[0] for args in update.call_args[0][0]], [buses[1].id])
+        self.assertEqual(BusLocation.objects.get(bus=buses[0]).latitude, 37.70)
+
+
+class DashboardCounterTests(TestCase):
+    def test_counters_made_by_signals_are_not_totals_until_reconciled(self):
+        # Rows from before the counters existed
+        Bus.objects.bulk_create([Bus(number=f"B{i}", capacity=40) for i in range(3)])
+        Bus.objects.create(number='NEW', capacity=40)
+        self.assertIsNone(counters.read())
+
+        self.assertEqual(counters.reconcile()['total_buses'], (1, 4))
+        Bus.objects.create(number='NEWER', capacity=40)
+        self.assertEqual(counters.read()['total_buses'], 5)
+
+
+class SeatConcurrencyTests(TransactionTestCase):
+    capacity = 5
+    workers = 24
+
+    def setUp(self):
+        # The threads race for row locks; SQLite locks the whole file instead
+        if not connection.features.has_select_for_update:
+            self.skipTest("needs a database with SELECT ... FOR UPDATE")
+        self.stations = make_stations(6)
+        self.bus = Bus.objects.create(number='SEATS', capacity=self.capacity)
+        self.schedule = make_schedule(self.bus, self.stations, timezone.now() + timedelta(hours=1))
+        self.users = [User.objects.create(username=f"rider{i}") for i in range(self.workers)]
+
+    def book_concurrently(self, segments):
+        """Run one seats.book() per segment, all at once. Returns (booked, sold out)."""
+        start = threading.Barrier(len(segments))
+        results = []
+        lock = threading.Lock()
+
+        def book(user, boarding, destination):
+            try:
+                start.wait()
+                try:
+                    seats.book(user, self.schedule.id, boarding.id, destination.id)
+                    outcome = 'booked'
+                except seats.SeatsUnavailable:
+                    outcome = 'sold out'
+                except Exception as e:
+                    outcome = e
+                with lock:
+                    results.append(outcome)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=book, args=(user, self.stations[i], self.stations[j]))
+            for user, (i, j) in zip(self.users, segments)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        errors = [r for r in results if not isinstance(r, str)]
+        self.assertEqual(errors, [])
+        return results.count('booked'), results.count('sold out')
+
+    def assert_inventory_matches_bookings(self):
+        stops = seats.load_stops(self.schedule.id)
+        counted = seats.count_bookings(self.schedule.id, stops)
+        stored = seats.unpack(SeatInventory.objects.get(schedule=self.schedule).occupancy)
+        self.assertEqual(list(stored), list(counted))
+        self.assertLessEqual(max(counted), self.capacity)
+
+    def test_last_seats_are_sold_once(self):
+        booked, sold_out = self.book_concurrently([(0, 5)] * self.workers)
+        self.assertEqual(booked, self.capacity)
+        self.assertEqual(sold_out, self.workers - self.capacity)
+        self.assertEqual(Booking.objects.filter(schedule=self.schedule).count(), self.capacity)
+        self.assert_inventory_matches_bookings()
+
+    def test_overlapping_segments_never_oversell_a_leg(self):
+        rng = random.Random(1)
+        segments = []
+        for _ in range(self.workers):
+            i = rng.randrange(5)
+            segments.append((i, rng.randrange(i + 1, 6)))
+        booked, sold_out = self.book_concurrently(segments)
+        self.assertEqual(booked + sold_out, self.workers)
+        self.assertEqual(Booking.objects.filter(schedule=self.schedule).count(), booked)
+        self.assert_inventory_matches_bookings()
+
+
+class ArrivalReportTests(TransactionTestCase):
+    workers = 12
+
+    def setUp(self):
+        # The threads race for row locks; SQLite locks the whole file instead
+        if not connection.features.has_select_for_update:
+            self.skipTest("needs a database with SELECT ... FOR UPDATE")
+        self.station = make_stations(1)[0]
+        self.bus = Bus.objects.create(number='ARR', capacity=40)
+
+    def report(self, *etas):
+        return {'station_id': self.station.id, 'bus_data': [{'bus_id': self.bus.id, 'eta': eta} for eta in etas]}
+
+    def kinds(self):
+        return list(StationEvent.objects.order_by('id').values_list('kind', flat=True))
+
+    def test_visit_logs_one_arrival_and_one_departure(self):
+        for payload in (self.report(4), self.report(0.5), self.report(0.2), self.report()):
+            ingest_reports(payload)
+        self.assertEqual(self.kinds(), [StationEvent.ARRIVAL, StationEvent.DEPARTURE])
+        self.assertFalse(StationVisit.objects.exists())
+
+    def test_concurrent_retries_log_one_arrival(self):
+        start = threading.Barrier(self.workers)
+        errors = []
+
+        def post():
+            try:
+                start.wait()
+                ingest_reports(self.report(0.5))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=post) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.kinds(), [StationEvent.ARRIVAL])
+        self.assertEqual(StationVisit.objects.get().arrived, True)
+
+
+class StreamTicketTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='rider')
+
+    def test_ticket_is_single_use(self):
+        ticket = issue_ticket(self.user)
+        self.assertEqual(redeem_ticket(ticket), self.user.id)
+        self.assertIsNone(redeem_ticket(ticket))
+
+    def test_expired_or_forged_ticket_is_refused(self):
+        ticket = issue_ticket(self.user)
+        later = time.time() + TICKET_SECONDS + 1
+        with mock.patch('django.core.signing.time.time', return_value=later):
+            self.assertIsNone(redeem_ticket(ticket))
+        self.assertIsNone(redeem_ticket(ticket[:-2] + 'xx'))
+
+
+class AdminBusStatusTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+
+    def test_bbox_must_be_a_box_on_the_globe(self):
+        url = reverse('admin-bus-status')
+        self.assertEqual(self.client.get(url, {'bbox': '37,-123,38,-122'}).status_code, 200)
+        for bbox in ['38,-123,37,-122', '37,-122,38,-123', 'nan,-123,38,-122', '37,-123,inf,-122',
+                     '-91,-123,38,-122', '37,-181,38,-122', '37,-123,38']:
+            self.assertEqual(self.client.get(url, {'bbox': bbox}).status_code, 400, bbox)
+
+
+GTFS_FEED = {
+    'stops.txt': "stop_id,stop_name,stop_lat,stop_lon\nA,Stop A,37.70,-122.40\nB,Stop B,37.71,-122.41\n",
+    'routes.txt': "route_id,route_short_name,route_type\nR,1,3\n",
+    'trips.txt': "route_id,service_id,trip_id\nR,WK,T1\n",
+    'calendar.txt': "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+                    "WK,1,1,1,1,1,1,1,20260101,20261231\n",
+    'stop_times.txt': "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+                      "T1,08:00:00,08:00:00,A,1\nT1,08:10:00,08:10:00,B,2\n",
+}
+
+
+class GtfsImportErrorTests(TestCase):
+    def feed(self, **files):
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w') as feed:
+            for name, text in {**GTFS_FEED, **files}.items():
+                feed.writestr(name, text if isinstance(text, bytes) else text.encode())
+        output.seek(0)
+        return output
+
+    def assert_rejected(self, message, **files):
+        with self.assertRaisesMessage(GtfsError, message):
+            import_feed(self.feed(**files), date(2026, 6, 1), days=1)
+
+    def test_valid_feed_imports(self):
+        counts = import_feed(self.feed(), date(2026, 6, 1), days=1)
+        self.assertEqual((counts['schedules'], counts['stop_times']), (1, 2))
+
+    def test_bad_values_name_the_file_and_line(self):
+        self.assert_rejected("stops.txt line 3: invalid stop_lat 'north'",
+                             **{'stops.txt': GTFS_FEED['stops.txt'].replace('37.71', 'north')})
+        self.assert_rejected("stop_times.txt line 3: invalid stop_sequence 'two'",
+                             **{'stop_times.txt': GTFS_FEED['stop_times.txt'].replace('B,2', 'B,two')})
+        self.assert_rejected("stop_times.txt line 2: Invalid time '8am'",
+                             **{'stop_times.txt': GTFS_FEED['stop_times.txt'].replace('08:00:00,08', '8am,08')})
+        self.assert_rejected("calendar.txt line 2: Invalid date '2026-12-31'",
+                             **{'calendar.txt': GTFS_FEED['calendar.txt'].replace('20261231', '2026-12-31')})
+
+    def test_missing_column(self):
+        self.assert_rejected("trips.txt line 2: no service_id",
+                             **{'trips.txt': "route_id,trip_id\nR,T1\n"})
+
+    def test_undecodable_and_malformed_csv(self):
+        self.assert_rejected("stops.txt is not UTF-8",
+                             **{'stops.txt': GTFS_FEED['stops.txt'].encode() + b"C,\xff\xfe,37.72,-122.42\n"})
+        self.assert_rejected("stops.txt line 2: field larger than field limit",
+                             **{'stops.txt': f"stop_id,stop_name,stop_lat,stop_lon\nA,{'x' * 200000},37.7,-122.4\n"})
+
+    def test_large_feed_is_refused_before_importing(self):
+        with self.assertRaises(FeedTooLarge):
+            import_feed(self.feed(), date(2026, 6, 1), days=1, max_size=100)
+        self.assertFalse(Station.objects.exists())
@@ -8,18 +8,33 @@ router.register(r'admin/stations', views.AdminStationViewSet)
 router.register(r'admin/routes', views.AdminRouteViewSet)
 router.register(r'admin/schedules', views.AdminScheduleViewSet)
 router.register(r'admin/alerts', views.AdminAlertViewSet)
+router.register(r'admin/schedule-templates', views.AdminScheduleTemplateViewSet)
 
 urlpatterns = [
-    path('', include(router.urls)),
-    
     # User API endpoints
     path('stations/', views.StationListView.as_view(), name='station-list'),
+    path('stations/nearby/', views.nearby_stations, name='stations-nearby'),
     path('buses/search/', views.search_buses, name='search-buses'),
+    path('journeys/', views.plan_journeys, name='plan-journeys'),
     path('buses/<int:bus_id>/', views.get_bus_details, name='bus-details'),
     path('buses/<int:bus_id>/location/', views.get_bus_location, name='bus-location'),
+    path('buses/<int:bus_id>/stations/', views.bus_stations, name='bus-stations'),
+    path('routes/<int:route_id>/shape/', views.get_route_shape, name='route-shape'),
+    path('bus/location/update/', views.update_bus_locations, name='bus-location-update'),
+    path('station/update/', views.update_station_sightings, name='station-update'),
+    path('buses/stream/', views.stream_locations, name='bus-location-stream'),
+    path('buses/stream/ticket/', views.stream_ticket, name='bus-location-stream-ticket'),
     path('bookings/', views.create_booking, name='create-booking'),
+    path('schedules/<int:schedule_id>/seats/', views.schedule_seats, name='schedule-seats'),
     
     # Admin API endpoints
     path('admin/dashboard/stats/', views.admin_dashboard_stats, name='admin-dashboard-stats'),
+    path('admin/metrics/', views.admin_metrics, name='admin-metrics'),
     path('admin/buses/status/', views.admin_bus_status, name='admin-bus-status'),
+    path('admin/buses/<int:bus_id>/history/', views.admin_bus_history, name='admin-bus-history'),
+    path('admin/gtfs/import/', views.admin_gtfs_import, name='admin-gtfs-import'),
+    path('admin/gtfs/export/', views.admin_gtfs_export, name='admin-gtfs-export'),
+    
+    # Router last, so admin/buses/<pk>/ does not swallow admin/buses/status/
+    path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,26 +1,99 @@
-from rest_framework import viewsets, permissions, status, generics
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework import viewsets, permissions, status, generics, exceptions
+from rest_framework.decorators import api_view, permission_classes, parser_classes, action
 from rest_framework.response import Response
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.db.models import Prefetch, Q
 from django.utils import timezone
-from datetime import timedelta
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
+from datetime import date, timedelta
+import hashlib
+import math
+import tempfile
 
 from .models import (
     Station, Route, RoutePoint, Bus, Schedule, 
-    StationSchedule, BusLocation, Alert, Booking
+    StationSchedule, BusLocation, Alert, ScheduleTemplate
 )
 from .serializers import (
     UserSerializer, StationSerializer, RouteSerializer, 
     BusSerializer, ScheduleSerializer, BusLocationSerializer,
-    AlertSerializer, BookingSerializer
+    AlertSerializer, BookingSerializer, ScheduleTemplateSerializer
 )
+from .search import search_schedules, load_stops, stop_data
+from .journeys import planner
+from .ingest import ingest, InvalidFix
+from .arrivals import ingest_reports, InvalidReport
+from .parsers import GzipJSONParser
+from .history import locations_between
+from .geo import station_index
+from .geometry import snap_positions, progress_data
+from .eta import eta_engine, predicted_times
+from .streaming import Subscriber, stream, issue_ticket, redeem_ticket, MAX_SUBSCRIBED_BUSES, TICKET_SECONDS
+from .fleet import fleet_snapshot, filter_fleet
+from .schedule_templates import generate as generate_schedules, TemplateError
+from .gtfs import import_feed, export_feed, GtfsError, FeedTooLarge
+from .response_cache import CachedResponseMixin
+from .instrumentation import metrics_text
+from . import counters, dead_reckoning, polyline, seats
 
 # User API views
-class StationListView(generics.ListAPIView):
+class StationListView(CachedResponseMixin, generics.ListAPIView):
     queryset = Station.objects.all()
     serializer_class = StationSerializer
     permission_classes = [permissions.IsAuthenticated]
+    cache_models = [Station]
+
+NEARBY_MAX_RADIUS_KM = 20
+
+# Used for ETAs when the caller does not report a speed, or is crawling
+DEFAULT_SPEED_KMH = 20
+MIN_SPEED_KMH = 5
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def nearby_stations(request):
+    try:
+        latitude = float(request.query_params['latitude'])
+        longitude = float(request.query_params['longitude'])
+        radius = float(request.query_params.get('radius', 0.5))
+        speed = request.query_params.get('speed')
+        # Speed is reported by gpsd in m/s
+        speed_kmh = float(speed) * 3.6 if speed is not None else DEFAULT_SPEED_KMH
+        # gpsd reports NaN for a speed it cannot determine
+        if not math.isfinite(speed_kmh):
+            raise ValueError(speed)
+    except (KeyError, ValueError):
+        return Response(
+            {"error": "latitude and longitude are required; radius (km) and speed (m/s) must be numbers"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and 0 < radius <= NEARBY_MAX_RADIUS_KM):
+        return Response(
+            {"error": f"Coordinates out of range or radius not within 0-{NEARBY_MAX_RADIUS_KM} km"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    speed_kmh = max(speed_kmh, MIN_SPEED_KMH)
+    data = []
+    for distance, station_id, name, s_lat, s_lon in station_index.nearby(latitude, longitude, radius):
+        data.append({
+            'id': station_id,
+            'name': name,
+            'latitude': s_lat,
+            'longitude': s_lon,
+            'distance': round(distance, 3),
+            'eta': round(distance / speed_kmh * 60, 1)  # minutes
+        })
+    
+    return Response(data)
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
@@ -35,6 +108,15 @@ def search_buses(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
+    try:
+        start_station_id = int(start_station_id)
+        end_station_id = int(end_station_id)
+    except ValueError:
+        return Response(
+            {"error": "Invalid station"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
     # Parse the time
     try:
         search_time = timezone.datetime.strptime(time_str, '%H:%M').time()
@@ -46,51 +128,73 @@ def search_buses(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    # Find schedules that match the criteria
-    schedules = Schedule.objects.filter(
-        start_station_id=start_station_id,
-        end_station_id=end_station_id,
-        departure_time__gte=search_datetime,
-        is_active=True
-    ).select_related('bus', 'start_station', 'end_station')
+    # Find schedules that stop at both stations in the right order
+    data = search_schedules(start_station_id, end_station_id, search_datetime)
+    
+    return Response(data)
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def plan_journeys(request):
+    start_station_id = request.query_params.get('startStation')
+    end_station_id = request.query_params.get('endStation')
+    time_str = request.query_params.get('time')
+    
+    if not all([start_station_id, end_station_id, time_str]):
+        return Response(
+            {"error": "Start station, end station, and time are required"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    try:
+        start_station_id = int(start_station_id)
+        end_station_id = int(end_station_id)
+        max_transfers = int(request.query_params.get('maxTransfers', 2))
+    except ValueError:
+        return Response(
+            {"error": "Invalid station or transfer count"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    # Parse the time
+    try:
+        search_time = timezone.datetime.strptime(time_str, '%H:%M').time()
+        today = timezone.now().date()
+        search_datetime = timezone.make_aware(timezone.datetime.combine(today, search_time))
+    except ValueError:
+        return Response(
+            {"error": "Invalid time format. Use HH:MM"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    journeys = planner.plan(start_station_id, end_station_id, search_datetime, max_transfers)
+    
+    # Resolve names for every leg in two queries
+    schedule_ids = {leg['schedule_id'] for legs in journeys for leg in legs}
+    station_ids = {leg[key] for legs in journeys for leg in legs for key in ('from_station', 'to_station')}
+    schedules = Schedule.objects.select_related('bus').in_bulk(schedule_ids)
+    stations = Station.objects.in_bulk(station_ids)
     
-    # Prepare the response data
     data = []
-    for schedule in schedules:
-        # Get the bus location if available
-        try:
-            location = BusLocation.objects.get(bus=schedule.bus)
-            location_data = {
-                'latitude': location.latitude,
-                'longitude': location.longitude
-            }
-        except BusLocation.DoesNotExist:
-            location_data = None
-        
-        # Get all stops for this schedule
-        stops = StationSchedule.objects.filter(
-            schedule=schedule
-        ).select_related('station').order_by('order')
-        
-        stops_data = []
-        for stop in stops:
-            stops_data.append({
-                'id': stop.station.id,
-                'name': stop.station.name,
-                'arrival_time': stop.arrival_time,
-                'departure_time': stop.departure_time
+    for legs in journeys:
+        legs_data = []
+        for leg in legs:
+            bus = schedules[leg['schedule_id']].bus
+            legs_data.append({
+                'schedule_id': leg['schedule_id'],
+                'bus_number': bus.number,
+                'bus_type': bus.type,
+                'from_station': {'id': leg['from_station'], 'name': stations[leg['from_station']].name},
+                'to_station': {'id': leg['to_station'], 'name': stations[leg['to_station']].name},
+                'departure_time': leg['departure_time'],
+                'arrival_time': leg['arrival_time']
             })
         
         data.append({
-            'id': schedule.id,
-            'bus_number': schedule.bus.number,
-            'bus_type': schedule.bus.type,
-            'departure_time': schedule.departure_time,
-            'arrival_time': schedule.arrival_time,
-            'start_station': schedule.start_station.name,
-            'end_station': schedule.end_station.name,
-            'current_location': location_data,
-            'stops': stops_data
+            'departure_time': legs[0]['departure_time'],
+            'arrival_time': legs[-1]['arrival_time'],
+            'transfers': len(legs) - 1,
+            'legs': legs_data
         })
     
     return Response(data)
@@ -99,13 +203,21 @@ def search_buses(request):
 @permission_classes([permissions.IsAuthenticated])
 def get_bus_details(request, bus_id):
     bus = get_object_or_404(Bus, id=bus_id)
+    try:
+        detail = polyline.parse_detail(request.query_params)
+    except ValueError:
+        return Response(
+            {"error": "zoom and tolerance must be numbers"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     
-    # Get active schedules for this bus
-    schedules = Schedule.objects.filter(
+    # Get active schedules for this bus, including the one under way
+    schedules = list(Schedule.objects.filter(
         bus=bus,
         is_active=True,
-        departure_time__gte=timezone.now()
-    ).select_related('start_station', 'end_station').order_by('departure_time')
+        arrival_time__gte=timezone.now()
+    ).select_related('start_station', 'end_station').order_by('departure_time'))
+    stops = load_stops([schedule.id for schedule in schedules])
     
     # Get the current location
     try:
@@ -113,40 +225,56 @@ def get_bus_details(request, bus_id):
         location_data = {
             'latitude': location.latitude,
             'longitude': location.longitude,
-            'timestamp': location_data.timestamp
+            'timestamp': location.timestamp,
+            'estimated': dead_reckoning.estimate(location)
         }
     except BusLocation.DoesNotExist:
+        location = None
         location_data = None
     
-    # Get the route points
-    route_points = []
-    if bus.route:
-        points = RoutePoint.objects.filter(route=bus.route).order_by('order')
-        route_points = [{'latitude': p.latitude, 'longitude': p.longitude} for p in points]
+    # The route as an encoded polyline at the requested detail; the full
+    # point list only for clients that ask for it
+    route_shape = None
+    route_points = None
+    if bus.route_id:
+        route_shape = polyline.shape_data(polyline.get_shapes([bus.route_id]).get(bus.route_id), detail)
+        if request.query_params.get('geometry') == 'points':
+            points = RoutePoint.objects.filter(route_id=bus.route_id).order_by('order')
+            route_points = [{'latitude': p.latitude, 'longitude': p.longitude} for p in points]
+    
+    # Where the bus is along its route and which stop comes next
+    progress = None
+    if location and bus.route_id:
+        estimated = location_data['estimated']
+        snapped = snap_positions([(bus.id, bus.route_id, estimated['latitude'], estimated['longitude'])])
+        if bus.id in snapped:
+            current_stops = stops[schedules[0].id] if schedules else None
+            progress = progress_data(*snapped[bus.id], stops=current_stops)
+    
+    # Live arrival predictions for the trip the bus is on
+    predictions = []
+    prediction = eta_engine.predictions([bus.id]).get(bus.id)
+    if prediction:
+        predicted = predicted_times(prediction, prediction['schedule_id'])
+        for stop in stops.get(prediction['schedule_id'], []):
+            if stop.order in predicted:
+                predictions.append({
+                    'id': stop.station.id,
+                    'name': stop.station.name,
+                    'scheduled_arrival': stop.arrival_time,
+                    'predicted_arrival': predicted[stop.order]
+                })
     
     # Prepare schedule data
     schedule_data = []
     for schedule in schedules:
-        stops = StationSchedule.objects.filter(
-            schedule=schedule
-        ).select_related('station').order_by('order')
-        
-        stops_data = []
-        for stop in stops:
-            stops_data.append({
-                'id': stop.station.id,
-                'name': stop.station.name,
-                'arrival_time': stop.arrival_time,
-                'departure_time': stop.departure_time
-            })
-        
         schedule_data.append({
             'id': schedule.id,
             'departure_time': schedule.departure_time,
             'arrival_time': schedule.arrival_time,
             'start_station': schedule.start_station.name,
             'end_station': schedule.end_station.name,
-            'stops': stops_data
+            'stops': [stop_data(stop) for stop in stops[schedule.id]]
         })
     
     data = {
@@ -156,12 +284,78 @@ def get_bus_details(request, bus_id):
         'capacity': bus.capacity,
         'is_active': bus.is_active,
         'current_location': location_data,
-        'route_points': route_points,
+        'progress': progress,
+        'predictions': predictions,
+        'route_shape': route_shape,
         'schedules': schedule_data
     }
+    if route_points is not None:
+        data['route_points'] = route_points
     
     return Response(data)
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def get_route_shape(request, route_id):
+    route = get_object_or_404(Route, id=route_id)
+    try:
+        detail = polyline.parse_detail(request.query_params)
+    except ValueError:
+        return Response(
+            {"error": "zoom and tolerance must be numbers"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    shape = polyline.get_shapes([route.id]).get(route.id)
+    if shape is None:
+        return Response(
+            {"error": "This route has no geometry"},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    return Response({'route_id': route.id, **polyline.shape_data(shape, detail)})
+
+# Window of schedules whose stops make up a tracker's station set
+TRACKER_STATIONS_PAST = timedelta(days=1)
+TRACKER_STATIONS_AHEAD = timedelta(days=7)
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def bus_stations(request, bus_id):
+    # The stations a bus's route serves, for the tracker to cache. The ETag
+    # is a hash of the set, so a tracker's periodic refresh is a 304 until
+    # it changes.
+    bus = get_object_or_404(Bus, id=bus_id)
+    now = timezone.now()
+    served = StationSchedule.objects.filter(
+        schedule__departure_time__gte=now - TRACKER_STATIONS_PAST,
+        schedule__departure_time__lt=now + TRACKER_STATIONS_AHEAD,
+    )
+    if bus.route_id:
+        served = served.filter(schedule__bus__route_id=bus.route_id)
+    else:
+        served = served.filter(schedule__bus_id=bus.id)
+    stations = list(Station.objects.filter(id__in=served.values('station_id')).order_by('id').values_list(
+        'id', 'name', 'latitude', 'longitude'
+    ))
+    version = hashlib.sha1(repr((bus.route_id, stations)).encode()).hexdigest()
+    etag = f'"{version}"'
+    
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    
+    response = Response({
+        'bus_id': bus.id,
+        'route_id': bus.route_id,
+        'version': version,
+        'stations': [
+            {'id': station_id, 'name': name, 'latitude': lat, 'longitude': lon}
+            for station_id, name, lat, lon in stations
+        ]
+    })
+    response['ETag'] = etag
+    return response
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def get_bus_location(request, bus_id):
@@ -172,7 +366,9 @@ def get_bus_location(request, bus_id):
             'longitude': location.longitude,
             'speed': location.speed,
             'heading': location.heading,
-            'timestamp': location.timestamp
+            'timestamp': location.timestamp,
+            # Adaptive trackers report less often; this is where the last fix puts the bus now
+            'estimated': dead_reckoning.estimate(location)
         })
     except BusLocation.DoesNotExist:
         return Response(
@@ -180,6 +376,114 @@ def get_bus_location(request, bus_id):
             status=status.HTTP_404_NOT_FOUND
         )
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+@parser_classes([GzipJSONParser])
+def update_bus_locations(request):
+    # Accepts one fix or a batch of fixes from one or many buses, plain or
+    # gzip-compressed
+    try:
+        result = ingest(request.data)
+    except InvalidFix as e:
+        return Response(
+            {"error": str(e)},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    return Response(result)
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+@parser_classes([GzipJSONParser])
+def update_station_sightings(request):
+    # Buses heard by station receivers: one station's report or a batch of
+    # reports from many stations
+    try:
+        result = ingest_reports(request.data)
+    except InvalidReport as e:
+        return Response(
+            {"error": str(e)},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    return Response(result)
+
+def _valid_bbox(bbox):
+    # min_lat,min_lon,max_lat,max_lon on the globe, minimums first; the
+    # chained comparisons are False for nan
+    if len(bbox) != 4:
+        return False
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return -90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180
+
+def _location_snapshot(bus_ids, route_id, bbox):
+    query = Q(bus_id__in=bus_ids)
+    if route_id is not None:
+        query |= Q(bus__route_id=route_id)
+    if bbox is not None:
+        query |= Q(latitude__range=(bbox[0], bbox[2]), longitude__range=(bbox[1], bbox[3]))
+    return list(BusLocation.objects.filter(query).values(
+        'bus_id', 'bus__route_id', 'latitude', 'longitude', 'speed', 'heading', 'timestamp'
+    ))
+
+def _authenticate_stream(request):
+    # EventSource cannot set headers, so browsers pass a ticket from
+    # stream_ticket; other clients send their usual credentials
+    ticket = request.GET.get('ticket')
+    if ticket:
+        user_id = redeem_ticket(ticket)
+        return User.objects.filter(id=user_id, is_active=True).first() if user_id is not None else None
+    authenticators = [auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    try:
+        return Request(request, authenticators=authenticators).user
+    except exceptions.APIException:
+        return None
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def stream_ticket(request):
+    return Response({'ticket': issue_ticket(request.user), 'expires_in': TICKET_SECONDS})
+
+async def stream_locations(request):
+    """
+    Server-Sent Events stream of live locations for ?buses=1,2,3, ?route=<id>
+    and/or ?bbox=min_lat,min_lon,max_lat,max_lon. Runs as a plain async view
+    so an ASGI worker can hold thousands of open streams. Browsers
+    authenticate with ?ticket= from stream_ticket.
+    """
+    user = await sync_to_async(_authenticate_stream)(request)
+    if user is None or not user.is_authenticated:
+        return JsonResponse({"error": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED)
+    
+    try:
+        bus_ids = [int(b) for b in request.GET.get('buses', '').split(',') if b]
+        route_id = int(request.GET['route']) if request.GET.get('route') else None
+        bbox = [float(v) for v in request.GET['bbox'].split(',')] if request.GET.get('bbox') else None
+    except ValueError:
+        return JsonResponse({"error": "Invalid buses, route or bbox"}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if bbox is not None and not _valid_bbox(bbox):
+        return JsonResponse({"error": "bbox must be min_lat,min_lon,max_lat,max_lon"},
+                            status=status.HTTP_400_BAD_REQUEST)
+    if not (bus_ids or route_id is not None or bbox is not None):
+        return JsonResponse({"error": "Subscribe to buses, a route or a bbox"},
+                            status=status.HTTP_400_BAD_REQUEST)
+    if len(bus_ids) > MAX_SUBSCRIBED_BUSES:
+        return JsonResponse({"error": f"At most {MAX_SUBSCRIBED_BUSES} buses per stream"},
+                            status=status.HTTP_400_BAD_REQUEST)
+    
+    async def load_snapshot():
+        snapshot = await sync_to_async(_location_snapshot)(bus_ids, route_id, bbox)
+        for location in snapshot:
+            location['route_id'] = location.pop('bus__route_id')
+        return snapshot
+    
+    subscriber = Subscriber(bus_ids=bus_ids, route_id=route_id, bbox=bbox)
+    response = StreamingHttpResponse(stream(subscriber, load_snapshot), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def create_booking(request):
@@ -195,162 +499,385 @@ def create_booking(request):
         )
     
     try:
-        schedule = Schedule.objects.get(id=schedule_id, is_active=True)
-        boarding_station = Station.objects.get(id=boarding_station_id)
-        destination_station = Station.objects.get(id=destination_station_id)
-        
-        # Check if the stations are on the schedule's route
-        boarding_in_schedule = StationSchedule.objects.filter(
-            schedule=schedule, station=boarding_station
-        ).exists()
-        
-        destination_in_schedule = StationSchedule.objects.filter(
-            schedule=schedule, station=destination_station
-        ).exists()
-        
-        if not (boarding_in_schedule and destination_in_schedule):
-            return Response(
-                {"error": "Selected stations are not on this bus route"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Create the booking
-        booking = Booking.objects.create(
-            user=user,
-            schedule=schedule,
-            boarding_station=boarding_station,
-            destination_station=destination_station,
-            status='confirmed'
+        schedule_id = int(schedule_id)
+        boarding_station_id = int(boarding_station_id)
+        destination_station_id = int(destination_station_id)
+    except (TypeError, ValueError):
+        return Response(
+            {"error": "Invalid schedule or station"},
+            status=status.HTTP_400_BAD_REQUEST
         )
-        
-        serializer = BookingSerializer(booking)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
-        
+    
+    try:
+        booking = seats.book(user, schedule_id, boarding_station_id, destination_station_id)
     except Schedule.DoesNotExist:
         return Response(
             {"error": "Invalid schedule"},
             status=status.HTTP_400_BAD_REQUEST
         )
-    except Station.DoesNotExist:
+    except seats.InvalidSegment:
+        station_ids = {boarding_station_id, destination_station_id}
+        if Station.objects.filter(id__in=station_ids).count() < len(station_ids):
+            return Response(
+                {"error": "Invalid station"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         return Response(
-            {"error": "Invalid station"},
+            {"error": "Selected stations are not on this bus route"},
             status=status.HTTP_400_BAD_REQUEST
         )
+    except seats.SeatsUnavailable as e:
+        return Response(
+            {"error": str(e)},
+            status=status.HTTP_409_CONFLICT
+        )
+    
+    serializer = BookingSerializer(booking)
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def schedule_seats(request, schedule_id):
+    schedule = get_object_or_404(Schedule.objects.select_related('bus'), id=schedule_id, is_active=True)
+    stops = seats.load_stops(schedule_id)
+    counts = seats.availability(schedule_id, stops)
+    capacity = schedule.bus.capacity
+    
+    data = {
+        'schedule_id': schedule.id,
+        'capacity': capacity,
+        'legs': [
+            {
+                'from_station': stops[i][1],
+                'to_station': stops[i + 1][1],
+                'seats_free': seats.seats_free(counts, capacity, i, i + 1)
+            }
+            for i in range(len(counts))
+        ]
+    }
+    
+    boarding_station_id = request.query_params.get('boarding_station')
+    destination_station_id = request.query_params.get('destination_station')
+    if boarding_station_id and destination_station_id:
+        try:
+            i, j = seats.find_segment(stops, int(boarding_station_id), int(destination_station_id))
+        except ValueError:
+            return Response(
+                {"error": "Selected stations are not on this bus route"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        data['seats_free'] = seats.seats_free(counts, capacity, i, j)
+    
+    return Response(data)
 
 # Admin API views
+class AdminCursorPagination(CursorPagination):
+    # Keyset pages: each page is an index range scan from the cursor, so
+    # page 1000 costs the same as page 1. Views set cursor_ordering to an
+    # order their indexes serve, ending in a unique field.
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', self.ordering)
+        return (ordering,) if isinstance(ordering, str) else tuple(ordering)
+
+def _int_param(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise exceptions.ValidationError({"error": f"{name} must be an integer"})
+
+def _bool_param(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    if value.lower() not in ('true', 'false', '1', '0'):
+        raise exceptions.ValidationError({"error": f"{name} must be true or false"})
+    return value.lower() in ('true', '1')
+
+def _datetime_param(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        # Well formed but impossible, such as February 30
+        parsed = None
+    if parsed is None:
+        raise exceptions.ValidationError({"error": f"{name} must be an ISO 8601 datetime"})
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
 class AdminBusViewSet(viewsets.ModelViewSet):
-    queryset = Bus.objects.all()
+    # BusSerializer reads the route name and the current location
+    queryset = Bus.objects.select_related('route', 'location')
     serializer_class = BusSerializer
     permission_classes = [permissions.IsAdminUser]
+    pagination_class = AdminCursorPagination
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        route_id = _int_param(params, 'route')
+        if route_id is not None:
+            queryset = queryset.filter(route_id=route_id)
+        is_active = _bool_param(params, 'is_active')
+        if is_active is not None:
+            queryset = queryset.filter(is_active=is_active)
+        return queryset
 
 class AdminStationViewSet(viewsets.ModelViewSet):
     queryset = Station.objects.all()
     serializer_class = StationSerializer
     permission_classes = [permissions.IsAdminUser]
+    pagination_class = AdminCursorPagination
 
-class AdminRouteViewSet(viewsets.ModelViewSet):
-    queryset = Route.objects.all()
+class AdminRouteViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    queryset = Route.objects.select_related('shape')
     serializer_class = RouteSerializer
     permission_classes = [permissions.IsAdminUser]
+    pagination_class = AdminCursorPagination
+    cache_models = [Route, RoutePoint]
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # Points are only serialized when asked for
+        if self.request.query_params.get('geometry') == 'points':
+            queryset = queryset.prefetch_related('points')
+        return queryset
 
 class AdminScheduleViewSet(viewsets.ModelViewSet):
-    queryset = Schedule.objects.all()
+    # Everything ScheduleSerializer and its nested stops read, in three queries per page
+    queryset = Schedule.objects.select_related('bus', 'start_station', 'end_station').prefetch_related(
+        Prefetch('station_schedules', queryset=StationSchedule.objects.select_related('station'))
+    )
     serializer_class = ScheduleSerializer
     permission_classes = [permissions.IsAdminUser]
+    pagination_class = AdminCursorPagination
+    cursor_ordering = ('departure_time', 'id')
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        departure_after = _datetime_param(params, 'departure_after')
+        if departure_after is not None:
+            queryset = queryset.filter(departure_time__gte=departure_after)
+        departure_before = _datetime_param(params, 'departure_before')
+        if departure_before is not None:
+            queryset = queryset.filter(departure_time__lt=departure_before)
+        bus_id = _int_param(params, 'bus')
+        if bus_id is not None:
+            queryset = queryset.filter(bus_id=bus_id)
+        route_id = _int_param(params, 'route')
+        if route_id is not None:
+            queryset = queryset.filter(bus__route_id=route_id)
+        is_active = _bool_param(params, 'is_active')
+        if is_active is not None:
+            queryset = queryset.filter(is_active=is_active)
+        return queryset
+
+# Longest range one generate call may expand
+MAX_GENERATE_DAYS = 62
+
+class AdminScheduleTemplateViewSet(viewsets.ModelViewSet):
+    queryset = ScheduleTemplate.objects.prefetch_related('stops__station', 'buses')
+    serializer_class = ScheduleTemplateSerializer
+    permission_classes = [permissions.IsAdminUser]
+    pagination_class = AdminCursorPagination
+    
+    @action(detail=True, methods=['post'])
+    def generate(self, request, pk=None):
+        template = self.get_object()
+        try:
+            start_date = date.fromisoformat(request.data.get('start_date') or timezone.localdate().isoformat())
+            days = int(request.data.get('days', 7))
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "Invalid start_date (YYYY-MM-DD) or days"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not 1 <= days <= MAX_GENERATE_DAYS:
+            return Response(
+                {"error": f"days must be between 1 and {MAX_GENERATE_DAYS}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            result = generate_schedules(template, start_date, days)
+        except TemplateError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
 
 class AdminAlertViewSet(viewsets.ModelViewSet):
-    queryset = Alert.objects.all().order_by('-created_at')
+    queryset = Alert.objects.select_related('bus', 'station')
     serializer_class = AlertSerializer
     permission_classes = [permissions.IsAdminUser]
+    pagination_class = AdminCursorPagination
+    cursor_ordering = ('-created_at', '-id')
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        is_resolved = _bool_param(params, 'is_resolved')
+        if is_resolved is not None:
+            queryset = queryset.filter(is_resolved=is_resolved)
+        bus_id = _int_param(params, 'bus')
+        if bus_id is not None:
+            queryset = queryset.filter(bus_id=bus_id)
+        station_id = _int_param(params, 'station')
+        if station_id is not None:
+            queryset = queryset.filter(station_id=station_id)
+        created_after = _datetime_param(params, 'created_after')
+        if created_after is not None:
+            queryset = queryset.filter(created_at__gte=created_after)
+        created_before = _datetime_param(params, 'created_before')
+        if created_before is not None:
+            queryset = queryset.filter(created_at__lt=created_before)
+        return queryset
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAdminUser])
 def admin_dashboard_stats(request):
-    total_buses = Bus.objects.count()
-    active_buses = Bus.objects.filter(is_active=True).count()
-    total_stations = Station.objects.count()
-    total_routes = Route.objects.count()
-    
-    # Get today's bookings
-    today = timezone.now().date()
-    today_bookings = Booking.objects.filter(
-        booking_time__date=today
-    ).count()
-    
-    # Get active schedules
-    active_schedules = Schedule.objects.filter(
-        is_active=True,
-        departure_time__gte=timezone.now()
-    ).count()
+    # Counters are kept current by model signals; the first read after a
+    # fresh install (or a wiped counter table) rebuilds them once.
+    stats = counters.read()
+    if stats is None:
+        counters.reconcile()
+        stats = counters.read()
+    return Response(stats)
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def admin_metrics(request):
+    # Request metrics of this process in the Prometheus text format
+    return HttpResponse(metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class FleetPagination(PageNumberPagination):
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def admin_bus_status(request):
+    # Status of every active bus, from a snapshot shared by all admins
+    try:
+        route_id = int(request.query_params['route']) if request.query_params.get('route') else None
+        bbox = request.query_params.get('bbox')
+        bbox = [float(v) for v in bbox.split(',')] if bbox else None
+    except ValueError:
+        return Response(
+            {"error": "Invalid route or bbox"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if bbox is not None and not _valid_bbox(bbox):
+        return Response(
+            {"error": "bbox must be min_lat,min_lon,max_lat,max_lon"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     
-    # Get unresolved alerts
-    unresolved_alerts = Alert.objects.filter(
-        is_resolved=False
-    ).count()
+    data = filter_fleet(fleet_snapshot(), route_id=route_id, bbox=bbox)
     
-    return Response({
-        'total_buses': total_buses,
-        'active_buses': active_buses,
-        'total_stations': total_stations,
-        'total_routes': total_routes,
-        'today_bookings': today_bookings,
-        'active_schedules': active_schedules,
-        'unresolved_alerts': unresolved_alerts
-    })
+    # Paginate only when asked, so existing clients still get a plain list
+    if 'page' in request.query_params or 'page_size' in request.query_params:
+        paginator = FleetPagination()
+        page = paginator.paginate_queryset(data, request)
+        return paginator.get_paginated_response(page)
+    
+    return Response(data)
+
+HISTORY_MAX_ROWS = 10000
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAdminUser])
-def admin_bus_status(request):
-    # Get all active buses with their current location and schedule
-    active_buses = Bus.objects.filter(is_active=True)
+def admin_bus_history(request, bus_id):
+    try:
+        start = parse_datetime(request.query_params.get('start', ''))
+        end = parse_datetime(request.query_params.get('end', ''))
+    except ValueError:
+        # Well formed but impossible, such as February 30
+        start = end = None
+    resolution = request.query_params.get('resolution', 'raw')
+    
+    if start is None or end is None or resolution not in ('raw', 'minute'):
+        return Response(
+            {"error": "start and end must be ISO 8601 datetimes and resolution raw or minute"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if timezone.is_naive(start):
+        start = timezone.make_aware(start)
+    if timezone.is_naive(end):
+        end = timezone.make_aware(end)
+    
+    rows = list(locations_between(bus_id, start, end, resolution)[:HISTORY_MAX_ROWS + 1])
+    truncated = len(rows) > HISTORY_MAX_ROWS
     
     data = []
-    for bus in active_buses:
-        # Get current location
-        try:
-            location = BusLocation.objects.get(bus=bus)
-            location_data = {
-                'latitude': location.latitude,
-                'longitude': location.longitude,
-                'updated_at': location.timestamp
-            }
-        except BusLocation.DoesNotExist:
-            location_data = None
-        
-        # Get current or next schedule
-        current_time = timezone.now()
-        schedule = Schedule.objects.filter(
-            bus=bus,
-            is_active=True,
-            departure_time__lte=current_time,
-            arrival_time__gte=current_time
-        ).first()
-        
-        if not schedule:
-            # Get next schedule
-            schedule = Schedule.objects.filter(
-                bus=bus,
-                is_active=True,
-                departure_time__gt=current_time
-            ).order_by('departure_time').first()
-        
-        if schedule:
-            schedule_data = {
-                'id': schedule.id,
-                'start_station': schedule.start_station.name,
-                'end_station': schedule.end_station.name,
-                'departure_time': schedule.departure_time,
-                'arrival_time': schedule.arrival_time
-            }
-        else:
-            schedule_data = None
-        
-        data.append({
-            'id': bus.id,
-            'number': bus.number,
-            'type': bus.type,
-            'location': location_data,
-            'current_schedule': schedule_data
-        })
+    for row in rows[:HISTORY_MAX_ROWS]:
+        lat = row.pop('lat_e6') / 1e6
+        lon = row.pop('lon_e6') / 1e6
+        data.append({'latitude': lat, 'longitude': lon, **row})
     
-    return Response(data)
\ No newline at end of file
+    return Response({
+        'bus': bus_id,
+        'resolution': resolution,
+        'truncated': truncated,
+        'locations': data
+    })
+
+# Longest window one GTFS import may expand
+GTFS_MAX_DAYS = 62
+# Largest feed, uncompressed, imported inside a request; bigger ones take
+# minutes and go through the import_gtfs command
+GTFS_MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def admin_gtfs_import(request):
+    feed = request.FILES.get('feed')
+    if feed is None:
+        return Response(
+            {"error": "Upload the GTFS zip as 'feed'"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        start_date = date.fromisoformat(request.data.get('start_date') or timezone.localdate().isoformat())
+        days = int(request.data.get('days', 7))
+        bus_capacity = int(request.data.get('bus_capacity', 50))
+    except (TypeError, ValueError):
+        return Response(
+            {"error": "Invalid start_date (YYYY-MM-DD), days or bus_capacity"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if not 1 <= days <= GTFS_MAX_DAYS:
+        return Response(
+            {"error": f"days must be between 1 and {GTFS_MAX_DAYS}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    try:
+        counts = import_feed(feed, start_date, days=days, bus_capacity=bus_capacity,
+                             max_size=GTFS_MAX_UPLOAD_SIZE)
+    except FeedTooLarge as e:
+        return Response(
+            {"error": f"{e}. Import it with the import_gtfs management command."},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        )
+    except GtfsError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(counts)
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def admin_gtfs_export(request):
+    # Spooled to disk once large, so big feeds are not built in memory
+    output = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    export_feed(output)
+    output.seek(0)
+    return FileResponse(output, as_attachment=True, filename='gtfs.zip', content_type='application/zip')
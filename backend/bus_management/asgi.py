@@ -0,0 +1,15 @@
+"""
+ASGI config for bus_management project.
+
+The live location streams are async views; serve the project with an ASGI
+server, e.g.
+
+    uvicorn bus_management.asgi:application --workers 4
+"""
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_management.settings')
+
+application = get_asgi_application()
@@ -27,6 +27,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # First, so its timings cover the rest of the stack
+    'api.instrumentation.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,6 +57,9 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'bus_management.wsgi.application'
+# Serve with an ASGI server (e.g. uvicorn bus_management.asgi:application) so
+# open location streams do not each hold a thread
+ASGI_APPLICATION = 'bus_management.asgi.application'
 
 # Database
 DATABASES = {
@@ -68,6 +73,20 @@ DATABASES = {
     }
 }
 
+# Cache versions, the fleet snapshot and arrival visits must be shared by
+# every worker process; `manage.py check --deploy` refuses a local backend
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/1')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
+
+# Live location streams hear fixes ingested by other worker processes
+# through Redis pub/sub (None: only the ingesting process's streams)
+STREAM_REDIS_URL = REDIS_URL
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -79,6 +98,9 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Log api requests slower than this, with their slowest queries (None: off)
+API_SLOW_REQUEST_MS = 1000
+
 # Firebase configuration
 FIREBASE_CONFIG = {
     'apiKey': "YOUR_API_KEY",
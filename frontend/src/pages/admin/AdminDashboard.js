@@ -29,7 +29,7 @@ const AdminDashboard = () => {
         
         // Fetch recent alerts
         const alertsResponse = await axios.get('/api/admin/alerts/');
-        setAlerts(alertsResponse.data);
+        setAlerts(alertsResponse.data.results);
         
         setLoading(false);
       } catch (error) {
@@ -18,7 +18,7 @@ const BusManagement = () => {
     try {
       setLoading(true);
       const response = await axios.get('/api/admin/buses/');
-      setBuses(response.data);
+      setBuses(response.data.results);
       setLoading(false);
     } catch (err) {
       setError('Failed to fetch buses.');
@@ -1,21 +1,46 @@
+import math
 import time
-import json
 import random
-import requests
+import threading
 import serial
 import firebase_admin
 from firebase_admin import credentials, db
 from gps import gps, WATCH_ENABLE, WATCH_NEWSTYLE
 
+from dead_reckoning import NEAR_STATION_M, AdaptiveReporter
+from pipeline import Latest, Stats, Worker
+from radio import FrameEncoder
+from stations import APPROACH_M, ProximityTracker, StationCache, eta_minutes
+from uplink import FixQueue, Uplink
+
 # Configuration
 API_URL = "http://your-server.com/api/bus/location/update/"
 API_KEY = "your-api-key"
 BUS_ID = "1"  # This would be configured per bus
+# Fixes wait here while the bus has no signal
+QUEUE_PATH = "/var/lib/bus-tracker/fixes.db"
+# Report only when the server's dead-reckoned position goes stale, instead
+# of every REPORT_INTERVAL seconds
+ADAPTIVE_REPORTING = True
+REPORT_INTERVAL = 5
+# GPS read interval in adaptive mode
+SAMPLE_INTERVAL = 1
+# Stations served by this bus's route, cached on the device
+STATIONS_URL = f"http://your-server.com/api/buses/{BUS_ID}/stations/"
+STATIONS_PATH = "/var/lib/bus-tracker/stations.json"
+# Seconds between transceiver broadcasts to nearby stations
+BROADCAST_INTERVAL = 5
+# A fix older than this means gpsd has stopped delivering
+STALE_FIX_SECONDS = 5
+FIREBASE_TIMEOUT = 10
+# Seconds a transceiver write may block
+TRANSCEIVER_TIMEOUT = 1
 
 # Firebase setup
 cred = credentials.Certificate("path/to/serviceAccountKey.json")
 firebase_admin.initialize_app(cred, {
-    'databaseURL': 'https://your-app.firebaseio.com'
+    'databaseURL': 'https://your-app.firebaseio.com',
+    'httpTimeout': FIREBASE_TIMEOUT
 })
 
 # GPS setup
@@ -23,12 +48,28 @@ gpsd = gps(mode=WATCH_ENABLE|WATCH_NEWSTYLE)
 
 # Serial connection to the transceiver
 try:
-    transceiver = serial.Serial('/dev/ttyUSB0', 9600, timeout=1)
+    transceiver = serial.Serial('/dev/ttyUSB0', 9600, timeout=1, write_timeout=TRANSCEIVER_TIMEOUT)
     transceiver_connected = True
 except:
     print("Warning: Transceiver not connected")
     transceiver_connected = False
 
+# Uplink to the server, kept across fixes
+uplink = Uplink(API_URL, API_KEY, FixQueue(QUEUE_PATH))
+reporter = AdaptiveReporter()
+station_cache = StationCache(uplink.session, STATIONS_URL, STATIONS_PATH, uplink.timeout)
+proximity = ProximityTracker()
+last_broadcast = 0.0
+radio = FrameEncoder(BUS_ID)
+
+# Filled by the gpsd reader thread
+latest_fix = Latest()
+stats = Stats()
+
+def _number(value):
+    # gpsd reports NaN for speed and track it cannot determine
+    return 0.0 if value is None or math.isnan(value) else value
+
 def get_gps_data():
     try:
         gpsd.next()
@@ -36,15 +77,16 @@ def get_gps_data():
             return {
                 'latitude': gpsd.fix.latitude,
                 'longitude': gpsd.fix.longitude,
-                'speed': gpsd.fix.speed,
-                'heading': gpsd.fix.track,
+                'speed': _number(gpsd.fix.speed),
+                'heading': _number(gpsd.fix.track),
                 'timestamp': time.time()
             }
         else:
-            print("No GPS fix")
             return None
     except Exception as e:
         print(f"GPS error: {e}")
+        # Don't spin on a broken gpsd connection
+        time.sleep(SAMPLE_INTERVAL)
         # In case of GPS failure, return a simulated location for testing
         return {
             'latitude': 37.7749 + random.uniform(-0.01, 0.01),
@@ -54,23 +96,26 @@ def get_gps_data():
             'timestamp': time.time()
         }
 
+def read_gps():
+    # gpsd.next() blocks until gpsd has something to say; in its own thread
+    # that never holds up the main loop
+    while True:
+        location_data = get_gps_data()
+        if location_data:
+            latest_fix.set(location_data)
+
 def send_location_to_server(location_data):
-    try:
-        headers = {
-            'Authorization': f'Token {API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        data = {
-            'bus_id': BUS_ID,
-            **location_data
-        }
-        response = requests.post(API_URL, json=data, headers=headers)
-        if response.status_code == 200:
-            print("Location updated successfully")
-        else:
-            print(f"Server error: {response.status_code}")
-    except Exception as e:
-        print(f"Error sending data to server: {e}")
+    # Queued first, so a fix taken in a dead zone goes up with the next
+    # flush; the uplink thread is woken every tick
+    uplink.queue.push({
+        'bus_id': BUS_ID,
+        **location_data
+    })
+
+def upload(_):
+    # The uplink thread owns the HTTP session: queued fixes and the station set
+    uplink.flush()
+    station_cache.refresh()
 
 def update_firebase_location(location_data):
     try:
@@ -80,64 +125,90 @@ def update_firebase_location(location_data):
     except Exception as e:
         print(f"Firebase error: {e}")
 
+def write_transceiver(frames):
+    transceiver.write(b''.join(frames))
+
 def check_nearby_stations(location_data):
-    if not transceiver_connected:
-        return
+    # Worked out on the device from the cached station set, so it needs no
+    # server round trip. Returns whether a station is close, so reports can
+    # speed up.
+    global last_broadcast
+    nearby = station_cache.nearby(location_data['latitude'], location_data['longitude'], APPROACH_M)
     
-    try:
-        # This would be a more complex algorithm in a real implementation
-        # Here we're just simulating the process
-        
-        # Get list of nearby stations from the server
-        headers = {
-            'Authorization': f'Token {API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        params = {
-            'latitude': location_data['latitude'],
-            'longitude': location_data['longitude'],
-            'radius': 0.5  # km
-        }
-        response = requests.get(
-            "http://your-server.com/api/stations/nearby/",
-            params=params,
-            headers=headers
-        )
-        
-        if response.status_code == 200:
-            nearby_stations = response.json()
-            
-            for station in nearby_stations:
-                # Send signal to the station via transceiver
-                message = json.dumps({
-                    'bus_id': BUS_ID,
-                    'station_id': station['id'],
-                    'eta': station['eta']  # Estimated Time of Arrival
-                })
-                transceiver.write(message.encode())
-                print(f"Sent signal to station {station['id']}")
-        
-    except Exception as e:
-        print(f"Error checking nearby stations: {e}")
+    for event, distance, station in proximity.update(nearby):
+        print(f"{event.capitalize()} station {station['id']} ({distance:.0f} m)")
+    
+    now = time.monotonic()
+    if transceiver_connected and nearby and now - last_broadcast >= BROADCAST_INTERVAL:
+        last_broadcast = now
+        # Send signal to the stations via transceiver, one frame each with
+        # the Estimated Time of Arrival
+        transceiver_worker.put([
+            radio.eta(station['id'], eta_minutes(distance, location_data['speed']))
+            for distance, station in nearby
+        ])
+    
+    return any(distance <= NEAR_STATION_M for distance, _ in nearby)
+
+uplink_worker = Worker('uplink', upload, stats, maxsize=1)
+firebase_worker = Worker('firebase', update_firebase_location, stats, maxsize=1)
+transceiver_worker = Worker('transceiver', write_transceiver, stats)
 
 def main():
     print("Bus GPS tracker starting...")
     
+    threading.Thread(target=read_gps, name='gps', daemon=True).start()
+    uplink_worker.start()
+    firebase_worker.start()
+    if transceiver_connected:
+        transceiver_worker.start()
+    
+    interval = SAMPLE_INTERVAL if ADAPTIVE_REPORTING else REPORT_INTERVAL
+    last_seq = 0
+    next_tick = time.monotonic()
+    
     while True:
-        location_data = get_gps_data()
+        started = time.monotonic()
+        seq, fixed_at, location_data = latest_fix.get()
         
-        if location_data:
-            # Update server
-            send_location_to_server(location_data)
+        if location_data is None or started - fixed_at > STALE_FIX_SECONDS:
+            print("No GPS fix")
+        elif seq != last_seq:
+            last_seq = seq
+            stats.record('fix age', started - fixed_at)
+            
+            # Signal nearby stations, whether or not the uplink is up
+            near_station = check_nearby_stations(location_data)
             
-            # Update Firebase for real-time tracking
-            update_firebase_location(location_data)
+            if ADAPTIVE_REPORTING:
+                reason = reporter.check(location_data, near_station)
+            else:
+                reason = 'fixed'
             
-            # Check for nearby stations
-            check_nearby_stations(location_data)
+            if reason:
+                # Update server
+                send_location_to_server(location_data)
+                
+                # Update Firebase for real-time tracking
+                firebase_worker.put(location_data)
+                
+                reporter.sent(location_data)
         
-        # Wait before next update
-        time.sleep(5)
+        # Flush what was queued and keep draining any backlog between reports
+        uplink_worker.put(None)
+        stats.record('loop', time.monotonic() - started)
+        stats.maybe_report()
+        
+        # Wait for the next tick on a fixed schedule, so time spent in the
+        # loop does not add up
+        next_tick += interval
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            stats.count('loop overruns')
+            next_tick = time.monotonic()
+        stats.record('loop jitter', time.monotonic() - next_tick)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
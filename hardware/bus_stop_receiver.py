@@ -1,15 +1,27 @@
+import heapq
 import time
-import json
 import serial
 import requests
 import firebase_admin
 from firebase_admin import credentials, db
 from datetime import datetime
 
+from radio import FRAME_ETA, FrameDecoder, seq_gap
+
 # Configuration
 STATION_ID = "1"  # This would be configured per station
 API_URL = "http://your-server.com/api/station/update/"
 API_KEY = "your-api-key"
+# A bus not heard from for this long has left
+BUS_EXPIRY = 300
+# Changes arriving within this window are shown together
+DEBOUNCE_SECONDS = 2
+# Minimum seconds between writes to the server and Firebase
+UPLOAD_INTERVAL = 15
+# An ETA has to move by this many minutes to count as a change
+ETA_STEP = 1
+# (connect, read) seconds
+HTTP_TIMEOUT = (3.05, 10)
 
 # Firebase setup
 cred = credentials.Certificate("path/to/serviceAccountKey.json")
@@ -25,6 +37,10 @@ except Exception as e:
     print(f"Error connecting to transceiver: {e}")
     exit(1)
 
+# Kept alive between updates
+session = requests.Session()
+session.headers['Authorization'] = f'Token {API_KEY}'
+
 def update_display(bus_data):
     """
     Update the station's display with information about approaching buses
@@ -42,28 +58,25 @@ def update_display(bus_data):
 
 def notify_server(bus_data):
     """
-    Notify the server about bus arrivals
+    Notify the server about bus arrivals. Returns whether it accepted them.
     """
     try:
-        headers = {
-            'Authorization': f'Token {API_KEY}',
-            'Content-Type': 'application/json'
-        }
         data = {
             'station_id': STATION_ID,
             'bus_data': bus_data
         }
-        response = requests.post(API_URL, json=data, headers=headers)
+        response = session.post(API_URL, json=data, timeout=HTTP_TIMEOUT)
         if response.status_code == 200:
             print("Server updated successfully")
-        else:
-            print(f"Server error: {response.status_code}")
+            return True
+        print(f"Server error: {response.status_code}")
     except Exception as e:
         print(f"Error sending data to server: {e}")
+    return False
 
 def update_firebase(bus_data):
     """
-    Update Firebase with real-time bus information
+    Update Firebase with real-time bus information. Returns whether it worked.
     """
     try:
         ref = db.reference(f'station_updates/{STATION_ID}')
@@ -72,54 +85,115 @@ def update_firebase(bus_data):
             'buses': bus_data
         })
         print("Firebase updated successfully")
+        return True
     except Exception as e:
         print(f"Firebase error: {e}")
+        return False
+
+def changed(before, after):
+    """Whether the buses at the stop, as {bus_id: eta}, differ enough from `before` to update."""
+    return before.keys() != after.keys() or any(abs(after[bus_id] - before[bus_id]) >= ETA_STEP for bus_id in after)
 
 def main():
     print(f"Bus stop receiver starting for Station {STATION_ID}...")
     
     # Keep track of buses we've seen recently
     recent_buses = {}
+    # (expiry time, bus id), soonest first. Entries are left behind when a
+    # bus is heard again and skipped when they come up.
+    expiries = []
+    expires_at = {}
+    # Last frame sequence number per bus
+    last_seqs = {}
+    decoder = FrameDecoder()
+    station_id = int(STATION_ID)
+    
+    # {bus_id: eta} last shown on the display and last accepted by the
+    # server and by Firebase
+    shown = {}
+    uploaded = {}
+    published = {}
+    display_at = None
+    upload_at = None
+    last_upload = float('-inf')
     
     while True:
         try:
-            # Check for incoming signals from buses
-            if transceiver.in_waiting > 0:
-                data = transceiver.readline().decode('utf-8').strip()
-                try:
-                    bus_info = json.loads(data)
-                    bus_id = bus_info['bus_id']
-                    eta = bus_info['eta']
-                    
-                    # Store the bus info with timestamp
-                    recent_buses[bus_id] = {
-                        'bus_id': bus_id,
-                        'eta': eta,
-                        'last_seen': time.time()
-                    }
-                    
-                    print(f"Received signal from Bus {bus_id}, ETA: {eta} minutes")
-                except json.JSONDecodeError:
-                    print(f"Received invalid data: {data}")
+            # Sleep in the read until a frame arrives or the next deadline
+            now = time.monotonic()
+            deadlines = [at for at in (expiries[0][0] if expiries else None, display_at, upload_at) if at is not None]
+            transceiver.timeout = max(min(deadlines) - now, 0) if deadlines else None
+            data = transceiver.read(1)
+            if data:
+                data += transceiver.read(transceiver.in_waiting)
+            now = time.monotonic()
             
-            # Clean up old bus data (older than 5 minutes)
-            current_time = time.time()
-            buses_to_remove = []
-            for bus_id, info in recent_buses.items():
-                if current_time - info['last_seen'] > 300:  # 5 minutes
-                    buses_to_remove.append(bus_id)
+            crc_errors = decoder.crc_errors
+            for frame in decoder.feed(data):
+                # Buses broadcast to every station in range
+                if frame.kind != FRAME_ETA or frame.station_id != station_id:
+                    continue
+                bus_id = frame.bus_id
+                
+                if bus_id in last_seqs:
+                    gap = seq_gap(last_seqs[bus_id], frame.seq)
+                    if gap == 255:
+                        continue  # Repeat of the last frame
+                    if gap:
+                        print(f"Missed {gap} frames from Bus {bus_id}")
+                last_seqs[bus_id] = frame.seq
+                
+                # Store the bus info with timestamp
+                recent_buses[bus_id] = {
+                    'bus_id': bus_id,
+                    'eta': frame.eta,
+                    'last_seen': time.time()
+                }
+                expires_at[bus_id] = now + BUS_EXPIRY
+                heapq.heappush(expiries, (expires_at[bus_id], bus_id))
+                
+                print(f"Received signal from Bus {bus_id}, ETA: {frame.eta} minutes")
+            if decoder.crc_errors > crc_errors:
+                print(f"Dropped {decoder.crc_errors - crc_errors} corrupt frames")
             
-            for bus_id in buses_to_remove:
-                del recent_buses[bus_id]
+            # Forget buses not heard from in BUS_EXPIRY seconds
+            while expiries and expiries[0][0] <= now:
+                at, bus_id = heapq.heappop(expiries)
+                if expires_at.get(bus_id) == at:
+                    del recent_buses[bus_id]
+                    del expires_at[bus_id]
+                    # A bus coming back into range starts a new run of frames
+                    last_seqs.pop(bus_id, None)
             
-            # Update displays and server if we have bus data
-            if recent_buses:
-                bus_data = list(recent_buses.values())
-                update_display(bus_data)
-                notify_server(bus_data)
-                update_firebase(bus_data)
+            current = {bus_id: info['eta'] for bus_id, info in recent_buses.items()}
+            if display_at is None and changed(shown, current):
+                display_at = now + DEBOUNCE_SECONDS
             
-            time.sleep(1)
+            # Update the display once changes have settled
+            if display_at is not None and now >= display_at:
+                display_at = None
+                if changed(shown, current):
+                    update_display(list(recent_buses.values()))
+                    shown = current
+                    if upload_at is None:
+                        upload_at = max(now, last_upload + UPLOAD_INTERVAL)
+            
+            # Send everything that changed since the last upload in one go.
+            # Only sends that went through count: the server logs a departure
+            # when a report stops listing the bus, so a lost report has to be
+            # sent again even if nothing changes after it.
+            if upload_at is not None and now >= upload_at:
+                upload_at = None
+                bus_data = list(recent_buses.values())
+                if changed(uploaded, current) and notify_server(bus_data):
+                    uploaded = current
+                if changed(published, current) and update_firebase(bus_data):
+                    published = current
+                now = time.monotonic()
+                if changed(uploaded, current) or changed(published, current):
+                    upload_at = now + UPLOAD_INTERVAL
+                else:
+                    last_upload = now
             
         except Exception as e:
             print(f"Error in main loop: {e}")
@@ -0,0 +1,89 @@
+"""
+Adaptive reporting for the GPS tracker.
+
+The server extrapolates a bus forward from its last reported fix along the
+reported heading at the reported speed. The tracker runs the same
+prediction and only reports when the real position has drifted from it by
+more than DISTANCE_THRESHOLD_M, when the heading has turned by more than
+HEADING_THRESHOLD_DEG, or when MAX_INTERVAL seconds have passed. Near a
+station it reports at least every NEAR_STATION_INTERVAL seconds, so
+arrival times stay sharp. A parked bus or one cruising down a straight
+road sends almost nothing.
+
+extrapolate() must match backend/api/dead_reckoning.py exactly, or the
+server's picture drifts from what the tracker assumes it is.
+"""
+import math
+
+EARTH_RADIUS_M = 6371000
+
+DISTANCE_THRESHOLD_M = 25
+HEADING_THRESHOLD_DEG = 20
+MAX_INTERVAL = 60
+NEAR_STATION_INTERVAL = 5
+NEAR_STATION_M = 200
+# Below this, speed and heading are GPS noise and the bus is standing still
+STOPPED_SPEED = 0.5
+
+
+def extrapolate(latitude, longitude, speed, heading, seconds):
+    """Position after `seconds` at `speed` m/s on `heading` degrees."""
+    if speed < STOPPED_SPEED or seconds <= 0:
+        return latitude, longitude
+    seconds = min(seconds, MAX_INTERVAL)
+    distance = speed * seconds
+    bearing = math.radians(heading)
+    lat = latitude + math.degrees(distance * math.cos(bearing) / EARTH_RADIUS_M)
+    lon = longitude + math.degrees(
+        distance * math.sin(bearing) / (EARTH_RADIUS_M * math.cos(math.radians(latitude)))
+    )
+    return lat, lon
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    # Equirectangular; exact enough over the tens of metres compared here
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * EARTH_RADIUS_M
+
+
+def heading_change(a, b):
+    return abs((b - a + 180) % 360 - 180)
+
+
+class AdaptiveReporter:
+    def __init__(self, distance_threshold=DISTANCE_THRESHOLD_M, heading_threshold=HEADING_THRESHOLD_DEG,
+                 max_interval=MAX_INTERVAL, near_station_interval=NEAR_STATION_INTERVAL):
+        self.distance_threshold = distance_threshold
+        self.heading_threshold = heading_threshold
+        self.max_interval = max_interval
+        self.near_station_interval = near_station_interval
+        self.last = None
+
+    def predict(self, timestamp):
+        """Where the server thinks the bus is at `timestamp`."""
+        last = self.last
+        return extrapolate(last['latitude'], last['longitude'], last['speed'], last['heading'],
+                           timestamp - last['timestamp'])
+
+    def check(self, fix, near_station=False):
+        """The reason to report `fix`, or None if the server's prediction is still good."""
+        if self.last is None:
+            return 'first'
+        elapsed = fix['timestamp'] - self.last['timestamp']
+        if elapsed >= self.max_interval:
+            return 'interval'
+        moving = fix['speed'] >= STOPPED_SPEED
+        if near_station and moving and elapsed >= self.near_station_interval:
+            return 'station'
+        lat, lon = self.predict(fix['timestamp'])
+        if distance_m(lat, lon, fix['latitude'], fix['longitude']) > self.distance_threshold:
+            return 'distance'
+        if moving != (self.last['speed'] >= STOPPED_SPEED):
+            return 'motion'
+        if moving and heading_change(self.last['heading'], fix['heading']) > self.heading_threshold:
+            return 'heading'
+        return None
+
+    def sent(self, fix):
+        self.last = dict(fix)
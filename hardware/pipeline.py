@@ -0,0 +1,125 @@
+"""
+Threads, bounded queues and timing for the GPS tracker.
+
+The tracker's main loop only samples: it takes the latest fix from the
+gpsd reader thread, decides what to do with it and hands the slow work to
+Worker threads (server uplink, Firebase, transceiver) through small
+queues. A worker that stalls on a dead endpoint falls behind on its own;
+its queue keeps only the newest items, so the loop never waits for it and
+keeps its cadence.
+
+Stats keeps a rolling window of how long each stage takes, how long items
+wait in each queue and how late the loop wakes up, and prints a summary
+every STATS_INTERVAL seconds.
+"""
+import collections
+import queue
+import threading
+import time
+
+# Samples kept per timing
+STATS_WINDOW = 600
+STATS_INTERVAL = 60
+
+
+class Latest:
+    """The newest value from a producer thread, numbered so readers can tell it is new."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+        self.seq = 0
+        self.at = None
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+            self.seq += 1
+            self.at = time.monotonic()
+
+    def get(self):
+        """(sequence number, monotonic time it was set, value)."""
+        with self.lock:
+            return self.seq, self.at, self.value
+
+
+class Stats:
+    def __init__(self, interval=STATS_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # name -> recent durations in seconds
+        self.timings = {}
+        self.counts = {}
+        self.report_at = time.monotonic() + interval
+
+    def record(self, name, seconds):
+        with self.lock:
+            samples = self.timings.get(name)
+            if samples is None:
+                samples = self.timings[name] = collections.deque(maxlen=STATS_WINDOW)
+            samples.append(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def summary(self):
+        with self.lock:
+            timings = {name: sorted(samples) for name, samples in self.timings.items()}
+            counts = dict(self.counts)
+        lines = []
+        for name, samples in sorted(timings.items()):
+            def ms(fraction):
+                return samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1000
+            lines.append(f"  {name}: p50 {ms(0.5):.1f} ms, p95 {ms(0.95):.1f} ms, "
+                         f"max {samples[-1] * 1000:.1f} ms ({len(samples)} samples)")
+        for name, value in sorted(counts.items()):
+            lines.append(f"  {name}: {value}")
+        return '\n'.join(lines)
+
+    def maybe_report(self):
+        now = time.monotonic()
+        if now >= self.report_at:
+            self.report_at = now + self.interval
+            print(f"Pipeline stats:\n{self.summary()}")
+
+
+class Worker(threading.Thread):
+    """Runs `handler` on queued items in its own thread.
+
+    The queue holds at most `maxsize` items. When it is full the oldest item
+    is dropped for the new one: a fix or broadcast that has waited that long
+    is no longer worth sending.
+    """
+
+    def __init__(self, name, handler, stats, maxsize=8):
+        super().__init__(name=name, daemon=True)
+        self.handler = handler
+        self.stats = stats
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, item):
+        entry = (time.monotonic(), item)
+        while True:
+            try:
+                self.queue.put_nowait(entry)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.queue.get_nowait()
+                self.stats.count(f"{self.name} superseded")
+            except queue.Empty:
+                pass
+
+    def run(self):
+        while True:
+            queued_at, item = self.queue.get()
+            start = time.monotonic()
+            try:
+                self.handler(item)
+            except Exception as e:
+                print(f"{self.name} error: {e}")
+                self.stats.count(f"{self.name} errors")
+            self.stats.record(f"{self.name} wait", start - queued_at)
+            self.stats.record(self.name, time.monotonic() - start)
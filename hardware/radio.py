@@ -0,0 +1,111 @@
+"""
+Binary framing for the 9600-baud radio link between buses and stations.
+
+Every message is a fixed 16-byte frame:
+
+    sync     2 bytes   A5 5A
+    kind     uint8     FRAME_ETA
+    seq      uint8     per (bus, station), wraps at 256
+    bus_id   uint32
+    station  uint32
+    eta      uint16    tenths of a minute
+    crc      uint16    CRC-16/CCITT over kind..eta
+
+all little-endian. The sync bytes let a receiver find frame boundaries in
+the byte stream however the serial driver splits or merges reads, and the
+CRC rejects frames mangled by noise, including false syncs inside a
+payload. FrameDecoder skips past a bad frame one byte at a time, so it
+resynchronizes on the next good one.
+
+The sequence number is counted per station, so a station sees consecutive
+numbers from a bus in range and can tell a lost frame from a repeat.
+
+This module is shared by bus_gps_tracker.py and bus_stop_receiver.py and
+must stay identical on both ends.
+"""
+from binascii import crc_hqx
+from collections import namedtuple
+import struct
+
+SYNC = b'\xa5\x5a'
+FRAME_ETA = 1
+
+_BODY = struct.Struct('<BBIIH')
+_CRC = struct.Struct('<H')
+FRAME_SIZE = len(SYNC) + _BODY.size + _CRC.size
+CRC_INIT = 0xFFFF
+# Largest ETA a frame can carry, in minutes
+MAX_ETA = 0xFFFF / 10
+
+Frame = namedtuple('Frame', 'kind seq bus_id station_id eta')
+
+
+def _crc(body):
+    return crc_hqx(body, CRC_INIT)
+
+
+def encode(kind, seq, bus_id, station_id, eta):
+    body = _BODY.pack(kind, seq, bus_id, station_id, round(min(max(eta, 0), MAX_ETA) * 10))
+    return SYNC + body + _CRC.pack(_crc(body))
+
+
+def seq_gap(last, seq):
+    """Frames missed between sequence numbers `last` and `seq`; 255 for a repeat."""
+    return (seq - last - 1) & 0xFF
+
+
+class FrameEncoder:
+    """Numbers ETA frames from one bus, per station."""
+
+    def __init__(self, bus_id):
+        self.bus_id = int(bus_id)
+        self.seqs = {}
+
+    def eta(self, station_id, eta):
+        seq = self.seqs.get(station_id, 0)
+        self.seqs[station_id] = (seq + 1) & 0xFF
+        return encode(FRAME_ETA, seq, self.bus_id, station_id, eta)
+
+
+class FrameDecoder:
+    """Streaming decoder: feed() it bytes as they arrive, get whole frames back."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        while True:
+            index = buffer.find(SYNC, start)
+            if index < 0:
+                # A trailing first sync byte may be the start of the next frame
+                keep = 1 if buffer.endswith(SYNC[:1]) else 0
+                self.skipped_bytes += len(buffer) - start - keep
+                start = len(buffer) - keep
+                break
+            self.skipped_bytes += index - start
+            if len(buffer) - index < FRAME_SIZE:
+                start = index
+                break
+            body_at = index + len(SYNC)
+            body = bytes(buffer[body_at:body_at + _BODY.size])
+            (crc,) = _CRC.unpack_from(buffer, body_at + _BODY.size)
+            if crc != _crc(body):
+                # Noise that looked like a sync, or a damaged frame: resync
+                # from the next byte
+                self.crc_errors += 1
+                self.skipped_bytes += 1
+                start = index + 1
+                continue
+            kind, seq, bus_id, station_id, eta = _BODY.unpack(body)
+            frames.append(Frame(kind, seq, bus_id, station_id, eta / 10))
+            start = index + FRAME_SIZE
+        del buffer[:start]
+        self.frames += len(frames)
+        return frames
@@ -0,0 +1,148 @@
+"""
+Compare binary radio frames with the JSON messages they replaced.
+
+For the same stream of bus-to-station messages this reports the bytes per
+message, how many messages per second fit through a 9600-baud 8N1 link
+(960 bytes a second), how fast each format decodes on this machine, and
+how many messages survive a noisy link. Reads are split at random points
+to mimic a serial driver. JSON is newline-delimited here, which is what
+the receiver's readline() needed.
+
+    python radio_benchmark.py --messages 20000 --error-rate 0.001
+
+With --port, frames are also sent through a serial loopback (TX wired to
+RX) and the measured rate is reported.
+"""
+import argparse
+import json
+import random
+import time
+
+from radio import FRAME_SIZE, FrameDecoder, FrameEncoder
+
+BAUD = 9600
+# 8N1: a start and a stop bit around every byte
+BITS_PER_BYTE = 10
+
+
+def make_messages(count, seed):
+    rng = random.Random(seed)
+    return [(rng.randint(1, 400), rng.randint(1, 3000), round(rng.uniform(0, 30), 1)) for _ in range(count)]
+
+
+def encode_json(messages):
+    return b''.join(
+        json.dumps({'bus_id': str(bus_id), 'station_id': station_id, 'eta': eta}).encode() + b'\n'
+        for bus_id, station_id, eta in messages
+    )
+
+
+def encode_frames(messages):
+    encoders = {}
+    frames = []
+    for bus_id, station_id, eta in messages:
+        encoder = encoders.get(bus_id)
+        if encoder is None:
+            encoder = encoders[bus_id] = FrameEncoder(bus_id)
+        frames.append(encoder.eta(station_id, eta))
+    return b''.join(frames)
+
+
+def chunks(data, rng):
+    i = 0
+    while i < len(data):
+        size = rng.randint(1, 64)
+        yield data[i:i + size]
+        i += size
+
+
+def corrupt(data, error_rate, rng):
+    data = bytearray(data)
+    for _ in range(int(len(data) * error_rate)):
+        data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+    return bytes(data)
+
+
+def decode_json(stream, rng):
+    decoded = []
+    buffer = b''
+    for chunk in chunks(stream, rng):
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            try:
+                message = json.loads(line)
+                decoded.append((int(message['bus_id']), message['station_id'], message['eta']))
+            except (ValueError, KeyError, TypeError):
+                pass
+    return decoded
+
+
+def decode_frames(stream, rng):
+    decoder = FrameDecoder()
+    decoded = []
+    for chunk in chunks(stream, rng):
+        decoded.extend((frame.bus_id, frame.station_id, frame.eta) for frame in decoder.feed(chunk))
+    return decoded
+
+
+def score(sent, decoded):
+    """(messages received intact, messages received with wrong contents)."""
+    sent = set(sent)
+    intact = sum(1 for message in decoded if message in sent)
+    return intact, len(decoded) - intact
+
+
+def loopback(port, stream):
+    import serial
+
+    with serial.Serial(port, BAUD, timeout=1) as link:
+        decoder = FrameDecoder()
+        received = 0
+        start = time.perf_counter()
+        link.write(stream)
+        while True:
+            data = link.read(max(link.in_waiting, 1))
+            if not data:
+                break
+            received += len(decoder.feed(data))
+        return received, time.perf_counter() - start - link.timeout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--error-rate', type=float, default=0.001, help="Flipped bits per byte on the noisy link")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', help="Serial port with TX looped back to RX")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.seed)
+    link_bytes = BAUD / BITS_PER_BYTE
+    print(f"{args.messages} messages, {BAUD} baud")
+    print(f"{'':8} {'bytes/msg':>10} {'link msg/s':>11} {'decode msg/s':>13} "
+          f"{'noisy intact':>13} {'noisy wrong':>12}")
+
+    for name, encode, decode in (('json', encode_json, decode_json), ('binary', encode_frames, decode_frames)):
+        stream = encode(messages)
+        size = len(stream) / len(messages)
+
+        start = time.perf_counter()
+        decoded = decode(stream, random.Random(args.seed))
+        elapsed = time.perf_counter() - start
+        assert len(decoded) == len(messages), f"{name} lost messages on a clean link"
+
+        noisy = corrupt(stream, args.error_rate, random.Random(args.seed))
+        intact, wrong = score(messages, decode(noisy, random.Random(args.seed)))
+        print(f"{name:8} {size:10.1f} {link_bytes / size:11.1f} {len(messages) / elapsed:13.0f} "
+              f"{intact / len(messages):12.1%} {wrong:12}")
+
+    if args.port:
+        stream = encode_frames(messages[:2000])
+        received, elapsed = loopback(args.port, stream)
+        print(f"\nloopback on {args.port}: {received} of 2000 frames, {received / elapsed:.1f} frames/s "
+              f"(at most {link_bytes / FRAME_SIZE:.1f})")
+
+
+if __name__ == "__main__":
+    main()
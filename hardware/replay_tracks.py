@@ -0,0 +1,117 @@
+"""
+Replay recorded GPS tracks through the adaptive reporter.
+
+Counts how many messages adaptive reporting would have sent compared with
+fixed-interval reporting, and how far the server's dead-reckoned position
+was from the real one at every recorded fix.
+
+Tracks are JSON saved from /api/admin/buses/<id>/history/?resolution=raw, or
+CSV files with timestamp,latitude,longitude,speed,heading columns
+(timestamp in epoch seconds or ISO 8601). Pass a JSON list of stations
+(/api/stations/) to replay the faster reporting near stations too.
+
+    python replay_tracks.py bus12.json bus40.csv --stations stations.json
+"""
+import argparse
+import csv
+import json
+from datetime import datetime
+
+from dead_reckoning import NEAR_STATION_M, AdaptiveReporter, distance_m
+
+REPORT_INTERVAL = 5
+
+
+def _timestamp(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def load_track(path):
+    if path.endswith('.json'):
+        with open(path) as f:
+            rows = json.load(f)['locations']
+    else:
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+    fixes = [{
+        'timestamp': _timestamp(str(row['timestamp'])),
+        'latitude': float(row['latitude']),
+        'longitude': float(row['longitude']),
+        'speed': float(row.get('speed') or 0),
+        'heading': float(row.get('heading') or 0),
+    } for row in rows]
+    fixes.sort(key=lambda fix: fix['timestamp'])
+    return fixes
+
+
+def near_any(fix, stations):
+    return any(
+        distance_m(fix['latitude'], fix['longitude'], lat, lon) <= NEAR_STATION_M for lat, lon in stations
+    )
+
+
+def replay(fixes, stations):
+    reporter = AdaptiveReporter()
+    reasons = {}
+    errors = []
+    fixed = 0
+    last_fixed = None
+    for fix in fixes:
+        if last_fixed is None or fix['timestamp'] - last_fixed >= REPORT_INTERVAL:
+            fixed += 1
+            last_fixed = fix['timestamp']
+
+        # The tracker checks its cached stations on every fix
+        reason = reporter.check(fix, near_any(fix, stations))
+        if reason:
+            reasons[reason] = reasons.get(reason, 0) + 1
+            reporter.sent(fix)
+            errors.append(0.0)
+        else:
+            lat, lon = reporter.predict(fix['timestamp'])
+            errors.append(distance_m(lat, lon, fix['latitude'], fix['longitude']))
+    return fixed, reasons, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('tracks', nargs='+')
+    parser.add_argument('--stations', help="JSON list of stations with latitude and longitude")
+    args = parser.parse_args()
+
+    stations = []
+    if args.stations:
+        with open(args.stations) as f:
+            stations = [(s['latitude'], s['longitude']) for s in json.load(f)]
+
+    total_fixes = total_fixed = total_adaptive = 0
+    all_errors = []
+    for path in args.tracks:
+        fixes = load_track(path)
+        if not fixes:
+            continue
+        fixed, reasons, errors = replay(fixes, stations)
+        adaptive = sum(reasons.values())
+        print(f"{path}: {len(fixes)} fixes, every {REPORT_INTERVAL} s: {fixed} messages, "
+              f"adaptive: {adaptive} ({reasons}), max error {max(errors):.1f} m")
+        total_fixes += len(fixes)
+        total_fixed += fixed
+        total_adaptive += adaptive
+        all_errors.extend(errors)
+
+    if not all_errors:
+        print("No fixes to replay")
+        return
+    all_errors.sort()
+    print(f"\n{total_fixes} fixes replayed")
+    print(f"messages: {total_fixed} at a fixed {REPORT_INTERVAL} s, {total_adaptive} adaptive "
+          f"({1 - total_adaptive / total_fixed:.0%} fewer)")
+    print(f"server position error: mean {sum(all_errors) / len(all_errors):.1f} m, "
+          f"p95 {all_errors[int(len(all_errors) * 0.95)]:.1f} m, max {all_errors[-1]:.1f} m")
+
+
+if __name__ == "__main__":
+    main()
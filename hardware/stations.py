@@ -0,0 +1,156 @@
+"""
+On-device station set for the GPS tracker.
+
+The tracker downloads the stations its route serves from
+/api/buses/<id>/stations/ once and keeps them in a small grid index, saved
+to disk so a restart without signal still has them. Every REFRESH_INTERVAL
+it revalidates with the set's ETag, which costs one 304 while nothing
+changed. Proximity to stations and approach/arrival/departure events are
+worked out locally from each fix, so the transceiver keeps broadcasting to
+stations when the uplink is down. refresh() may run on another thread than
+nearby().
+"""
+import json
+import math
+import os
+import threading
+import time
+
+from dead_reckoning import EARTH_RADIUS_M, distance_m
+
+REFRESH_INTERVAL = 3600
+RETRY_INTERVAL = 300
+
+# Grid cell size; lookups cover the 3x3 cells around a point, so a radius
+# up to this size is answered exactly
+CELL_M = 500
+
+APPROACH_M = 500
+ARRIVAL_M = 40
+# Wider than ARRIVAL_M so GPS jitter at the stop does not read as leaving
+DEPARTURE_M = 70
+
+# Same floor as the server's nearby-stations ETA
+MIN_SPEED_KMH = 5
+
+
+def eta_minutes(metres, speed):
+    """Minutes to cover `metres` at `speed` m/s."""
+    speed_kmh = max(speed * 3.6, MIN_SPEED_KMH)
+    return round(metres / 1000 / speed_kmh * 60, 1)
+
+
+class StationCache:
+    def __init__(self, session, url, path, timeout):
+        self.session = session
+        self.url = url
+        self.path = path
+        self.timeout = timeout
+        self.etag = None
+        self.lock = threading.Lock()
+        self.stations = []
+        self.cells = {}
+        self.cos_lat = 1.0
+        self.refresh_at = 0.0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.etag = saved.get('etag')
+        self._index(saved.get('stations', []))
+
+    def _save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'etag': self.etag, 'stations': self.stations}, f)
+        os.replace(tmp, self.path)
+
+    def _cell(self, lat, lon):
+        # Equirectangular metres; a route spans a few kilometres at most
+        y = math.radians(lat) * EARTH_RADIUS_M
+        x = math.radians(lon) * EARTH_RADIUS_M * self.cos_lat
+        return int(y // CELL_M), int(x // CELL_M)
+
+    def _index(self, stations):
+        with self.lock:
+            self.stations = stations
+            lat0 = stations[0]['latitude'] if stations else 0.0
+            self.cos_lat = math.cos(math.radians(lat0))
+            self.cells = {}
+            for station in stations:
+                self.cells.setdefault(self._cell(station['latitude'], station['longitude']), []).append(station)
+
+    def refresh(self):
+        """Revalidate the station set if it is due. Failures keep the current set."""
+        now = time.monotonic()
+        if now < self.refresh_at:
+            return
+        headers = {'If-None-Match': self.etag} if self.etag and self.stations else {}
+        try:
+            response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        except Exception as e:
+            print(f"Error refreshing stations: {e}")
+            self.refresh_at = now + RETRY_INTERVAL
+            return
+        if response.status_code == 200:
+            self.etag = response.headers.get('ETag')
+            self._index(response.json()['stations'])
+            self._save()
+            print(f"Station set updated: {len(self.stations)} stations")
+        elif response.status_code != 304:
+            print(f"Server error refreshing stations: {response.status_code}")
+            self.refresh_at = now + RETRY_INTERVAL
+            return
+        self.refresh_at = now + REFRESH_INTERVAL
+
+    def nearby(self, lat, lon, radius_m):
+        """(distance in metres, station) within `radius_m`, closest first."""
+        found = []
+        with self.lock:
+            if not self.stations:
+                return found
+            row, col = self._cell(lat, lon)
+            for r in (row - 1, row, row + 1):
+                for c in (col - 1, col, col + 1):
+                    for station in self.cells.get((r, c), ()):
+                        distance = distance_m(lat, lon, station['latitude'], station['longitude'])
+                        if distance <= radius_m:
+                            found.append((distance, station))
+        found.sort(key=lambda item: item[0])
+        return found
+
+
+class ProximityTracker:
+    """Turns successive fixes into approach, arrival and departure events per station."""
+
+    def __init__(self):
+        # station id -> 'approaching', 'arrived' or 'departed'
+        self.states = {}
+
+    def update(self, nearby):
+        """`nearby` is StationCache.nearby() within APPROACH_M. Returns [(event, distance, station)]."""
+        events = []
+        seen = set()
+        for distance, station in nearby:
+            station_id = station['id']
+            seen.add(station_id)
+            state = self.states.get(station_id)
+            if state is None:
+                state = self.states[station_id] = 'approaching'
+                events.append(('approach', distance, station))
+            if state == 'approaching' and distance <= ARRIVAL_M:
+                self.states[station_id] = 'arrived'
+                events.append(('arrive', distance, station))
+            elif state == 'arrived' and distance > DEPARTURE_M:
+                self.states[station_id] = 'departed'
+                events.append(('depart', distance, station))
+        for station_id in list(self.states):
+            if station_id not in seen:
+                # Out of range: forget it, so the next visit starts over
+                del self.states[station_id]
+        return events
+
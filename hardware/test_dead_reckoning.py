@@ -0,0 +1,77 @@
+"""
+Tests for adaptive reporting, replaying a recorded track.
+
+    cd hardware && python -m unittest
+"""
+import importlib.util
+import json
+import os
+import random
+import unittest
+
+from dead_reckoning import DISTANCE_THRESHOLD_M, MAX_INTERVAL, STOPPED_SPEED, extrapolate
+from replay_tracks import load_track, replay
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+BACKEND_MODULE = os.path.join(HERE, '..', 'backend', 'api', 'dead_reckoning.py')
+
+
+def load_backend():
+    """backend/api/dead_reckoning.py, or None where Django is not installed (as on the buses)."""
+    try:
+        import django  # noqa: F401
+    except ImportError:
+        return None
+    spec = importlib.util.spec_from_file_location('backend_dead_reckoning', BACKEND_MODULE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+backend = load_backend()
+
+
+class ReplayTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # A bus parked, then eight runs between stops with GPS noise
+        cls.fixes = load_track(os.path.join(FIXTURES, 'track.csv'))
+        with open(os.path.join(FIXTURES, 'stations.json')) as f:
+            cls.stations = [(s['latitude'], s['longitude']) for s in json.load(f)]
+
+    def test_sends_far_fewer_messages_than_fixed_interval(self):
+        fixed, reasons, _ = replay(self.fixes, [])
+        self.assertEqual(fixed, 198)
+        self.assertLessEqual(sum(reasons.values()), fixed * 0.4)
+
+    def test_faster_reporting_near_stations_still_saves(self):
+        fixed, reasons, _ = replay(self.fixes, self.stations)
+        self.assertGreater(reasons.get('station', 0), 0)
+        self.assertLessEqual(sum(reasons.values()), fixed * 0.6)
+
+    def test_server_position_stays_within_threshold(self):
+        for stations in ([], self.stations):
+            _, _, errors = replay(self.fixes, stations)
+            self.assertEqual(len(errors), len(self.fixes))
+            self.assertLessEqual(max(errors), DISTANCE_THRESHOLD_M)
+
+
+@unittest.skipIf(backend is None, "Django is not installed")
+class SharedExtrapolationTests(unittest.TestCase):
+    def test_backend_extrapolates_identically(self):
+        self.assertEqual((backend.MAX_INTERVAL, backend.STOPPED_SPEED), (MAX_INTERVAL, STOPPED_SPEED))
+        rng = random.Random(1)
+        cases = [(37.77, -122.42, 0.2, 90, 10), (37.77, -122.42, 12, 45, 0), (37.77, -122.42, 12, 45, 600),
+                 (-33.9, 151.2, 8.3, 359.9, 59.5), (64.1, -21.9, 30, 180, 1e-3)]
+        cases += [
+            (rng.uniform(-70, 70), rng.uniform(-180, 180), rng.uniform(0, 35), rng.uniform(0, 360),
+             rng.uniform(-5, 90))
+            for _ in range(2000)
+        ]
+        for case in cases:
+            self.assertEqual(backend.extrapolate(*case), extrapolate(*case), case)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Tests for the radio framing.
+
+    cd hardware && python -m unittest
+"""
+import random
+import unittest
+
+from radio import FRAME_ETA, FRAME_SIZE, SYNC, Frame, FrameDecoder, FrameEncoder, encode, seq_gap
+from radio_benchmark import (
+    BAUD, BITS_PER_BYTE, corrupt, decode_frames, decode_json, encode_frames, encode_json, make_messages, score,
+)
+
+
+def frames_for(count, bus_id=7):
+    encoder = FrameEncoder(bus_id)
+    return [encoder.eta(100, i % 300 / 10) for i in range(count)]
+
+
+def feed_in_chunks(decoder, data, rng, largest):
+    frames = []
+    i = 0
+    while i < len(data):
+        size = rng.randint(1, largest)
+        frames.extend(decoder.feed(data[i:i + size]))
+        i += size
+    return frames
+
+
+class FrameDecoderTests(unittest.TestCase):
+    def test_round_trip(self):
+        frame = encode(FRAME_ETA, 255, 4000000000, 12, 7.25)
+        self.assertEqual(len(frame), FRAME_SIZE)
+        self.assertEqual(FrameDecoder().feed(frame), [Frame(FRAME_ETA, 255, 4000000000, 12, 7.2)])
+
+    def test_any_chunking_gives_the_same_frames(self):
+        data = b''.join(frames_for(200))
+        expected = FrameDecoder().feed(data)
+        self.assertEqual(len(expected), 200)
+        rng = random.Random(1)
+        for largest in (1, 2, 3, FRAME_SIZE - 1, FRAME_SIZE + 1, 64):
+            decoder = FrameDecoder()
+            self.assertEqual(feed_in_chunks(decoder, data, rng, largest), expected, largest)
+            self.assertEqual((decoder.crc_errors, decoder.skipped_bytes), (0, 0))
+
+    def test_resyncs_after_garbage(self):
+        good = frames_for(3)
+        # Line noise, including a false sync and a frame cut short
+        data = good[0] + b'\x00\xff' + SYNC + b'\x01\x02' + good[1][:9] + good[2] + SYNC[:1]
+        decoder = FrameDecoder()
+        frames = feed_in_chunks(decoder, data, random.Random(2), 5)
+        self.assertEqual([frame.seq for frame in frames], [0, 2])
+        self.assertEqual(decoder.frames, 2)
+        self.assertGreater(decoder.skipped_bytes, 0)
+        # The trailing half sync is kept for the next read
+        self.assertEqual(decoder.feed(good[0][1:]), FrameDecoder().feed(good[0]))
+
+    def test_every_single_bit_flip_is_rejected(self):
+        frame = frames_for(1)[0]
+        for bit in range(len(SYNC) * 8, FRAME_SIZE * 8):
+            damaged = bytearray(frame)
+            damaged[bit // 8] ^= 1 << bit % 8
+            decoder = FrameDecoder()
+            self.assertEqual(decoder.feed(bytes(damaged)), [], bit)
+            self.assertEqual(decoder.crc_errors, 1, bit)
+
+    def test_damaged_frame_does_not_hide_the_next_one(self):
+        first, second = frames_for(2)
+        damaged = bytearray(first)
+        damaged[6] ^= 0x10
+        frames = FrameDecoder().feed(bytes(damaged) + second)
+        self.assertEqual([frame.seq for frame in frames], [1])
+
+    def test_sequence_gaps(self):
+        self.assertEqual(seq_gap(4, 5), 0)
+        self.assertEqual(seq_gap(4, 7), 2)
+        self.assertEqual(seq_gap(255, 0), 0)
+        self.assertEqual(seq_gap(9, 9), 255)
+
+
+class FramesAgainstJsonTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.messages = make_messages(2000, seed=1)
+
+    def link_rate(self, stream):
+        """Messages per second a 9600-baud 8N1 link carries."""
+        return BAUD / BITS_PER_BYTE / (len(stream) / len(self.messages))
+
+    def test_frames_carry_more_messages_per_second(self):
+        json_rate = self.link_rate(encode_json(self.messages))
+        frame_rate = self.link_rate(encode_frames(self.messages))
+        self.assertEqual(frame_rate, BAUD / BITS_PER_BYTE / FRAME_SIZE)
+        self.assertGreater(frame_rate, json_rate * 3)
+
+    def test_clean_link_delivers_everything(self):
+        self.assertEqual(len(decode_json(encode_json(self.messages), random.Random(1))), len(self.messages))
+        self.assertEqual(len(decode_frames(encode_frames(self.messages), random.Random(1))), len(self.messages))
+
+    def test_noisy_link_never_delivers_wrong_frames(self):
+        noisy = corrupt(encode_frames(self.messages), 0.002, random.Random(3))
+        intact, wrong = score(self.messages, decode_frames(noisy, random.Random(3)))
+        self.assertEqual(wrong, 0)
+        # About one frame in 30 takes a hit at this rate
+        self.assertGreater(intact, len(self.messages) * 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
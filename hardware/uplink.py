@@ -0,0 +1,138 @@
+"""
+Store-and-forward uplink for the GPS tracker.
+
+Every fix is first written to a small SQLite queue on the device (WAL mode,
+so an append is one cheap write that survives a power cut), then the queue
+is flushed to the server's batch endpoint, oldest first, as gzip-compressed
+JSON over one keep-alive session. A fix only leaves the queue once the
+server has accepted it. When the uplink is down, flushes back off
+exponentially; when it comes back, the backlog goes up in as few requests as
+the server's batch limit allows. The queue is capped, and the oldest fixes
+are evicted first, so a long outage cannot fill the disk.
+
+FixQueue can be shared between threads: the tracker pushes fixes from its
+sampling loop while its uplink thread flushes.
+"""
+import gzip
+import json
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# The server takes up to 5000 fixes per request
+BATCH_SIZE = 5000
+# About 100 bytes per fix: roughly 10 MB, or a week of fixes every 5 seconds
+MAX_QUEUED_FIXES = 100000
+
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+# (connect, read) seconds
+TIMEOUT = (3.05, 15)
+
+
+class FixQueue:
+    def __init__(self, path, max_fixes=MAX_QUEUED_FIXES):
+        self.max_fixes = max_fixes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        # Free pages are returned to the file system after deletes
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fixes (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)"
+        )
+
+    def push(self, fix):
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO fixes (payload) VALUES (?)", (json.dumps(fix),))
+            # Ids only grow, so everything at or below this is beyond the cap
+            evicted = self.db.execute("DELETE FROM fixes WHERE id <= ?", (cursor.lastrowid - self.max_fixes,))
+        if evicted.rowcount:
+            print(f"Uplink queue full, dropped {evicted.rowcount} oldest fixes")
+
+    def peek(self, limit):
+        """The oldest `limit` fixes as (last id, [fix, ...])."""
+        with self.lock:
+            rows = self.db.execute("SELECT id, payload FROM fixes ORDER BY id LIMIT ?", (limit,)).fetchall()
+        if not rows:
+            return None, []
+        return rows[-1][0], [json.loads(payload) for _, payload in rows]
+
+    def ack(self, last_id):
+        with self.lock:
+            self.db.execute("DELETE FROM fixes WHERE id <= ?", (last_id,))
+
+    def compact(self):
+        with self.lock:
+            self.db.execute("PRAGMA incremental_vacuum")
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM fixes").fetchone()[0]
+
+
+class Uplink:
+    def __init__(self, url, api_key, queue, batch_size=BATCH_SIZE):
+        self.url = url
+        self.queue = queue
+        self.batch_size = batch_size
+        self.timeout = TIMEOUT
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.headers['Authorization'] = f'Token {api_key}'
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def send(self, fix):
+        self.queue.push(fix)
+        self.flush()
+
+    def flush(self):
+        """Upload queued fixes until the queue is empty or a request fails. Returns fixes sent."""
+        if time.monotonic() < self.retry_at:
+            return 0
+        sent = 0
+        while True:
+            last_id, fixes = self.queue.peek(self.batch_size)
+            if not fixes:
+                break
+            body = gzip.compress(json.dumps({'fixes': fixes}).encode())
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout, headers={
+                    'Content-Type': 'application/json',
+                    'Content-Encoding': 'gzip',
+                })
+            except requests.RequestException as e:
+                self._back_off(f"Error sending data to server: {e}")
+                break
+            if response.status_code == 400:
+                # The server will never take this batch; retrying would block the queue
+                print(f"Server rejected {len(fixes)} fixes: {response.text[:200]}")
+                self.queue.ack(last_id)
+                continue
+            if response.status_code != 200:
+                self._back_off(f"Server error: {response.status_code}")
+                break
+            self.queue.ack(last_id)
+            self.failures = 0
+            sent += len(fixes)
+            if len(fixes) < self.batch_size:
+                break
+        if sent > 1:
+            print(f"Uploaded {sent} queued fixes")
+            self.queue.compact()
+        return sent
+
+    def _back_off(self, message):
+        self.failures += 1
+        # Full jitter, so a depot full of buses does not reconnect in lockstep
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** self.failures))
+        self.retry_at = time.monotonic() + delay
+        print(f"{message}; {len(self.queue)} fixes queued, retrying in {delay:.0f} s")